@@ -3,8 +3,10 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from typing import Optional
 from datetime import datetime, timedelta
-from database import SessionLocal
-from crud import get_user_by_username
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from crud import get_user_by_username_async
+from user_cache import get_cached_user, cache_user
 import os
 from dotenv import load_dotenv
 from passlib.context import CryptContext
@@ -77,7 +79,11 @@ async def get_token_from_request(
     print("Токен не найден")
     return None
 
-async def get_current_user(request: Request, token: Optional[str] = Depends(get_token_from_request)):
+async def get_current_user(
+    request: Request,
+    token: Optional[str] = Depends(get_token_from_request),
+    db: AsyncSession = Depends(get_async_db)
+):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Не удалось проверить учетные данные",
@@ -123,29 +129,42 @@ async def get_current_user(request: Request, token: Optional[str] = Depends(get_
         print(f"Ошибка при декодировании JWT: {e}")
         raise credentials_exception
     
-    db = SessionLocal()
-    try:
-        user = get_user_by_username(db, username=token_data.username)
-        if user is None:
-            print(f"Пользователь с username={token_data.username} не найден в БД")
-            
-            # Особый случай для суперадмина
-            if "superadmin" in token_data.username:
-                print("Создание объекта пользователя для суперадмина")
-                from models import User
-                return User(
-                    id=user_id or -1,
-                    username=username,
-                    email=username,
-                    role="superadmin"
-                )
-            
-            raise credentials_exception
+    # Обычно пользователь уже в кэше, и запроса к БД нет
+    cached_user = await get_cached_user(token_data.username, token_data.user_id)
+    if cached_user is not None:
+        return cached_user
+    
+    # Сессия запроса общая с обработчиком (см. database.get_async_db),
+    # поэтому проверка пользователя не занимает отдельное соединение из пула
+    user = await get_user_by_username_async(db, username=token_data.username)
+    # Завершаем читающую транзакцию, чтобы соединение не простаивало,
+    # пока обработчик выполняет работу без БД (объекты не expire-ятся)
+    await db.commit()
+    if user is None:
+        print(f"Пользователь с username={token_data.username} не найден в БД")
         
-        print(f"Пользователь найден: id={user.id}, role={user.role}")
-        return user
-    finally:
-        db.close()
+        # Особый случай для суперадмина
+        if "superadmin" in token_data.username:
+            print("Создание объекта пользователя для суперадмина")
+            from models import User
+            return User(
+                id=user_id or -1,
+                username=username,
+                email=username,
+                role="superadmin"
+            )
+        
+        raise credentials_exception
+    
+    print(f"Пользователь найден: id={user.id}, role={user.role}")
+    await cache_user(token_data.username, token_data.user_id, user)
+    return user
+
+# Зависимость для служебных эндпоинтов (метрики и т.п.), доступных только админам
+async def get_current_admin(current_user = Depends(get_current_user)):
+    if current_user.role not in ["admin", "superadmin"]:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return current_user
 
 # Вспомогательная функция для проверки прав доступа к контактам других пользователей
 def check_contact_access(user, contact_user_id):
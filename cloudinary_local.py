@@ -0,0 +1,90 @@
+"""
+Локальная заглушка Upload API Cloudinary для разработки и проверки
+фоновой загрузки аватаров (media_pipeline) без аккаунта Cloudinary.
+
+Реализует только то, что использует utils_cloudinary: upload и destroy для
+изображений и пакетное удаление Admin API (delete_resources). Подпись
+запроса не проверяется. Файлы хранятся в CLOUDINARY_LOCAL_DIR и отдаются
+по /media/...
+
+Запуск:
+    uvicorn cloudinary_local:app --port 8090
+и в окружении приложения:
+    CLOUDINARY_UPLOAD_PREFIX=http://localhost:8090
+    CLOUDINARY_CLOUD_NAME=local (любое непустое значение)
+
+CLOUDINARY_LOCAL_FAIL_RATE (0..1) — доля запросов upload, на которые
+заглушка отвечает ошибкой 500 (для проверки повторных попыток); та же доля
+применяется к пакетному удалению.
+"""
+import os
+import random
+import uuid
+
+from fastapi import FastAPI, Form, UploadFile, File, Request
+from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
+
+CLOUDINARY_LOCAL_DIR = os.getenv("CLOUDINARY_LOCAL_DIR", "local_cloudinary")
+CLOUDINARY_LOCAL_FAIL_RATE = float(os.getenv("CLOUDINARY_LOCAL_FAIL_RATE", "0"))
+
+os.makedirs(CLOUDINARY_LOCAL_DIR, exist_ok=True)
+
+app = FastAPI(title="Local Cloudinary stand-in")
+app.mount("/media", StaticFiles(directory=CLOUDINARY_LOCAL_DIR), name="media")
+
+def _error(status_code: int, message: str):
+    # Формат ошибок Cloudinary: SDK ищет ключ "error" в ответе
+    return JSONResponse(status_code=status_code, content={"error": {"message": message}})
+
+def _stored_path(public_id: str):
+    parts = [part for part in public_id.split("/") if part not in ("", ".", "..")]
+    return os.path.join(CLOUDINARY_LOCAL_DIR, *parts)
+
+@app.post("/v1_1/{cloud_name}/image/upload")
+async def upload(
+    request: Request,
+    cloud_name: str,
+    file: UploadFile = File(...),
+    folder: str = Form(""),
+    public_id: str = Form(None),
+):
+    if random.random() < CLOUDINARY_LOCAL_FAIL_RATE:
+        return _error(500, "Simulated upload failure")
+    public_id = "/".join(part for part in (folder, public_id or uuid.uuid4().hex) if part)
+    path = _stored_path(public_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = await file.read()
+    with open(path, "wb") as out:
+        out.write(data)
+    url = f"{str(request.base_url).rstrip('/')}/media/{public_id}"
+    return {
+        "public_id": public_id,
+        "resource_type": "image",
+        "bytes": len(data),
+        "url": url,
+        "secure_url": url,
+    }
+
+@app.post("/v1_1/{cloud_name}/image/destroy")
+async def destroy(cloud_name: str, public_id: str = Form(...)):
+    path = _stored_path(public_id)
+    if not os.path.exists(path):
+        return {"result": "not found"}
+    os.remove(path)
+    return {"result": "ok"}
+
+@app.delete("/v1_1/{cloud_name}/resources/image/upload")
+async def delete_resources(cloud_name: str, request: Request):
+    if random.random() < CLOUDINARY_LOCAL_FAIL_RATE:
+        return _error(500, "Simulated delete failure")
+    body = await request.json()
+    deleted = {}
+    for public_id in body.get("public_ids", []):
+        path = _stored_path(public_id)
+        if os.path.exists(path):
+            os.remove(path)
+            deleted[public_id] = "deleted"
+        else:
+            deleted[public_id] = "not_found"
+    return {"deleted": deleted, "partial": False}
@@ -0,0 +1,222 @@
+"""
+Пакетные изменения контактов (POST /contacts/batch).
+
+Пакет операций create / update / delete / set_groups / add_groups /
+remove_groups применяется в одной транзакции:
+- доступ ко всем затронутым контактам проверяется одним запросом (строки
+  блокируются FOR UPDATE до конца транзакции), существование групп — ещё одним;
+- изменения выполняются массовыми запросами по фазам: вставка новых
+  контактов, UPDATE по первичному ключу, замена телефонов, назначение,
+  добавление и удаление групп, удаление контактов. Порядок фаз не зависит от
+  порядка операций в списке; повторные update и set_groups одного контакта
+  объединяются (побеждает последняя);
+- если массовый шаг упал на ограничении БД, операции повторяются по одной в
+  savepoint'ах, и ошибка достаётся только своей операции.
+
+Для каждой операции возвращается код, который вернул бы одиночный запрос
+(201, 200, 400, 403, 404). С atomic=true при ошибке любой операции
+транзакция откатывается, а остальные операции получают 424.
+"""
+from pydantic import ValidationError
+from sqlalchemy import select, insert, update, delete, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
+
+import crud
+import models
+from auth import check_contact_access
+from media_cleanup import schedule_url_deletion
+from schemas import ContactCreate, ContactUpdate, validation_error_message
+
+stats = {"batches": 0, "operations": 0, "failed": 0, "fallbacks": 0, "rolled_back": 0}
+
+def _parse(op, current_user: models.User):
+    """Проверенные данные операции: ContactCreate, ContactUpdate, список групп или None (delete)."""
+    if op.op == "create":
+        data = dict(op.data or {})
+        # Как в POST /contacts/: чужой user_id могут указать только админы
+        if current_user.role not in ("superadmin", "admin") or data.get("user_id") is None:
+            data["user_id"] = current_user.id
+        data.setdefault("phone_numbers", [])
+        return ContactCreate(**data)
+    if op.id is None:
+        raise ValueError("id is required")
+    if op.op == "update":
+        return ContactUpdate(**(op.data or {}))
+    if op.op == "delete":
+        return None
+    if op.group_ids is None:
+        raise ValueError("group_ids is required")
+    return list(dict.fromkeys(op.group_ids))
+
+def _group_ids(payload):
+    if isinstance(payload, list):
+        return payload
+    return getattr(payload, "group_ids", None) or []
+
+async def _apply(db, items):
+    """Применяет операции массовыми запросами; возвращает id созданных контактов по порядку."""
+    creates = [payload for result, payload in items if result["op"] == "create"]
+    updates, phones, set_groups = {}, {}, {}
+    add_links, remove_links, delete_ids = set(), set(), set()
+    for result, payload in items:
+        op, contact_id = result["op"], result["id"]
+        if op == "update":
+            fields = payload.dict(exclude_unset=True, exclude={"phone_numbers", "group_ids"})
+            if "birthday" in fields:
+                # При UPDATE без ORM-объектов @validates не вызывается
+                fields["birthday_md"] = models.birthday_ordinal(fields["birthday"])
+            updates.setdefault(contact_id, {"id": contact_id}).update(fields)
+            if payload.phone_numbers is not None:
+                phones[contact_id] = payload.phone_numbers
+            if payload.group_ids is not None:
+                set_groups[contact_id] = list(dict.fromkeys(payload.group_ids))
+        elif op == "set_groups":
+            set_groups[contact_id] = payload
+        elif op == "add_groups":
+            add_links.update((contact_id, group_id) for group_id in payload)
+        elif op == "remove_groups":
+            remove_links.update((contact_id, group_id) for group_id in payload)
+        elif op == "delete":
+            delete_ids.add(contact_id)
+
+    created = await crud.insert_contacts(db, creates) if creates else []
+
+    # UPDATE по первичному ключу: подряд идущие строки с одинаковым набором
+    # полей отправляются одним executemany, поэтому строки группируются
+    rows = sorted((row for row in updates.values() if len(row) > 1), key=lambda row: sorted(row))
+    if rows:
+        await db.execute(update(models.Contact), rows)
+    if phones:
+        await db.execute(delete(models.PhoneNumber).where(models.PhoneNumber.contact_id.in_(list(phones))))
+        rows = [row for contact_id, numbers in phones.items() for row in crud.phone_rows(contact_id, numbers)]
+        if rows:
+            await db.execute(insert(models.PhoneNumber), [dict(zip(crud.PHONE_COLUMNS, row)) for row in rows])
+
+    links = models.contact_group.c
+    if set_groups:
+        await db.execute(delete(models.contact_group).where(links.contact_id.in_(list(set_groups))))
+        add_links.update((contact_id, group_id) for contact_id, group_ids in set_groups.items() for group_id in group_ids)
+    if add_links:
+        await db.execute(
+            pg_insert(models.contact_group).on_conflict_do_nothing(),
+            [dict(zip(crud.LINK_COLUMNS, link)) for link in sorted(add_links)],
+        )
+    if remove_links:
+        await db.execute(
+            delete(models.contact_group)
+            .where(tuple_(links.contact_id, links.group_id).in_(sorted(remove_links)))
+        )
+
+    if delete_ids:
+        delete_ids = sorted(delete_ids)
+        urls = await crud.contact_media_urls(db, delete_ids)
+        await db.execute(
+            delete(models.Contact).where(models.Contact.id.in_(delete_ids))
+            .execution_options(synchronize_session=False)
+        )
+        await schedule_url_deletion(db, urls)
+    return created
+
+def _succeed(result, created_ids):
+    if result["op"] == "create":
+        result["id"], result["status"] = created_ids.pop(0), 201
+    else:
+        result["status"] = 200
+
+def _fail(result, status: int, error: str):
+    result["status"], result["error"] = status, error
+
+async def apply_contact_batch(db, current_user: models.User, operations, atomic: bool = False):
+    """
+    Применяет операции (schemas.ContactBatchOperation) от имени current_user.
+    Возвращает словарь схемы ContactBatchResult; commit выполняется здесь.
+    """
+    stats["batches"] += 1
+    stats["operations"] += len(operations)
+    results = [
+        {"index": i, "op": op.op, "id": None if op.op == "create" else op.id, "status": None, "error": None}
+        for i, op in enumerate(operations)
+    ]
+
+    parsed = []
+    for result, op in zip(results, operations):
+        try:
+            parsed.append((result, _parse(op, current_user)))
+        except ValidationError as e:
+            _fail(result, 400, validation_error_message(e))
+        except ValueError as e:
+            _fail(result, 400, str(e))
+
+    # Один запрос на владельцев всех затронутых контактов и один на группы
+    contact_ids = sorted({result["id"] for result, _ in parsed if result["op"] != "create"})
+    owners = {}
+    if contact_ids:
+        owners = dict((await db.execute(
+            select(models.Contact.id, models.Contact.user_id)
+            .where(models.Contact.id.in_(contact_ids))
+            .order_by(models.Contact.id)
+            .with_for_update()
+        )).all())
+    group_ids = sorted({group_id for _, payload in parsed for group_id in _group_ids(payload)})
+    known_groups = set()
+    if group_ids:
+        known_groups = set((await db.execute(
+            select(models.Group.id).where(models.Group.id.in_(group_ids))
+        )).scalars())
+
+    items = []
+    for result, payload in parsed:
+        if result["op"] != "create":
+            owner = owners.get(result["id"])
+            if owner is None:
+                _fail(result, 404, "Contact not found")
+                continue
+            if not check_contact_access(current_user, owner):
+                _fail(result, 403, "Not enough permissions to access this contact")
+                continue
+        missing = [group_id for group_id in _group_ids(payload) if group_id not in known_groups]
+        if missing:
+            _fail(result, 400, f"Group not found: {', '.join(map(str, missing))}")
+            continue
+        items.append((result, payload))
+
+    if items:
+        try:
+            async with db.begin_nested():
+                created = await _apply(db, items)
+            for result, _ in items:
+                _succeed(result, created)
+        except DBAPIError:
+            # Ошибка одной операции откатила весь массовый шаг — повторяем по одной
+            stats["fallbacks"] += 1
+            for result, payload in items:
+                try:
+                    async with db.begin_nested():
+                        created = await _apply(db, [(result, payload)])
+                    _succeed(result, created)
+                except DBAPIError as e:
+                    _fail(result, 400, crud.db_error_message(e))
+
+    failed = sum(1 for result in results if result["status"] >= 400)
+    stats["failed"] += failed
+    committed = not (atomic and failed)
+    if committed:
+        await db.commit()
+    else:
+        await db.rollback()
+        stats["rolled_back"] += 1
+        for result in results:
+            if result["status"] < 400:
+                if result["op"] == "create":
+                    result["id"] = None
+                _fail(result, 424, "Not applied: another operation in the batch failed")
+    return {
+        "results": results,
+        "succeeded": sum(1 for result in results if result["status"] < 400),
+        "failed": len(results) - sum(1 for result in results if result["status"] < 400),
+        "committed": committed,
+    }
+
+def contact_batch_stats():
+    return dict(stats)
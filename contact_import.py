@@ -0,0 +1,572 @@
+"""
+Массовый импорт контактов из CSV и vCard.
+
+Загрузка (POST /contacts/import) только сохраняет файл по частям во
+временный каталог (CONTACT_IMPORT_DIR), создаёт задачу в таблице
+contact_import_jobs и сразу возвращает её id. Дальше импорт выполняется в
+фоне:
+- файл разбирается потоково, пачками по CONTACT_IMPORT_BATCH_SIZE записей
+  (в отдельном потоке; весь файл в память не загружается);
+- каждая запись проверяется схемой schemas.ContactCreate в пуле процессов
+  (CONTACT_IMPORT_PROCESS_WORKERS), пока предыдущая пачка записывается в
+  БД; ошибки запоминаются с номером строки (для vCard — номером карточки);
+- корректные записи пачки вставляются через COPY (на PostgreSQL; иначе —
+  тремя INSERT на пачку), а не по одному контакту на запрос. Если вставка
+  пачки не удалась, её записи вставляются по одной, чтобы ошибка досталась
+  только виноватой строке;
+- пачка фиксируется вместе с прогрессом задачи, поэтому прерванный импорт
+  продолжается после перезапуска с первой незафиксированной записи
+  (recover_import_jobs).
+
+Задачу ведёт один процесс: run_import_job забирает её условным UPDATE
+(claimed_by), владелец обновляет updated_at, пока задача ждёт очереди или
+выполняется, и проверяет владение при записи каждой пачки. Другой процесс
+может забрать задачу, только если updated_at старше
+CONTACT_IMPORT_STALE_SECONDS.
+
+CSV: первая строка — заголовок. Колонки first_name, last_name, email,
+birthday, extra_info (или note), phone_numbers (или phone, phones) — номера
+через ";", с необязательной меткой "mobile:+380...", group_ids — id групп
+через ";". vCard 2.1/3.0/4.0: N/FN, EMAIL, TEL (TYPE — метка), BDAY, NOTE.
+"""
+import asyncio
+import csv
+import io
+import itertools
+import logging
+import os
+import quopri
+import re
+import socket
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import asyncpg
+from fastapi import HTTPException, UploadFile
+from pydantic import ValidationError
+from sqlalchemy import select, update, func, or_, and_
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+import crud
+import models
+from crud import CONTACT_COLUMNS, PHONE_COLUMNS, LINK_COLUMNS, contact_insert_row, contact_related_rows
+from database import AsyncSessionLocal
+from schemas import ContactCreate, validation_error_message
+
+logger = logging.getLogger(__name__)
+
+CONTACT_IMPORT_DIR = os.getenv("CONTACT_IMPORT_DIR", os.path.join(tempfile.gettempdir(), "contact_imports"))
+CONTACT_IMPORT_BATCH_SIZE = int(os.getenv("CONTACT_IMPORT_BATCH_SIZE", "500"))
+CONTACT_IMPORT_MAX_BYTES = int(os.getenv("CONTACT_IMPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+# Сколько ошибок по строкам хранится в отчёте задачи
+CONTACT_IMPORT_MAX_ERRORS = int(os.getenv("CONTACT_IMPORT_MAX_ERRORS", "10000"))
+# Процессы для проверки записей схемой (CPU-нагрузка не блокирует event loop)
+CONTACT_IMPORT_PROCESS_WORKERS = int(os.getenv("CONTACT_IMPORT_PROCESS_WORKERS", "1"))
+# Сколько задач выполняется одновременно в одном процессе
+CONTACT_IMPORT_CONCURRENCY = int(os.getenv("CONTACT_IMPORT_CONCURRENCY", "2"))
+# Задача без прогресса дольше этого времени считается прерванной
+CONTACT_IMPORT_STALE_SECONDS = int(os.getenv("CONTACT_IMPORT_STALE_SECONDS", "60"))
+# Как часто владелец отмечает, что задача жива
+CONTACT_IMPORT_HEARTBEAT_SECONDS = max(1, CONTACT_IMPORT_STALE_SECONDS // 3)
+# Хост, на котором лежат файлы CONTACT_IMPORT_DIR, и id этого процесса
+IMPORT_HOST = os.getenv("CONTACT_IMPORT_HOST") or socket.gethostname()
+IMPORT_WORKER_ID = f"{IMPORT_HOST}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+CONTACT_IMPORT_CHUNK_SIZE = 256 * 1024
+
+IMPORT_QUEUED = "queued"
+IMPORT_RUNNING = "running"
+IMPORT_DONE = "done"
+IMPORT_FAILED = "failed"
+
+FORMATS = ("csv", "vcard")
+
+_semaphore: asyncio.Semaphore = None
+_tasks = set()
+# Задачи, которые уже ждут или выполняются в этом процессе
+_active = set()
+
+# ---------------------------------------------------------------------------
+# Разбор файлов. Генераторы возвращают (номер записи, поля контакта); поля
+# проверяются позже схемой ContactCreate.
+
+CSV_COLUMNS = {
+    "first_name": "first_name", "firstname": "first_name", "given_name": "first_name", "name": "first_name",
+    "last_name": "last_name", "lastname": "last_name", "family_name": "last_name", "surname": "last_name",
+    "email": "email", "e_mail": "email",
+    "birthday": "birthday", "birth_date": "birthday", "date_of_birth": "birthday",
+    "extra_info": "extra_info", "note": "extra_info", "notes": "extra_info",
+    "phone_numbers": "phone_numbers", "phone_number": "phone_numbers", "phones": "phone_numbers", "phone": "phone_numbers",
+    "group_ids": "group_ids", "groups": "group_ids",
+}
+
+def _csv_column(header: str):
+    key = re.sub(r"[\s\-]+", "_", (header or "").strip().lower())
+    return CSV_COLUMNS.get(key)
+
+def _split_list(value: str):
+    return [item.strip() for item in (value or "").split(";") if item.strip()]
+
+def _phone(item: str):
+    label, _, number = item.rpartition(":")
+    return {"number": number.strip(), "label": label.strip() or None}
+
+def parse_csv(text):
+    reader = csv.reader(text)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [_csv_column(h) for h in header]
+    for row_number, values in enumerate(reader, start=2):
+        if not any(value.strip() for value in values):
+            continue
+        row = {}
+        for column, value in zip(columns, values):
+            if column and value.strip():
+                row[column] = value.strip()
+        contact = {k: v for k, v in row.items() if k not in ("phone_numbers", "group_ids")}
+        contact["phone_numbers"] = [_phone(item) for item in _split_list(row.get("phone_numbers"))]
+        if row.get("group_ids"):
+            contact["group_ids"] = _split_list(row["group_ids"])
+        yield row_number, contact
+
+def _vcard_lines(text):
+    """Строки vCard с учётом переноса (строка, начинающаяся с пробела, — продолжение)."""
+    current = None
+    for line in text:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None and current.endswith("=") and "QUOTED-PRINTABLE" in current.upper():
+            # Мягкий перенос quoted-printable (vCard 2.1)
+            current = current[:-1] + line
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+def _vcard_unescape(value: str):
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+
+def _vcard_birthday(value: str):
+    value = value.split("T")[0]
+    if re.fullmatch(r"\d{8}", value):
+        return f"{value[:4]}-{value[4:6]}-{value[6:]}"
+    return value
+
+def _vcard_contact(properties):
+    contact = {"phone_numbers": []}
+    for name, params, value in properties:
+        if name == "N":
+            parts = [_vcard_unescape(p) for p in re.split(r"(?<!\\);", value)] + ["", ""]
+            if parts[1].strip():
+                contact["first_name"] = parts[1].strip()
+            if parts[0].strip():
+                contact["last_name"] = parts[0].strip()
+        elif name == "FN" and value.strip():
+            contact.setdefault("full_name", _vcard_unescape(value).strip())
+        elif name == "EMAIL" and "email" not in contact:
+            contact["email"] = value.strip()
+        elif name == "TEL":
+            number = value.strip()
+            if number.lower().startswith("tel:"):
+                number = number[4:]
+            types = [t for t in params.get("TYPE", []) if t.lower() not in ("pref", "voice")]
+            contact["phone_numbers"].append({"number": number, "label": types[0].lower() if types else None})
+        elif name == "BDAY":
+            contact["birthday"] = _vcard_birthday(value.strip())
+        elif name == "NOTE":
+            contact["extra_info"] = _vcard_unescape(value)
+    full_name = contact.pop("full_name", None)
+    if "first_name" not in contact and full_name:
+        contact["first_name"] = full_name
+    return contact
+
+def _vcard_property(line: str):
+    head, _, value = line.partition(":")
+    name, *raw_params = head.split(";")
+    name = name.split(".")[-1].upper()  # item1.TEL -> TEL
+    params = {}
+    for param in raw_params:
+        key, sep, val = param.partition("=")
+        if not sep:
+            # vCard 2.1: TEL;CELL:...
+            key, val = "TYPE", key
+        params.setdefault(key.upper(), []).extend(v.strip('"') for v in val.split(","))
+    if "QUOTED-PRINTABLE" in (v.upper() for v in params.get("ENCODING", [])):
+        value = quopri.decodestring(value.encode()).decode("utf-8", errors="replace")
+    return name, params, value
+
+def parse_vcard(text):
+    card_number, properties = 0, None
+    for line in _vcard_lines(text):
+        upper = line.strip().upper()
+        if upper == "BEGIN:VCARD":
+            card_number += 1
+            properties = []
+        elif upper == "END:VCARD":
+            if properties is not None:
+                yield card_number, _vcard_contact(properties)
+            properties = None
+        elif properties is not None and ":" in line:
+            properties.append(_vcard_property(line))
+
+PARSERS = {"csv": parse_csv, "vcard": parse_vcard}
+
+def detect_format(filename: str, content_type: str):
+    name = (filename or "").lower()
+    if name.endswith((".vcf", ".vcard")) or "vcard" in (content_type or ""):
+        return "vcard"
+    return "csv"
+
+# ---------------------------------------------------------------------------
+# Проверка и запись
+
+def _validate(user_id: int, data: dict, group_ids: set):
+    """ContactCreate для записи или текст ошибки."""
+    try:
+        contact = ContactCreate(user_id=user_id, **data)
+    except ValidationError as e:
+        return validation_error_message(e)
+    unknown = set(contact.group_ids or []) - group_ids
+    if unknown:
+        return f"group_ids: unknown groups {sorted(unknown)}"
+    return contact
+
+def validate_batch(user_id: int, batch, group_ids: set):
+    """
+    Проверяет пачку записей (выполняется в пуле процессов).
+    Возвращает ([(номер, ContactCreate)], ошибки).
+    """
+    valid, errors = [], []
+    for row_number, data in batch:
+        result = _validate(user_id, data, group_ids)
+        if isinstance(result, str):
+            errors.append({"row": row_number, "error": result})
+        else:
+            valid.append((row_number, result))
+    return valid, errors
+
+def _read_records(records, raw):
+    batch = list(itertools.islice(records, CONTACT_IMPORT_BATCH_SIZE))
+    return batch, raw.tell()
+
+_executor = None
+
+async def _run_in_pool(func, *args):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=CONTACT_IMPORT_PROCESS_WORKERS)
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+async def _copy_contacts(db, contacts):
+    """
+    То же через COPY (PostgreSQL + asyncpg): id заранее берутся из
+    последовательности, после чего три таблицы заполняются COPY в текущей
+    транзакции.
+    """
+    conn = (await (await db.connection()).get_raw_connection()).driver_connection
+    contact_ids = [row[0] for row in await conn.fetch(
+        "SELECT nextval(pg_get_serial_sequence('contacts', 'id')) FROM generate_series(1, $1)", len(contacts)
+    )]
+    await conn.copy_records_to_table("contacts", columns=CONTACT_COLUMNS, records=[
+        (contact_id, *contact_insert_row(c).values()) for contact_id, c in zip(contact_ids, contacts)
+    ])
+    phones, links = contact_related_rows(contact_ids, contacts)
+    if phones:
+        await conn.copy_records_to_table("phone_numbers", columns=PHONE_COLUMNS, records=phones)
+    if links:
+        await conn.copy_records_to_table("contact_group", columns=LINK_COLUMNS, records=links)
+
+async def _write_batch(db, rows):
+    """
+    Записывает проверенные записи [(номер, ContactCreate)] пачкой (COPY на
+    PostgreSQL); если пачка не вставилась — по одной. Возвращает (число
+    вставленных, ошибки).
+    """
+    if not rows:
+        return 0, []
+    bulk_insert = _copy_contacts if db.get_bind().dialect.driver == "asyncpg" else crud.insert_contacts
+    try:
+        async with db.begin_nested():
+            await bulk_insert(db, [contact for _, contact in rows])
+        return len(rows), []
+    except (IntegrityError, DBAPIError, asyncpg.PostgresError):
+        pass
+    imported, errors = 0, []
+    for row_number, contact in rows:
+        try:
+            async with db.begin_nested():
+                await crud.insert_contacts(db, [contact])
+            imported += 1
+        except (IntegrityError, DBAPIError) as e:
+            errors.append({"row": row_number, "error": crud.db_error_message(e)})
+    return imported, errors
+
+# ---------------------------------------------------------------------------
+# Задачи
+
+def _job_path(job_id: int):
+    return os.path.join(CONTACT_IMPORT_DIR, str(job_id))
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def create_import_job(db, file: UploadFile, user_id: int, created_by: int, file_format: str = None):
+    """
+    Сохраняет загруженный файл и ставит задачу импорта. Возвращает задачу.
+    Файл больше CONTACT_IMPORT_MAX_BYTES — 413.
+    """
+    file_format = file_format or detect_format(file.filename, file.content_type)
+    if file_format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {file_format}")
+    os.makedirs(CONTACT_IMPORT_DIR, exist_ok=True)
+    job = models.ContactImportJob(
+        user_id=user_id, created_by=created_by, format=file_format, filename=file.filename, status=IMPORT_QUEUED,
+        file_host=IMPORT_HOST, claimed_by=IMPORT_WORKER_ID,
+    )
+    db.add(job)
+    await db.flush()
+    path = _job_path(job.id)
+    size = 0
+    try:
+        with open(path, "wb") as out:
+            while chunk := await file.read(CONTACT_IMPORT_CHUNK_SIZE):
+                size += len(chunk)
+                if size > CONTACT_IMPORT_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="File is too large")
+                await asyncio.to_thread(out.write, chunk)
+        job.total_bytes = size
+        await db.commit()
+    except BaseException:
+        _remove(path)
+        raise
+    _start(job.id)
+    return job
+
+def _start(job_id: int):
+    global _semaphore
+    if job_id in _active:
+        return
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(CONTACT_IMPORT_CONCURRENCY)
+    _active.add(job_id)
+    task = asyncio.create_task(_run_guarded(job_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    task.add_done_callback(lambda _: _active.discard(job_id))
+
+async def _run_guarded(job_id: int):
+    # Пока задача ждёт семафора, она тоже должна выглядеть живой для других процессов
+    heartbeat = asyncio.create_task(_heartbeat(job_id))
+    try:
+        async with _semaphore:
+            try:
+                await run_import_job(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Импорт контактов {job_id} прерван ошибкой: {e}")
+                async with AsyncSessionLocal() as db:
+                    failed = (await db.execute(
+                        update(models.ContactImportJob)
+                        .where(models.ContactImportJob.id == job_id,
+                               models.ContactImportJob.claimed_by == IMPORT_WORKER_ID)
+                        .values(status=IMPORT_FAILED, error=str(e)[:1000], finished_at=datetime.utcnow())
+                        .returning(models.ContactImportJob.id)
+                    )).first()
+                    await db.commit()
+                if failed:
+                    _remove(_job_path(job_id))
+    finally:
+        heartbeat.cancel()
+
+async def _heartbeat(job_id: int):
+    """Обновляет updated_at задачи, пока ею владеет этот процесс."""
+    while True:
+        await asyncio.sleep(CONTACT_IMPORT_HEARTBEAT_SECONDS)
+        try:
+            await _touch_job(job_id)
+        except Exception as e:
+            logger.warning(f"Импорт контактов {job_id}: не удалось обновить отметку владельца: {e}")
+
+async def _touch_job(job_id: int, db=None):
+    """
+    Отмечает, что задача жива. В транзакции db заодно блокирует строку задачи
+    до commit, поэтому другой процесс не заберёт её посреди записи пачки.
+    Возвращает False, если задачей владеет уже другой процесс.
+    """
+    statement = (
+        update(models.ContactImportJob)
+        .where(models.ContactImportJob.id == job_id,
+               models.ContactImportJob.claimed_by == IMPORT_WORKER_ID,
+               models.ContactImportJob.status.in_((IMPORT_QUEUED, IMPORT_RUNNING)))
+        .values(updated_at=datetime.utcnow())
+        .returning(models.ContactImportJob.id)
+        .execution_options(synchronize_session=False)
+    )
+    if db is not None:
+        return (await db.execute(statement)).first() is not None
+    async with AsyncSessionLocal() as db:
+        touched = (await db.execute(statement)).first() is not None
+        await db.commit()
+    return touched
+
+def _is_stale():
+    """Условие для задачи, владелец которой давно не отмечался."""
+    stale_before = datetime.utcnow() - timedelta(seconds=CONTACT_IMPORT_STALE_SECONDS)
+    return and_(
+        models.ContactImportJob.status.in_((IMPORT_QUEUED, IMPORT_RUNNING)),
+        or_(models.ContactImportJob.updated_at.is_(None), models.ContactImportJob.updated_at < stale_before),
+    )
+
+async def _claim_job(db, job_id: int):
+    """
+    Атомарно забирает задачу этим процессом: свою задачу или задачу, владелец
+    которой давно не отмечался. Возвращает False, если её ведёт другой процесс
+    или она уже завершена.
+    """
+    now = datetime.utcnow()
+    job = models.ContactImportJob
+    claimed = (await db.execute(
+        update(job)
+        .where(job.id == job_id, or_(
+            and_(job.claimed_by == IMPORT_WORKER_ID, job.status.in_((IMPORT_QUEUED, IMPORT_RUNNING))),
+            _is_stale(),
+        ))
+        .values(status=IMPORT_RUNNING, claimed_by=IMPORT_WORKER_ID, updated_at=now,
+                started_at=func.coalesce(job.started_at, now))
+        .returning(job.id)
+        .execution_options(synchronize_session=False)
+    )).first()
+    await db.commit()
+    return claimed is not None
+
+async def run_import_job(job_id: int):
+    async with AsyncSessionLocal() as db:
+        if not await _claim_job(db, job_id):
+            logger.info(f"Импорт контактов {job_id} ведёт другой процесс или он уже завершён")
+            return
+        job = await db.get(models.ContactImportJob, job_id)
+        group_ids = set((await db.execute(select(models.Group.id))).scalars().all())
+
+        raw = open(_job_path(job_id), "rb")
+        text = io.TextIOWrapper(raw, encoding="utf-8-sig", errors="replace", newline="")
+        records = PARSERS[job.format](text)
+
+        async def next_batch():
+            batch, bytes_read = await asyncio.to_thread(_read_records, records, raw)
+            if not batch:
+                return 0, [], [], bytes_read
+            valid, errors = await _run_in_pool(validate_batch, job.user_id, batch, group_ids)
+            return len(batch), valid, errors, bytes_read
+
+        pending = None
+        lost = False
+        try:
+            # Записи, зафиксированные до перезапуска, пропускаются
+            await asyncio.to_thread(lambda: list(itertools.islice(records, job.rows_processed)))
+            pending = asyncio.ensure_future(next_batch())
+            while True:
+                count, valid, errors, bytes_read = await pending
+                if not count:
+                    break
+                # Следующая пачка читается и проверяется, пока пишется текущая
+                pending = asyncio.ensure_future(next_batch())
+                if not await _touch_job(job_id, db):
+                    # Задачу перехватил другой процесс (эта долго не отмечалась) — продолжит он
+                    lost = True
+                    await db.rollback()
+                    break
+                imported, write_errors = await _write_batch(db, valid)
+                errors = sorted(errors + write_errors, key=lambda e: e["row"])
+
+                job.rows_processed += count
+                job.imported += imported
+                job.failed += len(errors)
+                job.bytes_read = bytes_read
+                room = CONTACT_IMPORT_MAX_ERRORS - len(job.errors or [])
+                if errors and room > 0:
+                    job.errors = (job.errors or []) + errors[:room]
+                job.updated_at = datetime.utcnow()
+                await db.commit()
+        finally:
+            if pending is not None and not pending.done():
+                # Следующая пачка ещё читается — дожидаемся её перед закрытием файла
+                await asyncio.wait([pending])
+            raw.close()
+        if lost or not await _touch_job(job_id, db):
+            logger.warning(f"Импорт контактов {job_id} перехвачен другим процессом")
+            return
+
+        job.status = IMPORT_DONE
+        job.bytes_read = job.total_bytes
+        job.finished_at = datetime.utcnow()
+        await db.commit()
+    _remove(_job_path(job_id))
+    logger.info(f"Импорт контактов {job_id}: {job.imported} импортировано, {job.failed} с ошибками")
+
+async def recover_import_jobs():
+    """
+    Продолжает задачи, прерванные перезапуском. Ждёт
+    CONTACT_IMPORT_STALE_SECONDS и берёт только задачи, владелец которых с
+    тех пор не отмечался; саму задачу забирает run_import_job, поэтому при
+    нескольких процессах её продолжит только один.
+
+    Задача без файла завершается ошибкой, только если файл должен лежать на
+    этом хосте; задачи с файлом на другом хосте оставляются его процессам.
+    """
+    await asyncio.sleep(CONTACT_IMPORT_STALE_SECONDS)
+    try:
+        async with AsyncSessionLocal() as db:
+            jobs = (await db.execute(
+                select(models.ContactImportJob.id, models.ContactImportJob.file_host).where(_is_stale())
+            )).all()
+    except Exception as e:
+        logger.error(f"Не удалось восстановить задачи импорта контактов: {e}")
+        return
+    for job_id, file_host in jobs:
+        if os.path.exists(_job_path(job_id)):
+            _start(job_id)
+        elif file_host in (None, IMPORT_HOST):
+            async with AsyncSessionLocal() as db:
+                # Условие повторяется: пока шла проверка, задачу мог забрать живой процесс
+                await db.execute(
+                    update(models.ContactImportJob).where(models.ContactImportJob.id == job_id, _is_stale())
+                    .values(status=IMPORT_FAILED, error="Import file is missing", finished_at=datetime.utcnow())
+                )
+                await db.commit()
+
+def job_status(job: models.ContactImportJob, errors_limit: int = 50):
+    return {
+        "id": job.id,
+        "user_id": job.user_id,
+        "format": job.format,
+        "filename": job.filename,
+        "status": job.status,
+        "progress": round(job.bytes_read / job.total_bytes, 3) if job.total_bytes else 0,
+        "rows_processed": job.rows_processed,
+        "imported": job.imported,
+        "failed": job.failed,
+        "errors": (job.errors or [])[:errors_limit],
+        "errors_truncated": job.failed > min(len(job.errors or []), errors_limit),
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+def errors_csv(job: models.ContactImportJob):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["row", "error"])
+    for error in job.errors or []:
+        writer.writerow([error["row"], error["error"]])
+    return out.getvalue()
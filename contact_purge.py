@@ -0,0 +1,79 @@
+"""
+Фоновое удаление больших объёмов контактов (очистка через /db/clear).
+
+Контакты удаляются пачками по CONTACT_PURGE_CHUNK_SIZE, каждая пачка — в
+своей короткой транзакции (crud.delete_contacts_chunk): блокировки строк
+держатся миллисекунды, а не всё время удаления сотен тысяч контактов, и в
+памяти находится только список id одной пачки. Строки, которые в этот
+момент редактируются, пропускаются (SKIP LOCKED); когда пачки без них
+заканчиваются, оставшиеся контакты удаляются с ожиданием блокировок. Дочерние строки удаляет БД
+(ON DELETE CASCADE), изображения ставятся в очередь media_cleanup.
+Между пачками — пауза CONTACT_PURGE_PAUSE, чтобы не забирать всю
+пропускную способность БД у обычных запросов.
+
+Если процесс остановился посреди очистки, уже удалённые пачки не
+возвращаются, а оставшиеся контакты удаляются повторным вызовом /db/clear.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import crud
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+CONTACT_PURGE_CHUNK_SIZE = int(os.getenv("CONTACT_PURGE_CHUNK_SIZE", "2000"))
+CONTACT_PURGE_PAUSE = float(os.getenv("CONTACT_PURGE_PAUSE", "0.05"))
+
+# Идущие очистки: user_id (None — контакты всех пользователей) -> задача
+_running = {}
+
+stats = {"purges": 0, "chunks": 0, "deleted": 0, "failed": 0}
+
+async def purge_contacts(user_id=None):
+    """Удаляет все контакты пользователя user_id (None — всех) пачками."""
+    started, deleted, skip_locked = time.monotonic(), 0, True
+    while True:
+        async with AsyncSessionLocal() as db:
+            count = await crud.delete_contacts_chunk(
+                db, user_id, limit=CONTACT_PURGE_CHUNK_SIZE, skip_locked=skip_locked
+            )
+        stats["chunks"] += 1
+        stats["deleted"] += count
+        deleted += count
+        if count == 0:
+            # Короткая пачка может означать пропущенные заблокированные строки,
+            # поэтому конец — только пустая пачка. Пропущенные строки
+            # дочищаются пачками, которые ждут снятия блокировок.
+            if not skip_locked:
+                break
+            skip_locked = False
+            continue
+        await asyncio.sleep(CONTACT_PURGE_PAUSE)
+    logger.info(f"Очистка контактов (user_id={user_id}): удалено {deleted} за {time.monotonic() - started:.1f} с")
+    return deleted
+
+def _finished(user_id, task: asyncio.Task):
+    _running.pop(user_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        stats["failed"] += 1
+        logger.error(f"Ошибка фоновой очистки контактов (user_id={user_id}): {task.exception()}")
+
+def start_contact_purge(user_id=None):
+    """Запускает фоновую очистку; False, если такая очистка уже идёт."""
+    if user_id in _running or None in _running:
+        return False
+    stats["purges"] += 1
+    task = asyncio.create_task(purge_contacts(user_id))
+    _running[user_id] = task
+    task.add_done_callback(lambda t: _finished(user_id, t))
+    return True
+
+def contact_purge_stats():
+    return {
+        **stats,
+        "running": ["all" if user_id is None else user_id for user_id in _running],
+        "chunk_size": CONTACT_PURGE_CHUNK_SIZE,
+    }
@@ -1,8 +1,14 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import or_, and_, func, select, insert, delete, update, case, literal_column, tuple_
 from datetime import date, timedelta
+from typing import Optional
+import re
+import base64
+import json
 import models, schemas
-from sqlalchemy.exc import IntegrityError
+from media_cleanup import schedule_url_deletion
+from sqlalchemy.exc import IntegrityError, DBAPIError
 
 # USERS CRUD
 
@@ -12,6 +18,10 @@ def get_user_by_username(db: Session, username: str):
 def get_user_by_id(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
 
+async def get_user_by_username_async(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
 def update_user_role(db: Session, user_id: int, role: str):
     """Обновляет роль пользователя."""
     db_user = db.query(models.User).filter(models.User.id == user_id).first()
@@ -28,26 +38,113 @@ def update_user_role(db: Session, user_id: int, role: str):
     return db_user
 
 # CONTACTS CRUD
+# Контакты обслуживаются асинхронными обработчиками, поэтому функции ниже
+# работают с AsyncSession. Связи загружаются заранее через selectinload,
+# так как ленивая загрузка в асинхронной сессии невозможна.
 
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import selectinload
 
-def get_contact(db: Session, contact_id: int):
+def contact_load_options():
+    """Опции загрузки всех связей, нужных для сериализации schemas.Contact."""
     return (
-        db.query(models.Contact)
-        .options(
-            joinedload(models.Contact.phone_numbers),
-            joinedload(models.Contact.avatars),
-            joinedload(models.Contact.photos),
-            joinedload(models.Contact.groups),
-        )
-        .filter(models.Contact.id == contact_id)
-        .first()
+        selectinload(models.Contact.phone_numbers),
+        selectinload(models.Contact.avatars),
+        selectinload(models.Contact.photos),
+        selectinload(models.Contact.groups),
+    )
+
+# Область видимости (tenant scope). Права применяются в самом SQL-запросе,
+# до загрузки строк: обычный пользователь читает только свои контакты,
+# admin и superadmin — контакты всех пользователей.
+
+CONTACT_ADMIN_ROLES = ("superadmin", "admin")
+
+def contact_scope_filter(current_user: models.User, user_id: Optional[int] = None):
+    """Список условий WHERE, ограничивающих контакты правами current_user."""
+    filters = []
+    if current_user.role not in CONTACT_ADMIN_ROLES:
+        filters.append(models.Contact.user_id == current_user.id)
+    if user_id is not None:
+        # Явный user_id только сужает выборку и не расширяет права
+        filters.append(models.Contact.user_id == user_id)
+    return filters
+
+def scoped_contacts_query(current_user: models.User, user_id: Optional[int] = None):
+    """select(Contact) с опциями загрузки и ограничением по правам current_user."""
+    return (
+        select(models.Contact)
+        .options(*contact_load_options())
+        .where(*contact_scope_filter(current_user, user_id))
+    )
+
+async def get_contact(db: AsyncSession, contact_id: int, refresh: bool = False):
+    stmt = (
+        select(models.Contact)
+        .options(*contact_load_options())
+        .where(models.Contact.id == contact_id)
     )
+    if refresh:
+        # Перечитываем связи даже если объект уже есть в identity map
+        stmt = stmt.execution_options(populate_existing=True)
+    result = await db.execute(stmt)
+    return result.scalars().first()
+
+# Keyset-пагинация. Курсор — непрозрачная строка с ключом сортировки
+# (first_name) и id последнего контакта страницы; следующая страница
+# начинается строго после него, поэтому стоимость не зависит от глубины.
+
+def encode_contact_cursor(contact: models.Contact):
+    raw = json.dumps([contact.first_name, contact.id], ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_contact_cursor(cursor: str):
+    """Возвращает (first_name, id); ValueError при повреждённом курсоре."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        first_name, contact_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(first_name, str) or not isinstance(contact_id, int):
+        raise ValueError("Invalid cursor")
+    return first_name, contact_id
 
-def get_contacts(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Contact).filter(models.Contact.user_id == user_id).offset(skip).limit(limit).all()
+def contact_keyset_filter(cursor: str, sort: str = "asc"):
+    """Условие "после курсора" в порядке contact_name_order(sort)."""
+    first_name, contact_id = decode_contact_cursor(cursor)
+    key = tuple_(func.lower(models.Contact.first_name), models.Contact.id)
+    after = tuple_(func.lower(first_name), contact_id)
+    return key < after if sort == "desc" else key > after
 
-def create_contact(db: Session, user_id: int, contact: schemas.ContactCreate):
+async def get_contacts(db: AsyncSession, current_user: models.User, user_id: Optional[int] = None,
+                       search: Optional[str] = None, sort: str = "asc",
+                       skip: int = 0, limit: int = 100, cursor: Optional[str] = None):
+    stmt = scoped_contacts_query(current_user, user_id)
+    if search:
+        stmt = stmt.where(contact_search_filter(search, get_dialect_name(db)))
+    if cursor:
+        # В режиме курсора offset не нужен
+        stmt = stmt.where(contact_keyset_filter(cursor, sort))
+        skip = 0
+    result = await db.execute(
+        stmt.order_by(*contact_name_order(sort))
+        .offset(skip)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+async def get_contacts_page(db: AsyncSession, current_user: models.User, user_id: Optional[int] = None,
+                            search: Optional[str] = None, sort: str = "asc",
+                            limit: int = 100, cursor: Optional[str] = None):
+    """Страница контактов и курсор следующей (None, если страница последняя)."""
+    # Берём на одну строку больше, чтобы узнать, есть ли продолжение
+    contacts = await get_contacts(db, current_user, user_id=user_id, search=search, sort=sort,
+                                  limit=limit + 1, cursor=cursor)
+    if len(contacts) > limit:
+        contacts = contacts[:limit]
+        return contacts, encode_contact_cursor(contacts[-1])
+    return contacts, None
+
+async def create_contact(db: AsyncSession, user_id: int, contact: schemas.ContactCreate):
     db_contact = models.Contact(
         user_id=user_id,
         first_name=contact.first_name,
@@ -58,29 +155,28 @@ def create_contact(db: Session, user_id: int, contact: schemas.ContactCreate):
     )
     # Add groups
     if getattr(contact, 'group_ids', None):
-        groups = db.query(models.Group).filter(models.Group.id.in_(contact.group_ids)).all()
-        db_contact.groups = groups
+        groups = await db.execute(select(models.Group).where(models.Group.id.in_(contact.group_ids)))
+        db_contact.groups = list(groups.scalars().all())
     db.add(db_contact)
     try:
-        db.flush()  # get db_contact.id
+        await db.flush()  # get db_contact.id
     except IntegrityError as e:
-        db.rollback()
+        await db.rollback()
         raise ValueError(f"Email already exists: {contact.email}")
     # Add phone numbers
     for pn in getattr(contact, 'phone_numbers', []):
         db_pn = models.PhoneNumber(number=pn.number, label=pn.label, contact_id=db_contact.id)
         db.add(db_pn)
-    db.commit()
-    db.refresh(db_contact)
-    return db_contact
+    await db.commit()
+    return await get_contact(db, db_contact.id, refresh=True)
 
-def update_contact(db: Session, contact_id: int, contact: schemas.ContactUpdate):
-    db_contact = db.query(models.Contact).filter(models.Contact.id == contact_id).first()
+async def update_contact(db: AsyncSession, contact_id: int, contact: schemas.ContactUpdate):
+    db_contact = await get_contact(db, contact_id)
     if not db_contact:
         return None
     for field, value in contact.dict(exclude_unset=True).items():
         if field == "phone_numbers" and value is not None:
-            db.query(models.PhoneNumber).filter(models.PhoneNumber.contact_id == contact_id).delete()
+            await db.execute(delete(models.PhoneNumber).where(models.PhoneNumber.contact_id == contact_id))
             for pn in value:
                 # Исправление: поддержка dict и схемы
                 if isinstance(pn, dict):
@@ -88,71 +184,353 @@ def update_contact(db: Session, contact_id: int, contact: schemas.ContactUpdate)
                 db_pn = models.PhoneNumber(number=pn.number, label=pn.label, contact_id=contact_id)
                 db.add(db_pn)
         elif field == "group_ids" and value is not None:
-            groups = db.query(models.Group).filter(models.Group.id.in_(value)).all()
-            db_contact.groups = groups
+            groups = await db.execute(select(models.Group).where(models.Group.id.in_(value)))
+            db_contact.groups = list(groups.scalars().all())
         else:
             setattr(db_contact, field, value)
-    db.commit()
-    db.refresh(db_contact)
-    return db_contact
+    await db.commit()
+    return await get_contact(db, contact_id, refresh=True)
+
+def db_error_message(e: DBAPIError):
+    """Первая строка ошибки БД без имени класса драйвера."""
+    # asyncpg через SQLAlchemy: "<class '...ForeignKeyViolationError'>: текст"
+    return re.sub(r"^<class '[^']+'>: ", "", str(e.orig).splitlines()[0])
+
+# Массовая вставка контактов (импорт, пакетные операции): три запроса на
+# пачку — контакты, телефоны и связи с группами — вместо запросов на контакт.
+
+CONTACT_COLUMNS = ("id", "user_id", "first_name", "last_name", "email", "birthday", "birthday_md", "extra_info")
+PHONE_COLUMNS = ("contact_id", "number", "label")
+LINK_COLUMNS = ("contact_id", "group_id")
+
+# Вставка без ORM-объектов (и COPY) не применяет значения по умолчанию модели
+PHONE_LABEL_DEFAULT = models.PhoneNumber.__table__.c.label.default.arg
+
+def contact_insert_row(c: schemas.ContactCreate):
+    return {
+        "user_id": c.user_id,
+        "first_name": c.first_name,
+        "last_name": c.last_name,
+        "email": c.email,
+        "birthday": c.birthday,
+        # При вставке без ORM-объектов @validates не вызывается
+        "birthday_md": models.birthday_ordinal(c.birthday),
+        "extra_info": c.extra_info,
+    }
+
+def phone_rows(contact_id: int, phone_numbers):
+    return [
+        (contact_id, pn.number, pn.label if pn.label is not None else PHONE_LABEL_DEFAULT)
+        for pn in phone_numbers
+    ]
 
-def delete_contact(db: Session, contact_id: int):
-    db_contact = db.query(models.Contact).filter(models.Contact.id == contact_id).first()
+def contact_related_rows(contact_ids, contacts):
+    """Строки телефонов и связей с группами для вставленных контактов."""
+    phones = [row for contact_id, c in zip(contact_ids, contacts) for row in phone_rows(contact_id, c.phone_numbers)]
+    links = [
+        (contact_id, group_id)
+        for contact_id, c in zip(contact_ids, contacts) for group_id in set(c.group_ids or [])
+    ]
+    return phones, links
+
+async def insert_contacts(db: AsyncSession, contacts):
+    """Вставляет контакты (schemas.ContactCreate) тремя запросами; возвращает их id по порядку."""
+    contact_ids = (await db.execute(
+        insert(models.Contact).returning(models.Contact.id, sort_by_parameter_order=True),
+        [contact_insert_row(c) for c in contacts],
+    )).scalars().all()
+    phones, links = contact_related_rows(contact_ids, contacts)
+    if phones:
+        await db.execute(insert(models.PhoneNumber), [dict(zip(PHONE_COLUMNS, row)) for row in phones])
+    if links:
+        await db.execute(insert(models.contact_group), [dict(zip(LINK_COLUMNS, row)) for row in links])
+    return contact_ids
+
+# Удаление контактов. Телефоны, аватары, фото и членство в группах удаляет
+# сама БД (ON DELETE CASCADE), поэтому контакт удаляется одним DELETE без
+# загрузки дочерних строк. Изображения удаляются из Cloudinary в фоне
+# (media_cleanup) — в той же транзакции они только ставятся в очередь.
+
+async def count_contacts(db: AsyncSession, user_id: Optional[int] = None):
+    """Число контактов пользователя user_id (None — всех)."""
+    stmt = select(func.count()).select_from(models.Contact)
+    if user_id is not None:
+        stmt = stmt.where(models.Contact.user_id == user_id)
+    return await db.scalar(stmt)
+
+async def contact_media_urls(db: AsyncSession, contact_ids):
+    """URL аватаров и фото контактов (до удаления строк)."""
+    urls = []
+    for model in (models.Avatar, models.Photo):
+        result = await db.execute(select(model.file_path).where(model.contact_id.in_(contact_ids)))
+        urls.extend(result.scalars())
+    return urls
+
+async def delete_contact(db: AsyncSession, contact_id: int):
+    db_contact = await get_contact(db, contact_id)
     if not db_contact:
         return None
-    db.delete(db_contact)
-    db.commit()
+    urls = [media.file_path for media in (*db_contact.avatars, *db_contact.photos)]
+    await db.execute(
+        delete(models.Contact).where(models.Contact.id == contact_id)
+        .execution_options(synchronize_session=False)
+    )
+    await schedule_url_deletion(db, urls)
+    await db.commit()
     return db_contact
 
-def search_contacts(db: Session, query: str):
-    query = f"%{query}%"
-    return db.query(models.Contact).filter(
-        or_(models.Contact.first_name.ilike(query),
-            models.Contact.last_name.ilike(query),
-            models.Contact.email.ilike(query))
-    ).all()
+async def delete_contacts(db: AsyncSession, current_user: models.User, contact_ids):
+    """
+    Удаляет контакты из списка, доступные current_user, одним DELETE.
+    Возвращает id удалённых; недоступные и несуществующие id пропускаются.
+    """
+    contact_ids = sorted(set(contact_ids))
+    scope = contact_scope_filter(current_user)
+    allowed = select(models.Contact.id).where(models.Contact.id.in_(contact_ids), *scope)
+    urls = await contact_media_urls(db, allowed)
+    result = await db.execute(
+        delete(models.Contact).where(models.Contact.id.in_(contact_ids), *scope)
+        .returning(models.Contact.id)
+        .execution_options(synchronize_session=False)
+    )
+    deleted = sorted(result.scalars().all())
+    await schedule_url_deletion(db, urls)
+    await db.commit()
+    return deleted
 
-def contacts_with_upcoming_birthdays(db: Session):
+async def delete_contacts_chunk(db: AsyncSession, user_id: Optional[int] = None, limit: int = 1000,
+                                skip_locked: bool = True):
+    """
+    Удаляет до limit контактов пользователя user_id (None — всех) в отдельной
+    короткой транзакции; возвращает число удалённых. При skip_locked строки,
+    заблокированные другими транзакциями, пропускаются (SKIP LOCKED), поэтому
+    пачка меньше limit не означает, что контактов не осталось; без него
+    запрос ждёт снятия блокировок.
+    """
+    stmt = select(models.Contact.id).order_by(models.Contact.id).limit(limit).with_for_update(skip_locked=skip_locked)
+    if user_id is not None:
+        stmt = stmt.where(models.Contact.user_id == user_id)
+    contact_ids = (await db.execute(stmt)).scalars().all()
+    if not contact_ids:
+        await db.commit()
+        return 0
+    urls = await contact_media_urls(db, contact_ids)
+    await db.execute(
+        delete(models.Contact).where(models.Contact.id.in_(contact_ids))
+        .execution_options(synchronize_session=False)
+    )
+    await schedule_url_deletion(db, urls)
+    await db.commit()
+    return len(contact_ids)
+
+# Поиск контактов. На PostgreSQL используется поддерживаемый самой БД
+# tsvector (Contact.search_vector, GIN) с префиксным поиском, trigram-индекс
+# (pg_trgm) для поиска подстроки и trigram-индекс по цифрам телефонов.
+# На других СУБД остаётся простой ILIKE.
+
+def get_dialect_name(db: AsyncSession):
+    return db.get_bind().dialect.name
+
+def _escape_like(value: str):
+    return value.replace("/", "//").replace("%", "/%").replace("_", "/_")
+
+def _search_tsquery(search: str):
+    """Префиксный tsquery: каждое слово запроса должно быть началом слова документа."""
+    tokens = re.findall(r"\w+", search.lower())
+    if not tokens:
+        return None
+    return func.to_tsquery(models.SEARCH_CONFIG, " & ".join(f"{token}:*" for token in tokens))
+
+def contact_search_filter(search: str, dialect_name: str = "postgresql"):
+    """Условие поиска по имени, фамилии, email (и телефону на PostgreSQL)."""
+    if dialect_name != "postgresql":
+        search_pattern = f"%{search}%"
+        return or_(models.Contact.first_name.ilike(search_pattern),
+                   models.Contact.last_name.ilike(search_pattern),
+                   models.Contact.email.ilike(search_pattern))
+
+    document = literal_column(f"({models.contact_search_document_sql('contacts')})")
+    conditions = [document.ilike(f"%{_escape_like(search)}%", escape="/")]
+    tsquery = _search_tsquery(search)
+    if tsquery is not None:
+        conditions.append(models.Contact.search_vector.op("@@")(tsquery))
+    # Телефон ищем по цифрам, чтобы "+38 (050) 123" находил "380501234567"
+    digits = re.sub(r"\D", "", search)
+    if len(digits) >= 3:
+        phone_digits = literal_column(f"({models.phone_digits_sql('phone_numbers')})")
+        conditions.append(models.Contact.id.in_(
+            select(models.PhoneNumber.contact_id).where(phone_digits.like(f"%{digits}%"))
+        ))
+    return or_(*conditions)
+
+def contact_search_rank(search: str):
+    """Релевантность для PostgreSQL: полнотекстовый ранг плюс trigram-сходство."""
+    document = literal_column(f"({models.contact_search_document_sql('contacts')})")
+    rank = func.similarity(document, search)
+    tsquery = _search_tsquery(search)
+    if tsquery is not None:
+        rank = rank + func.ts_rank(models.Contact.search_vector, tsquery)
+    return rank
+
+def contact_name_order(sort: str = "asc"):
+    """Сортировка по имени без учёта регистра; id делает порядок однозначным."""
+    name_key = func.lower(models.Contact.first_name)
+    if sort == "desc":
+        return (name_key.desc(), models.Contact.id.desc())
+    return (name_key.asc(), models.Contact.id.asc())
+
+async def search_contacts(db: AsyncSession, current_user: models.User, query: str, limit: int = 50):
+    dialect_name = get_dialect_name(db)
+    stmt = scoped_contacts_query(current_user).where(contact_search_filter(query, dialect_name))
+    if dialect_name == "postgresql":
+        stmt = stmt.order_by(contact_search_rank(query).desc(), *contact_name_order())
+    else:
+        stmt = stmt.order_by(*contact_name_order())
+    result = await db.execute(stmt.limit(limit))
+    return result.scalars().all()
+
+async def get_contacts_grouped_by_user(db: AsyncSession, current_user: models.User, user_ids,
+                                       search: Optional[str] = None, sort: str = "asc",
+                                       per_user_limit: int = 100, per_user_offset: int = 0):
+    """
+    Постраничная выборка контактов отдельно для каждого пользователя из user_ids.
+    Страница каждого пользователя берётся подзапросом JOIN LATERAL с ORDER BY и
+    LIMIT, который идёт по индексу ix_contacts_user_lower_first_name, поэтому
+    объём работы зависит от размера страницы, а не от числа контактов.
+    Возвращает (contacts_by_user, totals_by_user).
+    """
+    if not user_ids:
+        return {}, {}
+    filters = contact_scope_filter(current_user)
+    if search:
+        filters.append(contact_search_filter(search, get_dialect_name(db)))
+
+    users = select(models.User.id.label("user_id")).where(models.User.id.in_(user_ids)).subquery()
+    top = (
+        select(models.Contact.id.label("contact_id"))
+        .where(models.Contact.user_id == users.c.user_id, *filters)
+        .order_by(*contact_name_order(sort))
+        .offset(per_user_offset)
+        .limit(per_user_limit)
+        .correlate(users)
+        .lateral()
+    )
+    page = await db.execute(
+        select(models.Contact)
+        .select_from(users)
+        .join(top, literal_column("true"))
+        .join(models.Contact, models.Contact.id == top.c.contact_id)
+        .options(*contact_load_options())
+        .order_by(models.Contact.user_id, *contact_name_order(sort))
+    )
+    contacts_by_user = {}
+    for contact in page.scalars().all():
+        contacts_by_user.setdefault(contact.user_id, []).append(contact)
+
+    # Подсчёт только по пользователям страницы (индекс по user_id)
+    totals = await db.execute(
+        select(models.Contact.user_id, func.count(models.Contact.id))
+        .where(models.Contact.user_id.in_(user_ids), *filters)
+        .group_by(models.Contact.user_id)
+    )
+    totals_by_user = {uid: total for uid, total in totals.all()}
+    return contacts_by_user, totals_by_user
+
+# BIRTHDAYS
+# Все выборки по дням рождения используют индексированную колонку
+# Contact.birthday_md (month * 100 + day), поэтому сводятся к range scan.
+
+def birthday_in_window(md, today: date, days: int = 7):
+    """
+    День рождения md (birthday_ordinal) в ближайшие days дней с переходом через
+    конец года. md — число (проверка в Python) или колонка Contact.birthday_md
+    (условие для SQL): операторы & и | работают для обоих.
+    """
+    start_md = models.birthday_ordinal(today)
+    end_md = models.birthday_ordinal(today + timedelta(days=days))
+    if start_md <= end_md:
+        return (md >= start_md) & (md <= end_md)
+    return (md >= start_md) | (md <= end_md)
+
+def upcoming_birthdays_filter(today: date, days: int = 7):
+    """Условие "день рождения в ближайшие days дней" для запроса контактов."""
+    return birthday_in_window(models.Contact.birthday_md, today, days)
+
+def next_birthday_order(today: date):
+    """Сортировка по ближайшему дню рождения: сначала оставшиеся в этом году, затем со следующего."""
+    start_md = models.birthday_ordinal(today)
+    return (
+        case((models.Contact.birthday_md >= start_md, 0), else_=1),
+        models.Contact.birthday_md,
+    )
+
+async def contacts_with_upcoming_birthdays(db: AsyncSession, current_user: models.User, days: int = 7):
     today = date.today()
-    in_seven_days = today + timedelta(days=7)
-    # Check only month and day, ignore year
-    return db.query(models.Contact).filter(
-        or_(
-            and_(func.extract('month', models.Contact.birthday) == today.month,
-                 func.extract('day', models.Contact.birthday) >= today.day),
-            and_(func.extract('month', models.Contact.birthday) == in_seven_days.month,
-                 func.extract('day', models.Contact.birthday) <= in_seven_days.day)
+    result = await db.execute(
+        scoped_contacts_query(current_user)
+        .where(upcoming_birthdays_filter(today, days=days))
+        .order_by(*next_birthday_order(today))
+    )
+    return result.scalars().all()
+
+async def contacts_with_birthdays(db: AsyncSession, current_user: models.User):
+    """Все контакты с датой рождения, по ближайшему дню рождения (окно 12 месяцев)."""
+    today = date.today()
+    result = await db.execute(
+        scoped_contacts_query(current_user)
+        .where(models.Contact.birthday_md.isnot(None))
+        .order_by(*next_birthday_order(today))
+    )
+    return result.scalars().all()
+
+async def refresh_birthday_ordinals(db: AsyncSession):
+    """Пересчитывает birthday_md для строк, записанных в обход ORM (или до появления колонки)."""
+    expected = (
+        func.extract('month', models.Contact.birthday) * 100
+        + func.extract('day', models.Contact.birthday)
+    )
+    result = await db.execute(
+        update(models.Contact)
+        .where(
+            models.Contact.birthday.isnot(None),
+            or_(models.Contact.birthday_md.is_(None), models.Contact.birthday_md != expected)
         )
-    ).all()
+        .values(birthday_md=expected)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
 
 # GROUPS CRUD
 
-def get_groups(db: Session):
-    return db.query(models.Group).all()
+async def get_groups(db: AsyncSession):
+    result = await db.execute(select(models.Group))
+    return result.scalars().all()
 
-def get_group(db: Session, group_id: int):
-    return db.query(models.Group).filter(models.Group.id == group_id).first()
+async def get_group(db: AsyncSession, group_id: int):
+    result = await db.execute(select(models.Group).where(models.Group.id == group_id))
+    return result.scalars().first()
 
-def create_group(db: Session, group: schemas.GroupCreate):
+async def create_group(db: AsyncSession, group: schemas.GroupCreate):
     db_group = models.Group(name=group.name)
     db.add(db_group)
-    db.commit()
-    db.refresh(db_group)
+    await db.commit()
+    await db.refresh(db_group)
     return db_group
 
-def update_group(db: Session, group_id: int, group: schemas.GroupCreate):
-    db_group = db.query(models.Group).filter(models.Group.id == group_id).first()
+async def update_group(db: AsyncSession, group_id: int, group: schemas.GroupCreate):
+    db_group = await get_group(db, group_id)
     if not db_group:
         return None
     db_group.name = group.name
-    db.commit()
-    db.refresh(db_group)
+    await db.commit()
+    await db.refresh(db_group)
     return db_group
 
-def delete_group(db: Session, group_id: int):
-    db_group = db.query(models.Group).filter(models.Group.id == group_id).first()
+async def delete_group(db: AsyncSession, group_id: int):
+    db_group = await get_group(db, group_id)
     if not db_group:
         return None
-    db.delete(db_group)
-    db.commit()
+    await db.delete(db_group)
+    await db.commit()
     return db_group
@@ -1,10 +1,13 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 from dotenv import load_dotenv
 import logging
 import sys
+from contextvars import ContextVar
+from typing import Optional
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -108,8 +111,22 @@ def get_database_url():
     
     return database_url
 
+# Преобразуем URL базы данных в формат для асинхронного драйвера asyncpg
+def get_async_database_url(database_url):
+    if not database_url:
+        return None
+    # Убираем явно указанный синхронный драйвер, если он есть
+    for sync_prefix in ("postgresql+psycopg2://", "postgresql+psycopg://"):
+        if database_url.startswith(sync_prefix):
+            database_url = database_url.replace(sync_prefix, "postgresql://", 1)
+    if database_url.startswith("postgresql://"):
+        database_url = database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    # asyncpg не понимает параметр sslmode, вместо него используется ssl
+    return database_url.replace("sslmode=", "ssl=")
+
 # Создаем глобальный URL для базы данных
 DATABASE_URL = get_database_url()
+ASYNC_DATABASE_URL = get_async_database_url(DATABASE_URL)
 
 # Проверка наличия допустимого URL для подключения к базе данных
 if DATABASE_URL is None:
@@ -146,13 +163,94 @@ engine = create_engine(
 # Создаем фабрику сессий
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный движок (asyncpg) для обработчиков async def, чтобы запросы к БД
+# не блокировали event loop. Параметры пула совпадают с синхронным движком.
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=5,
+    max_overflow=10,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+    echo=False
+)
+
+# Фабрика асинхронных сессий. expire_on_commit=False, чтобы после commit
+# объекты можно было сериализовать без повторной (ленивой) загрузки атрибутов.
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 # Класс для моделей SQLAlchemy
 Base = declarative_base()
 
-# Функция для получения соединения с БД в виде зависимости FastAPI
-def get_db():
-    db = SessionLocal()
-    try:
+# Единая сессия на запрос (unit of work). FastAPI кэширует зависимости в пределах
+# запроса, поэтому get_current_user и обработчик, объявившие Depends(get_async_db),
+# получают один и тот же объект AsyncSession. Соединение берётся из пула лениво,
+# при первом запросе к БД, и возвращается в пул при commit/закрытии сессии.
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+# Учёт соединений, взятых из пула, в рамках одного HTTP-запроса.
+# Запрос не должен одновременно держать больше DB_MAX_CHECKOUTS_PER_REQUEST
+# соединений: каждое лишнее вдвое сокращает число запросов, которые пул
+# (pool_size + max_overflow) может обслуживать параллельно.
+DB_MAX_CHECKOUTS_PER_REQUEST = int(os.getenv("DB_MAX_CHECKOUTS_PER_REQUEST", "1"))
+# True — соединение сверх лимита не выдаётся, запрос завершается ошибкой 500
+# (для разработки и тестов); False — превышение только считается и логируется
+DB_ENFORCE_CHECKOUT_LIMIT = os.getenv("DB_ENFORCE_CHECKOUT_LIMIT", "False").lower() in ("true", "1", "t")
+
+class TooManyCheckouts(Exception):
+    """Запрос пытается взять из пула больше DB_MAX_CHECKOUTS_PER_REQUEST соединений."""
+
+class RequestCheckouts:
+    """Счётчики соединений одного запроса."""
+    def __init__(self):
+        self.total = 0      # сколько раз соединение бралось из пула
+        self.current = 0    # сколько удерживается сейчас
+        self.max_held = 0   # максимум одновременно удерживаемых
+
+_request_checkouts: ContextVar[Optional["RequestCheckouts"]] = ContextVar("request_checkouts", default=None)
+
+# Накопленная статистика по всем запросам
+pool_stats = {"requests": 0, "checkouts": 0, "over_limit": 0}
+
+def begin_request_checkouts():
+    checkouts = RequestCheckouts()
+    return checkouts, _request_checkouts.set(checkouts)
+
+def end_request_checkouts(checkouts: RequestCheckouts, token):
+    _request_checkouts.reset(token)
+    pool_stats["requests"] += 1
+    pool_stats["checkouts"] += checkouts.total
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    checkouts = _request_checkouts.get()
+    if checkouts is None:
+        return  # соединение взято вне HTTP-запроса (startup, фоновые задачи)
+    if checkouts.current >= DB_MAX_CHECKOUTS_PER_REQUEST:
+        pool_stats["over_limit"] += 1
+        message = (
+            f"Запрос удерживает {checkouts.current + 1} соединений с БД одновременно "
+            f"(лимит {DB_MAX_CHECKOUTS_PER_REQUEST}): используйте общую сессию get_async_db"
+        )
+        if DB_ENFORCE_CHECKOUT_LIMIT:
+            # Соединение, на котором checkout завершился ошибкой, пул закрывает сам
+            raise TooManyCheckouts(message)
+        logger.warning(message)
+    connection_record.info["request_checkouts"] = checkouts
+    checkouts.total += 1
+    checkouts.current += 1
+    checkouts.max_held = max(checkouts.max_held, checkouts.current)
+
+def _on_checkin(dbapi_connection, connection_record):
+    checkouts = connection_record.info.pop("request_checkouts", None)
+    if checkouts is not None:
+        checkouts.current -= 1
+
+for _pool in (engine.pool, async_engine.sync_engine.pool):
+    event.listen(_pool, "checkout", _on_checkout)
+    event.listen(_pool, "checkin", _on_checkin)
@@ -0,0 +1,116 @@
+import logging
+from sqlalchemy import text
+from models import SEARCH_CONFIG, contact_search_document_sql, phone_digits_sql
+
+logger = logging.getLogger(__name__)
+
+CONTACT_CHILD_TABLES = ("phone_numbers", "avatars", "photos", "contact_group")
+
+def _contact_fk_loop(table: str, condition: str, body: str):
+    return f"""
+    DO $$
+    DECLARE fk record;
+    BEGIN
+        FOR fk IN
+            SELECT c.conname FROM pg_constraint c
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY (c.conkey)
+            WHERE c.contype = 'f' AND c.conrelid = '{table}'::regclass
+              AND c.confrelid = 'contacts'::regclass AND a.attname = 'contact_id' AND {condition}
+        LOOP
+            {body}
+        END LOOP;
+    END $$
+    """
+
+def contact_cascade_upgrades(table: str):
+    """
+    Пересоздаёт внешний ключ table.contact_id -> contacts с ON DELETE CASCADE,
+    если он ещё без каскада. Новый ключ добавляется NOT VALID, а проверяется
+    отдельной командой (в своей транзакции): проверка существующих строк не
+    держит блокировку, запрещающую запись в таблицу.
+    """
+    return [
+        _contact_fk_loop(table, "c.confdeltype <> 'c'", f"""
+            EXECUTE format('ALTER TABLE {table} DROP CONSTRAINT %I', fk.conname);
+            EXECUTE format('ALTER TABLE {table} ADD CONSTRAINT %I FOREIGN KEY (contact_id) '
+                           'REFERENCES contacts (id) ON DELETE CASCADE NOT VALID', fk.conname);"""),
+        _contact_fk_loop(table, "NOT c.convalidated",
+                         f"EXECUTE format('ALTER TABLE {table} VALIDATE CONSTRAINT %I', fk.conname);"),
+    ]
+
+# Base.metadata.create_all создаёт только отсутствующие таблицы и не добавляет
+# новые колонки и индексы в уже существующие. Такие изменения схемы описаны
+# здесь и выполняются при каждом запуске, поэтому каждая команда должна быть
+# безопасной для повторного выполнения (IF NOT EXISTS).
+POSTGRES_UPGRADES = [
+    # Денормализованный день рождения для поиска по индексу
+    "ALTER TABLE contacts ADD COLUMN IF NOT EXISTS birthday_md SMALLINT",
+    "CREATE INDEX IF NOT EXISTS ix_contacts_birthday_md ON contacts (birthday_md)",
+    "CREATE INDEX IF NOT EXISTS ix_contacts_user_birthday_md ON contacts (user_id, birthday_md)",
+    # Постраничная сортировка контактов пользователя по имени
+    "CREATE INDEX IF NOT EXISTS ix_contacts_user_lower_first_name ON contacts (user_id, lower(first_name), id)",
+    "CREATE INDEX IF NOT EXISTS ix_contacts_lower_first_name_id ON contacts (lower(first_name), id)",
+    # Полнотекстовый и trigram-поиск контактов
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"ALTER TABLE contacts ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', {contact_search_document_sql()})) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_contacts_search_vector ON contacts USING gin (search_vector)",
+    f"CREATE INDEX IF NOT EXISTS ix_contacts_search_document_trgm ON contacts "
+    f"USING gin (({contact_search_document_sql()}) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_phone_numbers_contact_id ON phone_numbers (contact_id)",
+    f"CREATE INDEX IF NOT EXISTS ix_phone_numbers_digits_trgm ON phone_numbers "
+    f"USING gin (({phone_digits_sql()}) gin_trgm_ops)",
+    # Состояние фоновой загрузки аватара в Cloudinary
+    "ALTER TABLE user_avatars ADD COLUMN IF NOT EXISTS upload_status VARCHAR DEFAULT 'uploaded'",
+    "CREATE INDEX IF NOT EXISTS ix_user_avatars_upload_status ON user_avatars (upload_status)",
+    # Варианты аватара (миниатюра и полный размер в WebP/AVIF)
+    "ALTER TABLE user_avatars ADD COLUMN IF NOT EXISTS thumbnail_url VARCHAR",
+    "ALTER TABLE user_avatars ADD COLUMN IF NOT EXISTS variants JSON",
+    # Общие изображения для одинаковых загрузок (таблица media_assets создаётся create_all)
+    "ALTER TABLE user_avatars ADD COLUMN IF NOT EXISTS asset_id INTEGER REFERENCES media_assets (id)",
+    "CREATE INDEX IF NOT EXISTS ix_user_avatars_asset_id ON user_avatars (asset_id)",
+    # Захват фоновой загрузки ассета одним процессом
+    "ALTER TABLE media_assets ADD COLUMN IF NOT EXISTS spool_host VARCHAR",
+    "ALTER TABLE media_assets ADD COLUMN IF NOT EXISTS claimed_by VARCHAR",
+    "ALTER TABLE media_assets ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP",
+    # Захват писем outbox воркером
+    "ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS claimed_by VARCHAR",
+    "ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP",
+    # Захват записей очереди удаления изображений воркером
+    "ALTER TABLE media_deletions ADD COLUMN IF NOT EXISTS status VARCHAR NOT NULL DEFAULT 'pending'",
+    "ALTER TABLE media_deletions ADD COLUMN IF NOT EXISTS claimed_by VARCHAR",
+    "ALTER TABLE media_deletions ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP",
+    # Проверка ссылок на URL перед удалением изображения из Cloudinary
+    "ALTER TABLE media_deletions ADD COLUMN IF NOT EXISTS url VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_avatars_file_path ON avatars (file_path)",
+    "CREATE INDEX IF NOT EXISTS ix_photos_file_path ON photos (file_path)",
+    "CREATE INDEX IF NOT EXISTS ix_user_avatars_file_path ON user_avatars (file_path)",
+    "CREATE INDEX IF NOT EXISTS ix_user_avatars_thumbnail_url ON user_avatars (thumbnail_url)",
+    "CREATE INDEX IF NOT EXISTS ix_user_avatars_variants ON user_avatars USING gin ((variants::jsonb) jsonb_path_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_media_assets_variants ON media_assets USING gin ((variants::jsonb) jsonb_path_ops)",
+    # Владелец задачи импорта контактов и хост с её файлом
+    "ALTER TABLE contact_import_jobs ADD COLUMN IF NOT EXISTS file_host VARCHAR",
+    "ALTER TABLE contact_import_jobs ADD COLUMN IF NOT EXISTS claimed_by VARCHAR",
+    # Дочерние строки контакта удаляет БД (ON DELETE CASCADE). Индексы по
+    # contact_id нужны, чтобы каскад не сканировал таблицы целиком
+    "CREATE INDEX IF NOT EXISTS ix_avatars_contact_id ON avatars (contact_id)",
+    "CREATE INDEX IF NOT EXISTS ix_photos_contact_id ON photos (contact_id)",
+    *(statement for table in CONTACT_CHILD_TABLES for statement in contact_cascade_upgrades(table)),
+]
+
+def apply_schema_upgrades(engine):
+    """Применяет обновления схемы к существующей базе PostgreSQL."""
+    if engine.dialect.name != "postgresql":
+        logger.info(f"Обновления схемы пропущены для диалекта {engine.dialect.name}")
+        return
+    applied = 0
+    for statement in POSTGRES_UPGRADES:
+        # Каждая команда в своей транзакции: ошибка одной (например, нет прав
+        # на CREATE EXTENSION) не откатывает остальные
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(statement))
+            applied += 1
+        except Exception as e:
+            logger.error(f"Не удалось применить обновление схемы '{statement[:60]}...': {e}")
+    logger.info(f"Обновления схемы применены ({applied}/{len(POSTGRES_UPGRADES)} команд)")
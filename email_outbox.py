@@ -0,0 +1,305 @@
+"""
+Отправка писем через outbox.
+
+Обработчики (регистрация, восстановление пароля) не ждут SMTP: письмо
+записывается в таблицу email_outbox в той же транзакции, что и данные, ради
+которых оно отправляется (queue_email), и ответ возвращается сразу. Если
+транзакция откатилась, письмо не уйдёт; если процесс упал после commit —
+письмо отправится после перезапуска.
+
+Фоновый воркер забирает до EMAIL_OUTBOX_BATCH_SIZE писем (FOR UPDATE SKIP
+LOCKED — несколько процессов не берут одни и те же письма): отмечает их своим
+claimed_by и сразу фиксирует транзакцию, поэтому во время SMTP не держит ни
+соединение с БД, ни блокировки. Результат записывается отдельной короткой
+транзакцией только для писем, которые всё ещё за ним; письма процесса,
+упавшего посреди отправки, забираются снова через EMAIL_OUTBOX_CLAIM_TIMEOUT
+(такое письмо может уйти дважды). Письма отправляются через пул из EMAIL_SMTP_POOL_SIZE постоянных соединений: STARTTLS и вход
+выполняются один раз на соединение, а не на каждое письмо. Соединения,
+не использовавшиеся EMAIL_SMTP_IDLE_TIMEOUT секунд, закрываются.
+- Временные ошибки (обрыв, таймаут, коды 4xx) повторяются с
+  экспоненциальной задержкой, после EMAIL_OUTBOX_MAX_ATTEMPTS попыток письмо
+  остаётся в таблице с last_error.
+- Постоянные ошибки (коды 5xx, например несуществующий адрес) не повторяются.
+"""
+import asyncio
+import email
+import email.policy
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import aiosmtplib
+from dotenv import load_dotenv
+from sqlalchemy import select, update, delete, func, or_, and_, event
+
+from database import AsyncSessionLocal
+from models import EmailOutbox
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EMAIL_HOST = os.getenv("EMAIL_HOST")
+EMAIL_PORT = int(os.getenv("EMAIL_PORT") or "587")
+EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
+EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
+EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", "True").lower() in ("true", "1", "t")
+EMAIL_USE_SSL = os.getenv("EMAIL_USE_SSL", "False").lower() in ("true", "1", "t")
+
+EMAIL_SMTP_POOL_SIZE = int(os.getenv("EMAIL_SMTP_POOL_SIZE", "2"))
+EMAIL_SMTP_IDLE_TIMEOUT = float(os.getenv("EMAIL_SMTP_IDLE_TIMEOUT", "60"))
+EMAIL_SMTP_TIMEOUT = float(os.getenv("EMAIL_SMTP_TIMEOUT", "30"))
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", "50"))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", "6"))
+# Задержка повтора: EMAIL_OUTBOX_RETRY_DELAY * 2^(попытка-1) секунд, не больше часа
+EMAIL_OUTBOX_RETRY_DELAY = float(os.getenv("EMAIL_OUTBOX_RETRY_DELAY", "10"))
+EMAIL_OUTBOX_MAX_RETRY_DELAY = 3600
+# Как часто проверять outbox, если о новых письмах не сообщили
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.getenv("EMAIL_OUTBOX_POLL_INTERVAL", "30"))
+# Через сколько секунд письма, захваченные процессом, можно забрать снова
+EMAIL_OUTBOX_CLAIM_TIMEOUT = int(os.getenv("EMAIL_OUTBOX_CLAIM_TIMEOUT", "600"))
+
+EMAIL_OUTBOX_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_loop: asyncio.AbstractEventLoop = None
+_wakeup: asyncio.Event = None
+_worker_task: asyncio.Task = None
+
+stats = {
+    "queued": 0, "sent": 0, "retried": 0, "gave_up": 0, "rejected": 0,
+    "batches": 0, "connections_opened": 0, "reconnects": 0, "lost_claims": 0,
+}
+
+def _wake_worker(*_):
+    if _wakeup is not None:
+        # Письмо может быть поставлено из синхронного обработчика в другом потоке
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+def queue_email(db, message):
+    """
+    Добавляет письмо (email.message.EmailMessage) в outbox текущей транзакции
+    (Session или AsyncSession; commit выполняет вызывающий). После commit
+    воркер просыпается сразу.
+    """
+    db.add(EmailOutbox(to_email=message["To"], subject=message["Subject"], message=message.as_string()))
+    stats["queued"] += 1
+    event.listen(getattr(db, "sync_session", db), "after_commit", _wake_worker, once=True)
+
+class SMTPConnectionPool:
+    """Постоянные авторизованные SMTP-соединения, по одному на слот."""
+
+    def __init__(self, size: int):
+        self.slots = [None] * size  # (SMTP, время последнего использования)
+
+    async def _connect(self):
+        smtp = aiosmtplib.SMTP(
+            hostname=EMAIL_HOST,
+            port=EMAIL_PORT,
+            username=EMAIL_HOST_USER,
+            password=EMAIL_HOST_PASSWORD,
+            use_tls=EMAIL_USE_SSL,
+            start_tls=EMAIL_USE_TLS and not EMAIL_USE_SSL,
+            timeout=EMAIL_SMTP_TIMEOUT,
+        )
+        # connect() сам выполняет STARTTLS и вход
+        await smtp.connect()
+        stats["connections_opened"] += 1
+        return smtp
+
+    async def send(self, slot: int, message):
+        """Отправляет письмо через соединение slot; разорванное соединение открывается заново один раз."""
+        entry = self.slots[slot]
+        smtp = entry[0] if entry and entry[0].is_connected else None
+        for retry in (False, True):
+            if smtp is None:
+                smtp = await self._connect()
+            try:
+                await smtp.send_message(message)
+                self.slots[slot] = (smtp, time.monotonic())
+                return
+            except aiosmtplib.SMTPServerDisconnected:
+                # Сервер закрыл простаивавшее соединение
+                self.slots[slot] = None
+                smtp = None
+                if retry:
+                    raise
+                stats["reconnects"] += 1
+
+    async def close_idle(self, max_idle: float = EMAIL_SMTP_IDLE_TIMEOUT):
+        now = time.monotonic()
+        for slot, entry in enumerate(self.slots):
+            if entry and now - entry[1] >= max_idle:
+                self.slots[slot] = None
+                try:
+                    await entry[0].quit()
+                except aiosmtplib.SMTPException:
+                    entry[0].close()
+
+    def open_connections(self):
+        return sum(1 for entry in self.slots if entry and entry[0].is_connected)
+
+_pool = SMTPConnectionPool(EMAIL_SMTP_POOL_SIZE)
+
+def _is_permanent(error: Exception):
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return all(500 <= r.code < 600 for r in error.recipients)
+    return isinstance(error, aiosmtplib.SMTPResponseException) and 500 <= error.code < 600
+
+def _retry_delay(attempts: int):
+    return min(EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), EMAIL_OUTBOX_MAX_RETRY_DELAY)
+
+async def _send_share(slot: int, rows):
+    """Письма одного соединения отправляются по очереди; возвращает {id: ошибка или None}."""
+    results = {}
+    for i, row in enumerate(rows):
+        try:
+            message = email.message_from_string(row.message, policy=email.policy.default)
+            await _pool.send(slot, message)
+            results[row.id] = None
+        except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused) as e:
+            # Ошибка относится к письму; соединение можно использовать дальше
+            results[row.id] = e
+        except (aiosmtplib.SMTPException, OSError) as e:
+            # Сервер недоступен — остальные письма этого соединения не пробуем
+            for rest in rows[i:]:
+                results[rest.id] = e
+            break
+    return results
+
+async def _claim_batch():
+    """
+    Забирает пачку писем этим процессом и фиксирует захват. Возвращает строки
+    (id, to_email, message); блокировки снимаются вместе с commit.
+    """
+    now = datetime.utcnow()
+    due = select(EmailOutbox.id).where(
+        EmailOutbox.attempts < EMAIL_OUTBOX_MAX_ATTEMPTS,
+        or_(
+            and_(EmailOutbox.claimed_by.is_(None), EmailOutbox.next_attempt_at <= now),
+            # Захват процесса, который не довёл отправку до конца
+            EmailOutbox.claimed_at < now - timedelta(seconds=EMAIL_OUTBOX_CLAIM_TIMEOUT),
+        ),
+    ).order_by(EmailOutbox.next_attempt_at).limit(EMAIL_OUTBOX_BATCH_SIZE).with_for_update(skip_locked=True)
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            update(EmailOutbox)
+            .where(EmailOutbox.id.in_(due.scalar_subquery()))
+            .values(claimed_by=EMAIL_OUTBOX_WORKER_ID, claimed_at=now)
+            .returning(EmailOutbox.id, EmailOutbox.to_email, EmailOutbox.message)
+            .execution_options(synchronize_session=False)
+        )).all()
+        await db.commit()
+    return sorted(rows, key=lambda row: row.id)
+
+async def _record_results(results):
+    """Удаляет отправленные письма и откладывает остальные; чужие захваты не трогает."""
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            select(EmailOutbox)
+            .where(EmailOutbox.id.in_(list(results)), EmailOutbox.claimed_by == EMAIL_OUTBOX_WORKER_ID)
+            .with_for_update()
+        )).scalars().all()
+        now = datetime.utcnow()
+        sent = []
+        for row in rows:
+            error = results[row.id]
+            if error is None:
+                sent.append(row.id)
+                continue
+            row.claimed_by = None
+            row.attempts += 1
+            row.last_error = f"{type(error).__name__}: {error}"[:1000]
+            row.next_attempt_at = now + timedelta(seconds=_retry_delay(row.attempts))
+            if _is_permanent(error):
+                row.attempts = EMAIL_OUTBOX_MAX_ATTEMPTS
+                logger.error(f"Письмо {row.id} для {row.to_email} отклонено сервером: {error}")
+                stats["rejected"] += 1
+            elif row.attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Письмо {row.id} для {row.to_email} не отправлено после {row.attempts} попыток: {error}")
+                stats["gave_up"] += 1
+            else:
+                stats["retried"] += 1
+        if sent:
+            await db.execute(delete(EmailOutbox).where(EmailOutbox.id.in_(sent)))
+            stats["sent"] += len(sent)
+        if len(rows) < len(results):
+            # Захват устарел и письма забрал другой процесс — результат за ним
+            stats["lost_claims"] += len(results) - len(rows)
+        await db.commit()
+
+async def _process_batch():
+    """Отправляет одну пачку; возвращает (число писем в пачке, число временных ошибок)."""
+    rows = await _claim_batch()
+    if not rows:
+        return 0, 0
+
+    # SMTP — без открытой транзакции и соединения с БД
+    stats["batches"] += 1
+    size = len(_pool.slots)
+    shares = await asyncio.gather(*(
+        _send_share(slot, rows[slot::size]) for slot in range(size) if rows[slot::size]
+    ))
+    results = {row_id: error for share in shares for row_id, error in share.items()}
+
+    await _record_results(results)
+    transient = sum(1 for error in results.values() if error is not None and not _is_permanent(error))
+    return len(rows), transient
+
+async def _worker():
+    failures = 0
+    while True:
+        _wakeup.clear()
+        try:
+            processed, errors = await _process_batch()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка фоновой отправки писем: {e}")
+            processed, errors = 0, 1
+
+        if errors and errors == processed:
+            # Ни одно письмо не ушло (SMTP или БД недоступны) — пауза растёт с числом сбоев подряд
+            failures += 1
+            await asyncio.sleep(_retry_delay(failures))
+            continue
+        failures = 0
+        if processed == EMAIL_OUTBOX_BATCH_SIZE:
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), min(EMAIL_OUTBOX_POLL_INTERVAL, EMAIL_SMTP_IDLE_TIMEOUT))
+        except asyncio.TimeoutError:
+            pass
+        await _pool.close_idle()
+
+def start_email_worker():
+    """Запускает воркер отправки писем (вызывается при старте приложения)."""
+    global _loop, _wakeup, _worker_task
+    if not EMAIL_HOST:
+        logger.warning("EMAIL_HOST не задан: письма сохраняются в email_outbox, но не отправляются")
+        return
+    if _worker_task is None:
+        _loop = asyncio.get_running_loop()
+        _wakeup = asyncio.Event()
+        _worker_task = asyncio.create_task(_worker())
+
+async def email_outbox_stats():
+    async with AsyncSessionLocal() as db:
+        pending, sending, dead = (await db.execute(
+            select(
+                func.count().filter(EmailOutbox.attempts < EMAIL_OUTBOX_MAX_ATTEMPTS, EmailOutbox.claimed_by.is_(None)),
+                func.count().filter(EmailOutbox.claimed_by.is_not(None)),
+                func.count().filter(EmailOutbox.attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS),
+            )
+        )).one()
+    return {
+        **stats,
+        "pending": pending,
+        "sending": sending,
+        "dead": dead,
+        "worker": _worker_task is not None,
+        "pool_size": len(_pool.slots),
+        "open_connections": _pool.open_connections(),
+    }
@@ -0,0 +1,331 @@
+"""
+Генератор больших наборов тестовых данных (нагрузочное тестирование).
+
+Пользователи, группы, контакты, телефоны и членство в группах создаются
+пачками и загружаются в PostgreSQL через COPY, а не по одному ORM-объекту:
+миллион контактов — минуты, а не часы.
+- План (сколько контактов у каждого пользователя) и id строк готовит
+  основной процесс; id берутся из последовательностей заранее, одним
+  запросом на таблицу.
+- Пачки по FAKE_DATA_CHUNK_SIZE контактов формируются в пуле процессов
+  (FAKE_DATA_PROCESS_WORKERS) сразу в виде CSV для COPY; пока основной
+  процесс загружает одну пачку, следующие уже генерируются.
+- Имена, фамилии, домены и заметки выбираются из пулов, один раз
+  созданных Faker: вызов Faker на каждое поле был самой медленной частью
+  старого /db/fill-fake.
+- Всё загружается в одной транзакции: при ошибке в БД не остаётся
+  частично созданного набора.
+
+Один и тот же seed даёт тот же набор данных (у каждой пачки свой генератор
+случайных чисел, поэтому результат не зависит от числа процессов).
+
+Распределения:
+- контактов на пользователя: fixed (ровно contacts_per_user), uniform
+  (0..2*contacts_per_user), exponential, lognormal (длинный хвост, разброс
+  contacts_sigma) — среднее во всех случаях contacts_per_user;
+- телефонов на контакт: веса "число:вес", например "0:5,1:55,2:30,3:10";
+- дней рождения: uniform или normal (пик в середине) между birth_year_min и
+  birth_year_max.
+
+Запуск из командной строки:
+    python fake_data.py --users 1000 --contacts-per-user 1000 --seed 42
+"""
+import argparse
+import csv
+import io
+import logging
+import math
+import os
+import random
+import re
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from faker import Faker
+
+from database import engine
+from models import User, birthday_ordinal
+
+logger = logging.getLogger(__name__)
+
+FAKE_DATA_CHUNK_SIZE = int(os.getenv("FAKE_DATA_CHUNK_SIZE", "20000"))
+FAKE_DATA_PROCESS_WORKERS = int(os.getenv("FAKE_DATA_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+# Ограничения для HTTP-эндпоинта (администратор / остальные); из командной строки можно больше
+FAKE_DATA_MAX_CONTACTS = int(os.getenv("FAKE_DATA_MAX_CONTACTS", "2000000"))
+FAKE_DATA_MAX_USER_CONTACTS = int(os.getenv("FAKE_DATA_MAX_USER_CONTACTS", "1000"))
+# Пароль созданных пользователей (чтобы нагрузочные тесты могли войти).
+# Не задан — пользователям ставится хеш случайного пароля, войти под ними нельзя
+FAKE_DATA_USER_PASSWORD = os.getenv("FAKE_DATA_USER_PASSWORD")
+
+CONTACT_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+BIRTHDAY_DISTRIBUTIONS = ("uniform", "normal")
+DEFAULT_PHONE_COUNTS = "0:5,1:55,2:30,3:10"
+PHONE_LABELS = (("mobile", 6), ("home", 2), ("work", 2))
+PHONE_OPERATORS = ("50", "63", "66", "67", "68", "73", "93", "95", "96", "97", "98", "99")
+POOL_SIZE = 2000
+
+# ---------------------------------------------------------------------------
+# Разбор параметров и план
+
+def parse_phone_counts(value: str):
+    """"0:5,1:55,2:30" -> ([0, 1, 2], [5.0, 55.0, 30.0])."""
+    counts, weights = [], []
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        count, sep, weight = item.partition(":")
+        try:
+            count, weight = int(count), float(weight) if sep else 1.0
+        except ValueError:
+            raise ValueError(f"Invalid phone_counts item: {item!r}")
+        if count < 0 or weight < 0:
+            raise ValueError(f"Invalid phone_counts item: {item!r}")
+        counts.append(count)
+        weights.append(weight)
+    if not counts or not sum(weights):
+        raise ValueError("phone_counts must contain at least one positive weight")
+    return counts, weights
+
+def contacts_per_user_plan(rng: random.Random, users: int, mean: float, distribution: str = "fixed",
+                           sigma: float = 1.0):
+    """Число контактов каждого пользователя по выбранному распределению."""
+    if distribution == "fixed":
+        return [int(mean)] * users
+    if distribution == "uniform":
+        return [rng.randint(0, int(2 * mean)) for _ in range(users)]
+    if distribution == "exponential":
+        return [int(rng.expovariate(1 / mean)) if mean > 0 else 0 for _ in range(users)]
+    if distribution == "lognormal":
+        if mean <= 0:
+            return [0] * users
+        mu = math.log(mean) - sigma ** 2 / 2  # среднее логнормального = mean
+        return [int(rng.lognormvariate(mu, sigma)) for _ in range(users)]
+    raise ValueError(f"Unknown contacts distribution: {distribution}")
+
+# ---------------------------------------------------------------------------
+# Генерация пачки (выполняется в пуле процессов)
+
+_pools = {}
+
+def _slug(value: str):
+    return re.sub(r"[^a-z0-9]+", "", value.lower()) or "contact"
+
+def _name_pools(seed: int):
+    """Имена, фамилии, домены и заметки — один раз на seed в каждом процессе."""
+    if seed not in _pools:
+        faker = Faker()
+        faker.seed_instance(seed)
+        _pools[seed] = {
+            "first": [faker.first_name() for _ in range(POOL_SIZE)],
+            "last": [faker.last_name() for _ in range(POOL_SIZE)],
+            "domains": sorted({faker.free_email_domain() for _ in range(50)}),
+            "notes": [faker.sentence() for _ in range(POOL_SIZE // 4)],
+        }
+    return _pools[seed]
+
+def _birthdays(rng: random.Random, n: int, year_min: int, year_max: int, distribution: str):
+    start = date(year_min, 1, 1).toordinal()
+    span = date(year_max, 12, 31).toordinal() - start + 1
+    if distribution == "normal":
+        offsets = [min(max(int(rng.gauss(span / 2, span / 6)), 0), span - 1) for _ in range(n)]
+    else:
+        offsets = [rng.randrange(span) for _ in range(n)]
+    return [date.fromordinal(start + offset) for offset in offsets]
+
+def _csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue()
+
+def build_chunk(task: dict):
+    """
+    CSV для COPY одной пачки: (контакты, телефоны, членство в группах,
+    число телефонов, число членств).
+    """
+    seed, chunk_index = task["seed"], task["chunk_index"]
+    rng = random.Random(f"{seed}:{chunk_index}")
+    pools = _name_pools(seed)
+    contact_ids, owners = task["contact_ids"], task["owners"]
+    n = len(contact_ids)
+
+    first_names = rng.choices(pools["first"], k=n)
+    last_names = rng.choices(pools["last"], k=n)
+    domains = rng.choices(pools["domains"], k=n)
+    birthdays = _birthdays(rng, n, task["birth_year_min"], task["birth_year_max"], task["birthday_distribution"])
+    phone_counts = rng.choices(task["phone_counts"][0], weights=task["phone_counts"][1], k=n)
+    labels, label_weights = zip(*PHONE_LABELS)
+
+    contacts, phones, memberships = [], [], []
+    for i in range(n):
+        contact_id, first, last, birthday = contact_ids[i], first_names[i], last_names[i], birthdays[i]
+        number = task["start_index"] + i
+        contacts.append((
+            contact_id, owners[i], first, last,
+            f"{_slug(first)}.{_slug(last)}{number}@{domains[i]}",
+            birthday.isoformat(), birthday_ordinal(birthday),
+            rng.choice(pools["notes"]) if rng.random() < 0.5 else None,
+        ))
+        for label in rng.choices(labels, weights=label_weights, k=phone_counts[i]):
+            phones.append((contact_id, f"+380 {rng.choice(PHONE_OPERATORS)} {rng.randrange(10 ** 7):07d}", label))
+        if task["group_ids"] and rng.random() < task["group_membership"]:
+            memberships.append((contact_id, rng.choice(task["group_ids"])))
+    return _csv(contacts), _csv(phones), _csv(memberships), len(phones), len(memberships)
+
+# ---------------------------------------------------------------------------
+# Загрузка
+
+CONTACT_COLUMNS = "id, user_id, first_name, last_name, email, birthday, birthday_md, extra_info"
+
+def _copy(cursor, table: str, columns: str, data: str):
+    cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", io.StringIO(data))
+
+def _next_ids(cursor, table: str, count: int):
+    if not count:
+        return []
+    cursor.execute(
+        "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", (table, count)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def _create_users(cursor, seed: int, users: int):
+    prefix = f"loadtest_{seed}_"
+    cursor.execute("SELECT 1 FROM users WHERE username LIKE %s LIMIT 1", (prefix.replace("_", r"\_") + "%",))
+    if cursor.fetchone():
+        raise ValueError(f"Users for seed {seed} already exist: clear them or use another seed")
+    ids = _next_ids(cursor, "users", users)
+    # bcrypt дорогой — один хеш на всех пользователей набора
+    password_hash = User.get_password_hash(FAKE_DATA_USER_PASSWORD or secrets.token_urlsafe(32))
+    _copy(cursor, "users", "id, username, email, hashed_password, role, is_verified", _csv(
+        (user_id, f"{prefix}{i}", f"{prefix}{i}@example.com", password_hash, "user", True)
+        for i, user_id in enumerate(ids)
+    ))
+    return ids
+
+def _ensure_groups(cursor, seed: int, groups: int):
+    """Группы набора (имена уникальны, поэтому существующие используются повторно)."""
+    names = [f"Load test {seed} #{i + 1}" for i in range(groups)]
+    if not names:
+        return []
+    cursor.execute(
+        "INSERT INTO groups (name) SELECT unnest(%s::text[]) ON CONFLICT (name) DO NOTHING", (names,)
+    )
+    cursor.execute("SELECT id FROM groups WHERE name = ANY(%s) ORDER BY id", (names,))
+    return [row[0] for row in cursor.fetchall()]
+
+def _load_chunk(cursor, chunk, phones: int, memberships: int):
+    contacts_csv, phones_csv, memberships_csv, chunk_phones, chunk_memberships = chunk
+    _copy(cursor, "contacts", CONTACT_COLUMNS, contacts_csv)
+    _copy(cursor, "phone_numbers", "contact_id, number, label", phones_csv)
+    _copy(cursor, "contact_group", "contact_id, group_id", memberships_csv)
+    return phones + chunk_phones, memberships + chunk_memberships
+
+def generate_fake_data(seed: int = None, users: int = 0, user_id: int = None, contacts: int = None,
+                       contacts_per_user: float = 100, contacts_distribution: str = "fixed",
+                       contacts_sigma: float = 1.0, phone_counts: str = DEFAULT_PHONE_COUNTS,
+                       birth_year_min: int = 1945, birth_year_max: int = 2007,
+                       birthday_distribution: str = "uniform", groups: int = 0,
+                       group_membership: float = 0.3, workers: int = None,
+                       max_contacts: int = None):
+    """
+    Создаёт набор данных и возвращает сводку (seed, число строк, время).
+
+    users > 0 — создать пользователей loadtest_<seed>_<i> и распределить
+    контакты между ними; иначе — contacts контактов пользователю user_id.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    if contacts_distribution not in CONTACT_DISTRIBUTIONS:
+        raise ValueError(f"Unknown contacts distribution: {contacts_distribution}")
+    if birthday_distribution not in BIRTHDAY_DISTRIBUTIONS:
+        raise ValueError(f"Unknown birthday distribution: {birthday_distribution}")
+    if not 1900 <= birth_year_min <= birth_year_max <= date.today().year:
+        raise ValueError("Invalid birth year range")
+    if not 0 <= group_membership <= 1:
+        raise ValueError("group_membership must be between 0 and 1")
+    if users < 0 or contacts_per_user < 0 or (contacts or 0) < 0 or groups < 0:
+        raise ValueError("Counts must not be negative")
+    phone_weights = parse_phone_counts(phone_counts)
+
+    rng = random.Random(seed)
+    if users:
+        plan = contacts_per_user_plan(rng, users, contacts_per_user, contacts_distribution, contacts_sigma)
+    elif user_id is not None:
+        plan = [contacts or 0]
+    else:
+        raise ValueError("Either users or user_id is required")
+    total = sum(plan)
+    if max_contacts is not None and total > max_contacts:
+        raise ValueError(f"Too many contacts: {total} > {max_contacts}")
+
+    started = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        user_ids = _create_users(cursor, seed, users) if users else [user_id]
+        group_ids = _ensure_groups(cursor, seed, groups)
+        contact_ids = _next_ids(cursor, "contacts", total)
+        owners = [owner for owner, count in zip(user_ids, plan) for _ in range(count)]
+
+        tasks = ({
+            "seed": seed, "chunk_index": index, "start_index": start,
+            "contact_ids": contact_ids[start:start + FAKE_DATA_CHUNK_SIZE],
+            "owners": owners[start:start + FAKE_DATA_CHUNK_SIZE],
+            "group_ids": group_ids, "group_membership": group_membership,
+            "phone_counts": phone_weights, "birth_year_min": birth_year_min,
+            "birth_year_max": birth_year_max, "birthday_distribution": birthday_distribution,
+        } for index, start in enumerate(range(0, total, FAKE_DATA_CHUNK_SIZE)))
+
+        phones = memberships = 0
+        workers = workers or FAKE_DATA_PROCESS_WORKERS
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Не больше двух готовых пачек на процесс: память не растёт с размером набора
+            pending = []
+            for task in tasks:
+                pending.append(executor.submit(build_chunk, task))
+                if len(pending) >= 2 * workers:
+                    phones, memberships = _load_chunk(cursor, pending.pop(0).result(), phones, memberships)
+            for future in pending:
+                phones, memberships = _load_chunk(cursor, future.result(), phones, memberships)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Тестовые данные (seed={seed}): {len(user_ids)} пользователей, {total} контактов за {elapsed:.1f} с")
+    return {
+        "seed": seed,
+        "users": len(user_ids),
+        "user_ids": user_ids[:100],
+        "groups": len(group_ids),
+        "contacts": total,
+        "phone_numbers": phones,
+        "group_memberships": memberships,
+        "seconds": round(elapsed, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерация тестовых данных через COPY")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--users", type=int, default=0, help="Создать пользователей loadtest_<seed>_<i>")
+    parser.add_argument("--user-id", type=int, help="Добавить контакты существующему пользователю")
+    parser.add_argument("--contacts", type=int, help="Число контактов для --user-id")
+    parser.add_argument("--contacts-per-user", type=float, default=100)
+    parser.add_argument("--contacts-distribution", choices=CONTACT_DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--contacts-sigma", type=float, default=1.0)
+    parser.add_argument("--phone-counts", default=DEFAULT_PHONE_COUNTS)
+    parser.add_argument("--birth-year-min", type=int, default=1945)
+    parser.add_argument("--birth-year-max", type=int, default=2007)
+    parser.add_argument("--birthday-distribution", choices=BIRTHDAY_DISTRIBUTIONS, default="uniform")
+    parser.add_argument("--groups", type=int, default=0)
+    parser.add_argument("--group-membership", type=float, default=0.3)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+    print(generate_fake_data(**vars(args)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Подготовка аватаров перед загрузкой в Cloudinary.
+
+Браузер присылает оригиналы в несколько мегабайт, а интерфейс показывает их
+маленькими кругами. Поэтому перед загрузкой изображение:
+- проверяется (формат, размер в пикселях — защита от «decompression bomb»);
+- поворачивается по EXIF-ориентации, после чего метаданные отбрасываются
+  (EXIF, GPS, ICC не попадают в результат);
+- уменьшается до варианта "full" (до IMAGE_FULL_SIZE по большей стороне) и
+  квадратной миниатюры "thumb" (IMAGE_THUMB_SIZE);
+- кодируется в WebP и, если Pillow поддерживает, в AVIF.
+
+Для поиска повторных загрузок считается перцептивный хеш (dHash, 64 бита):
+у одинаковых на вид изображений (другое сжатие, размер, метаданные) хеши
+отличаются лишь в нескольких битах.
+
+Работа с изображениями нагружает CPU, поэтому выполняется в отдельном пуле
+процессов (IMAGE_PROCESS_WORKERS). Модуль не зависит от остального
+приложения: в процессах пула нужны только Pillow и функции ниже.
+"""
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", str(min(2, os.cpu_count() or 1))))
+IMAGE_FULL_SIZE = int(os.getenv("IMAGE_FULL_SIZE", "512"))
+IMAGE_THUMB_SIZE = int(os.getenv("IMAGE_THUMB_SIZE", "96"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(40_000_000)))
+
+ALLOWED_FORMATS = {"JPEG", "PNG", "WEBP", "GIF", "BMP", "TIFF", "AVIF", "MPO"}
+
+# Форматы, в которые кодируются варианты (AVIF — только если доступен в Pillow)
+OUTPUT_FORMATS = ["webp"] + (["avif"] if features.check("avif") else [])
+
+class InvalidImage(Exception):
+    """Файл не является допустимым изображением."""
+
+def _open(path: str):
+    Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+    try:
+        image = Image.open(path)
+    except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise InvalidImage(str(e))
+    if image.format not in ALLOWED_FORMATS:
+        raise InvalidImage(f"Unsupported image format: {image.format}")
+    if image.width * image.height > IMAGE_MAX_PIXELS:
+        raise InvalidImage("Image is too large")
+    return image
+
+def validate_image(path: str):
+    """Быстрая проверка по заголовку файла; возвращает формат и размеры."""
+    with _open(path) as image:
+        try:
+            image.verify()
+        except Exception as e:
+            raise InvalidImage(str(e))
+        return image.format, image.size
+
+def fingerprint_image(path: str):
+    """Проверяет изображение и возвращает его dHash (16 hex-символов)."""
+    validate_image(path)
+    with _open(path) as image:
+        try:
+            image = ImageOps.exif_transpose(image)
+            # 9x8 пикселей в оттенках серого: бит = яркость растёт слева направо
+            pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+        except (OSError, SyntaxError) as e:
+            raise InvalidImage(str(e))
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def phash_distance(a: str, b: str):
+    """Число различающихся бит двух dHash."""
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+def make_variants(path: str, out_prefix: str):
+    """
+    Создаёт варианты изображения рядом с out_prefix:
+    {out_prefix}.full.webp, {out_prefix}.thumb.webp (и .avif).
+    Возвращает {"full.webp": путь, ...}.
+    """
+    with _open(path) as image:
+        try:
+            image = ImageOps.exif_transpose(image)
+            image.load()
+        except (OSError, SyntaxError) as e:
+            raise InvalidImage(str(e))
+        # Сохраняем прозрачность, остальное приводим к RGB
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        # EXIF, ICC и прочие метаданные не переносятся в варианты
+        image.info = {}
+
+        full = image.copy()
+        full.thumbnail((IMAGE_FULL_SIZE, IMAGE_FULL_SIZE), Image.LANCZOS)
+        thumb = ImageOps.fit(image, (IMAGE_THUMB_SIZE, IMAGE_THUMB_SIZE), Image.LANCZOS)
+
+    variants = {}
+    for name, variant in (("full", full), ("thumb", thumb)):
+        for fmt in OUTPUT_FORMATS:
+            out_path = f"{out_prefix}.{name}.{fmt}"
+            variant.save(out_path, format=fmt.upper(), quality=IMAGE_QUALITY)
+            variants[f"{name}.{fmt}"] = out_path
+    return variants
+
+_executor = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+    return _executor
+
+async def run_in_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), func, *args)
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Request, HTTPException, Form, Depends, status, Cookie, Body, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException, Form, Depends, status, Cookie, Body
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware import Middleware
 from starlette.middleware.sessions import SessionMiddleware
@@ -13,6 +13,7 @@ import secrets
 import uuid
 import logging
 import time
+import asyncio
 import sqlalchemy.exc
 from pydantic import EmailStr
 import psycopg2
@@ -21,17 +22,26 @@ import re
 # Добавляем импорт роутера users
 from routers import contacts, groups, db_utils, email_verification, users
 from routers.users_sessions import router as sessions_router
-from database import SessionLocal, engine, Base, is_render_environment, is_docker_environment
-from crud import get_user_by_username, update_user_role, get_user_by_id
+from database import SessionLocal, AsyncSessionLocal, engine, Base, is_render_environment, is_docker_environment
+from database import begin_request_checkouts, end_request_checkouts, TooManyCheckouts
+from crud import get_user_by_username, update_user_role, get_user_by_id, refresh_birthday_ordinals
+from db_migrations import apply_schema_upgrades
 import models
 import os
 from dotenv import load_dotenv
 # Redis session utility
-from redis_client import set_user_session
+from redis_client import set_user_session, close_redis, redis_health_monitor
+from user_cache import invalidate_user, invalidation_listener
+from media_pipeline import start_media_workers
+from media_cleanup import start_media_cleanup
+from contact_import import recover_import_jobs
 # Импортируем функции из auth.py
-from auth import pwd_context, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ALGORITHM
+from auth import create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ALGORITHM
+# bcrypt выполняется в отдельном пуле потоков, а не в event loop
+from password_hashing import hash_password, verify_password, PasswordHashingBusy, PASSWORD_HASH_RETRY_AFTER
 # Добавляем импорт нашей новой функции отправки email
-from utils_email_verif import send_verification_email, send_password_reset_email
+from utils_email_verif import password_reset_email
+from email_outbox import queue_email, start_email_worker
 # Импортируем функции для rate limiting
 from rate_limiter import init_limiter
 
@@ -100,6 +110,23 @@ def ensure_database_exists():
         logger.warning("DATABASE_URL не задан в переменных окружения")
         return False
 
+# Интервал фонового пересчёта Contact.birthday_md (раз в сутки)
+BIRTHDAY_REFRESH_INTERVAL = 24 * 60 * 60
+
+async def refresh_birthday_ordinals_once():
+    try:
+        async with AsyncSessionLocal() as db:
+            updated = await refresh_birthday_ordinals(db)
+        logger.info(f"Пересчитано birthday_md для {updated} контактов")
+    except Exception as e:
+        logger.error(f"Ошибка при пересчёте birthday_md: {e}")
+
+async def birthday_ordinals_refresh_loop():
+    # Подхватывает строки, записанные в обход ORM (raw SQL, массовые загрузки)
+    while True:
+        await asyncio.sleep(BIRTHDAY_REFRESH_INTERVAL)
+        await refresh_birthday_ordinals_once()
+
 # Инициализация приложения
 app = FastAPI(title="Contacts API")
 
@@ -122,6 +149,32 @@ app.add_middleware(
 
 # (Роутеры уже зарегистрированы выше с префиксами, повторная регистрация не требуется)
 
+# Очередь bcrypt переполнена (поток входов) — просим клиента повторить позже
+@app.exception_handler(PasswordHashingBusy)
+async def password_hashing_busy_handler(request: Request, exc: PasswordHashingBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Сервер перегружен запросами входа, повторите попытку позже"},
+        headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER)},
+    )
+
+# Запрос превысил DB_MAX_CHECKOUTS_PER_REQUEST при DB_ENFORCE_CHECKOUT_LIMIT=True
+@app.exception_handler(TooManyCheckouts)
+async def too_many_checkouts_handler(request: Request, exc: TooManyCheckouts):
+    logger.error(f"{request.method} {request.url.path}: {exc}")
+    return JSONResponse(status_code=500, content={"detail": str(exc)})
+
+# Подсчёт соединений с БД, взятых из пула за запрос (X-DB-Checkouts: всего/максимум одновременно)
+@app.middleware("http")
+async def track_db_checkouts(request: Request, call_next):
+    checkouts, token = begin_request_checkouts()
+    try:
+        response = await call_next(request)
+    finally:
+        end_request_checkouts(checkouts, token)
+    response.headers["X-DB-Checkouts"] = f"{checkouts.total}/{checkouts.max_held}"
+    return response
+
 # Создаем таблицы базы данных при запуске приложения
 @app.on_event("startup")
 async def startup_db_and_tables():
@@ -151,6 +204,8 @@ async def startup_db_and_tables():
             # Пытаемся создать таблицы в базе данных
             Base.metadata.create_all(bind=engine)
             logger.info(f"Таблицы базы данных успешно созданы (попытка {attempt+1})")
+            # Добавляем новые колонки и индексы в уже существующие таблицы
+            apply_schema_upgrades(engine)
             break
         except sqlalchemy.exc.OperationalError as e:
             logger.error(f"Ошибка подключения к базе данных (попытка {attempt+1}/{max_retries}): {e}")
@@ -226,6 +281,28 @@ async def startup_db_and_tables():
     except Exception as e:
         logger.error(f"Ошибка при работе с базой данных: {e}")
     
+    # Заполняем birthday_md для существующих контактов и запускаем ежедневный пересчёт
+    await refresh_birthday_ordinals_once()
+    asyncio.create_task(birthday_ordinals_refresh_loop())
+    
+    # Сброс локального кэша пользователей по изменениям из других процессов
+    asyncio.create_task(invalidation_listener())
+    
+    # Мониторинг Redis: circuit breaker и синхронизация локального fallback после сбоя
+    asyncio.create_task(redis_health_monitor())
+    
+    # Воркеры фоновой загрузки аватаров в Cloudinary
+    await start_media_workers()
+    
+    # Фоновое пакетное удаление изображений из Cloudinary
+    start_media_cleanup()
+    
+    # Отправка писем из outbox через пул SMTP-соединений
+    start_email_worker()
+    
+    # Продолжение импортов контактов, прерванных перезапуском
+    asyncio.create_task(recover_import_jobs())
+    
     # Инициализация rate limiter
     try:
         await init_limiter()
@@ -233,6 +310,11 @@ async def startup_db_and_tables():
         logger.error(f"Ошибка при инициализации rate limiter: {e}")
         logger.info("Приложение продолжит работу без ограничения запросов (rate limiting)")
 
+@app.on_event("shutdown")
+async def shutdown_redis():
+    # Закрываем общий пул соединений Redis (сессии, rate limiter, кэши)
+    await close_redis()
+
 # Настройка сессий
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("SECRET_KEY", "default_secret_key"))
 
@@ -333,7 +415,7 @@ async def login_post(request: Request, username: str = Form(...), password: str
             }
             request.session["user"] = user_session_data
             # Сохраняем сессию в Redis
-            set_user_session(superadmin_id, user_session_data, ttl=1800)
+            await set_user_session(superadmin_id, user_session_data, ttl=1800)
             
             # Создаем JWT-токен для API-запросов суперадмина
             access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -358,7 +440,7 @@ async def login_post(request: Request, username: str = Form(...), password: str
             return response
         
         # Проверка для обычных пользователей
-        elif user and pwd_context.verify(password, user.hashed_password):
+        elif user and await verify_password(password, user.hashed_password):
             # Проверка, подтвержден ли email
             if not user.is_verified:
                 return templates.TemplateResponse("login.html", {"request": request, "error": "Пожалуйста, подтвердите ваш email перед входом"})
@@ -372,7 +454,7 @@ async def login_post(request: Request, username: str = Form(...), password: str
             }
             request.session["user"] = user_session_data
             # Сохраняем сессию в Redis
-            set_user_session(user.id, user_session_data, ttl=1800)
+            await set_user_session(user.id, user_session_data, ttl=1800)
             
             # Создаем JWT-токен для API-запросов
             access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -444,11 +526,11 @@ def current_user(request: Request):
     return templates.TemplateResponse("current_user.html", {"request": request})
 
 @app.get("/logout")
-def logout(request: Request):
+async def logout(request: Request):
     from redis_client import delete_user_session
     user = request.session.get("user")
     if user and user.get("id"):
-        delete_user_session(user["id"])
+        await delete_user_session(user["id"])
     request.session.clear()
     response = RedirectResponse("/login")
     # Удаляем cookie с токеном
@@ -460,7 +542,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     db = SessionLocal()
     try:
         user = get_user_by_username(db, form_data.username)
-        if not user or not pwd_context.verify(form_data.password, user.hashed_password):
+        if not user or not await verify_password(form_data.password, user.hashed_password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Неверное имя пользователя или пароль",
@@ -482,12 +564,10 @@ from typing import List, Dict
 
 @app.post("/accounts/status")
 async def accounts_status(user_ids: List[int] = Body(...)):
-    from redis_client import get_user_session
-    result = {}
-    for uid in user_ids:
-        session = get_user_session(uid)
-        result[uid] = "green" if session else "gray"
-    return result
+    from redis_client import get_sessions_status
+    # Все пользователи проверяются одним pipeline-запросом к Redis
+    statuses = await get_sessions_status(user_ids)
+    return {uid: "green" if active else "gray" for uid, active in statuses.items()}
 
 @app.get("/auth/status")
 async def auth_status(
@@ -573,6 +653,7 @@ async def change_user_role(
         
         # Обновляем роль пользователя
         updated_user = update_user_role(db, user_id, new_role)
+        await invalidate_user(user_id, user_to_change.username)
         print(f"Роль пользователя успешно изменена на: {new_role}")
         
         return {
@@ -690,7 +771,7 @@ async def forgot_password_page(request: Request):
 
 
 @app.post("/forgot", response_class=HTMLResponse)
-async def forgot_password_submit(request: Request, background_tasks: BackgroundTasks, email: str = Form(...)):
+async def forgot_password_submit(request: Request, email: str = Form(...)):
     db = SessionLocal()
     try:
         # Проверяем, существует ли пользователь с таким email
@@ -727,21 +808,15 @@ async def forgot_password_submit(request: Request, background_tasks: BackgroundT
             )
             db.add(password_reset)
         
-        db.commit()
-        
         # Генерируем URL для сброса пароля
         reset_url = f"{request.base_url}reset/{reset_token}"
         
         # Логирование для отладки
         print(f"Ссылка для сброса пароля: {reset_url}")
         
-        # Отправляем email в фоновом режиме
-        background_tasks.add_task(
-            send_password_reset_email, 
-            to_email=email, 
-            reset_url=str(reset_url), 
-            username=user.username
-        )
+        # Письмо сохраняется в outbox вместе с токеном и отправляется в фоне
+        queue_email(db, password_reset_email(email, str(reset_url), user.username))
+        db.commit()
         
         return templates.TemplateResponse(
             "password_reset/forgot.html", 
@@ -846,12 +921,13 @@ async def reset_password_submit(
             )
         
         # Обновляем пароль и хешируем его
-        user.hashed_password = models.User.get_password_hash(password)
+        user.hashed_password = await hash_password(password)
         
         # Отмечаем токен как использованный
         password_reset.is_used = True
         
         db.commit()
+        await invalidate_user(user.id, user.username)
         
         # Перенаправляем на страницу входа с сообщением об успешной смене пароля
         response = RedirectResponse(url="/login")
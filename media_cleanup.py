@@ -0,0 +1,279 @@
+"""
+Отложенное удаление изображений из Cloudinary.
+
+Обработчики удаления не обращаются к Cloudinary: public_id освобождённых
+изображений записываются в таблицу media_deletions в той же транзакции, что
+и удаление строк (schedule_media_deletion), поэтому ответ не зависит от
+числа изображений и скорости Cloudinary, а при падении процесса ничего не
+теряется.
+
+Фоновый воркер забирает из очереди до MEDIA_DELETE_BATCH_SIZE записей
+(FOR UPDATE SKIP LOCKED — несколько процессов не берут одни и те же записи):
+помечает их status='deleting' со своим claimed_by и сразу фиксирует
+транзакцию. Затем удаляет их одним запросом Admin API (delete_resources, до
+100 public_id) уже без открытой транзакции и блокировок и отдельной короткой
+транзакцией записывает результат — только для записей, которые всё ещё за
+ним. Записи процесса, упавшего посреди удаления, забираются снова через
+MEDIA_DELETE_CLAIM_TIMEOUT.
+- Частота запросов ограничена MEDIA_DELETE_CALLS_PER_HOUR (лимит Admin API
+  Cloudinary считается в запросах в час).
+- Не удалённые public_id повторяются с экспоненциальной задержкой, после
+  MEDIA_DELETE_MAX_ATTEMPTS попыток запись остаётся в таблице с last_error.
+- После неудачного запроса воркер делает паузу, чтобы не нагружать
+  Cloudinary во время сбоя.
+- Изображения, поставленные в очередь по URL (фото и аватары контактов,
+  schedule_url_deletion), удаляются, только если на URL больше никто не
+  ссылается. Проверка выполняется воркером при захвате пачки по индексам
+  URL-колонок и GIN-индексам variants, а не в запросе, удаляющем контакты.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, func, or_, and_, cast, event
+from sqlalchemy.dialects.postgresql import insert, JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models import MediaDeletion, MediaAsset, UserAvatar, Avatar, Photo
+from utils_cloudinary import delete_images, public_id_from_url
+
+logger = logging.getLogger(__name__)
+
+# Admin API принимает не больше 100 public_id за запрос
+MEDIA_DELETE_BATCH_SIZE = min(int(os.getenv("MEDIA_DELETE_BATCH_SIZE", "100")), 100)
+MEDIA_DELETE_CALLS_PER_HOUR = int(os.getenv("MEDIA_DELETE_CALLS_PER_HOUR", "300"))
+MEDIA_DELETE_MAX_ATTEMPTS = int(os.getenv("MEDIA_DELETE_MAX_ATTEMPTS", "8"))
+# Задержка повтора: MEDIA_DELETE_RETRY_DELAY * 2^(попытка-1) секунд, не больше часа
+MEDIA_DELETE_RETRY_DELAY = float(os.getenv("MEDIA_DELETE_RETRY_DELAY", "30"))
+MEDIA_DELETE_MAX_RETRY_DELAY = 3600
+# Как часто проверять очередь, если о новых записях не сообщили
+MEDIA_DELETE_POLL_INTERVAL = float(os.getenv("MEDIA_DELETE_POLL_INTERVAL", "60"))
+# Через сколько секунд записи, захваченные процессом, можно забрать снова
+MEDIA_DELETE_CLAIM_TIMEOUT = int(os.getenv("MEDIA_DELETE_CLAIM_TIMEOUT", "300"))
+
+# Ключи вариантов в UserAvatar.variants и MediaAsset.variants (см. media_pipeline);
+# AVIF включается, только если Pillow его поддерживает, но искать нужно всегда
+VARIANT_KEYS = [f"{name}.{fmt}" for name in ("full", "thumb") for fmt in ("webp", "avif")]
+
+DELETE_PENDING = "pending"
+DELETE_DELETING = "deleting"
+
+MEDIA_DELETE_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_wakeup: asyncio.Event = None
+_worker_task: asyncio.Task = None
+
+stats = {
+    "scheduled": 0, "deleted": 0, "retried": 0, "gave_up": 0, "api_calls": 0, "api_errors": 0,
+    "lost_claims": 0, "still_referenced": 0,
+}
+
+def _wake_worker(*_):
+    if _wakeup is not None:
+        _wakeup.set()
+
+async def _enqueue(db: AsyncSession, rows):
+    if not rows:
+        return
+    await db.execute(
+        insert(MediaDeletion)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=["public_id"])
+    )
+    stats["scheduled"] += len(rows)
+    event.listen(db.sync_session, "after_commit", _wake_worker, once=True)
+
+async def schedule_media_deletion(db: AsyncSession, public_ids):
+    """
+    Ставит public_id в очередь на удаление в текущей транзакции (commit
+    выполняет вызывающий). После commit воркер просыпается сразу.
+    """
+    public_ids = sorted({public_id for public_id in public_ids if public_id})
+    await _enqueue(db, [{"public_id": public_id} for public_id in public_ids])
+
+async def delete_media_later(public_ids):
+    """schedule_media_deletion в отдельной транзакции (для фоновых задач)."""
+    async with AsyncSessionLocal() as db:
+        await schedule_media_deletion(db, public_ids)
+        await db.commit()
+
+async def schedule_url_deletion(db: AsyncSession, urls):
+    """
+    Ставит в очередь изображения Cloudinary по их URL (аватары и фото
+    контактов хранят только URL). Вызывается после удаления строк; ссылки на
+    URL из других записей проверяет воркер перед удалением (_referenced_urls),
+    поэтому здесь запросов к другим таблицам нет.
+    """
+    public_ids = {public_id_from_url(url): url for url in sorted({url for url in urls if url})}
+    public_ids.pop(None, None)
+    await _enqueue(db, [{"public_id": public_id, "url": url} for public_id, url in sorted(public_ids.items())])
+
+async def _referenced_urls(db: AsyncSession, urls):
+    """URL из urls, на которые ещё ссылаются аватары, фото или ассеты (по индексам)."""
+    referenced = set()
+    for column in (Avatar.file_path, Photo.file_path, UserAvatar.file_path, UserAvatar.thumbnail_url):
+        referenced.update((await db.execute(select(column).where(column.in_(urls)))).scalars())
+    # Остальные варианты хранятся только в JSON; поиск по вложению
+    # {"вариант": {"url": ...}} использует GIN-индекс по variants::jsonb
+    for column in (UserAvatar.variants, MediaAsset.variants):
+        variants = cast(column, JSONB)
+        values = (await db.execute(
+            select(column).where(or_(*(
+                variants.contains({name: {"url": url}}) for url in urls for name in VARIANT_KEYS
+            )))
+        )).scalars()
+        referenced.update(
+            variant.get("url") for value in values for variant in value.values() if variant.get("url") in urls
+        )
+    return referenced
+
+def _retry_delay(attempts: int):
+    return min(MEDIA_DELETE_RETRY_DELAY * 2 ** (attempts - 1), MEDIA_DELETE_MAX_RETRY_DELAY)
+
+async def _claim_batch():
+    """
+    Забирает пачку записей этим процессом и фиксирует захват. Записи, URL
+    которых ещё используется, удаляются из очереди без обращения к
+    Cloudinary. Возвращает [(id, public_id)]; блокировки строк снимаются
+    вместе с commit.
+    """
+    now = datetime.utcnow()
+    due = select(MediaDeletion.id).where(
+        MediaDeletion.attempts < MEDIA_DELETE_MAX_ATTEMPTS,
+        or_(
+            and_(MediaDeletion.status == DELETE_PENDING, MediaDeletion.next_attempt_at <= now),
+            # Захват процесса, который не довёл удаление до конца
+            and_(MediaDeletion.status == DELETE_DELETING,
+                 MediaDeletion.claimed_at < now - timedelta(seconds=MEDIA_DELETE_CLAIM_TIMEOUT)),
+        ),
+    ).order_by(MediaDeletion.next_attempt_at).limit(MEDIA_DELETE_BATCH_SIZE).with_for_update(skip_locked=True)
+    async with AsyncSessionLocal() as db:
+        claimed = (await db.execute(
+            update(MediaDeletion)
+            .where(MediaDeletion.id.in_(due.scalar_subquery()))
+            .values(status=DELETE_DELETING, claimed_by=MEDIA_DELETE_WORKER_ID, claimed_at=now)
+            .returning(MediaDeletion.id, MediaDeletion.public_id, MediaDeletion.url)
+            .execution_options(synchronize_session=False)
+        )).all()
+        urls = {row.url for row in claimed if row.url}
+        referenced = await _referenced_urls(db, list(urls)) if urls else set()
+        if referenced:
+            # На URL снова ссылаются (или он был общим) — изображение не удаляется
+            await db.execute(delete(MediaDeletion).where(
+                MediaDeletion.id.in_([row.id for row in claimed if row.url in referenced])
+            ))
+            stats["still_referenced"] += sum(row.url in referenced for row in claimed)
+        await db.commit()
+    return [(row.id, row.public_id) for row in claimed if row.url not in referenced]
+
+async def _record_results(ids, done, api_ok: bool):
+    """Удаляет удалённые записи и откладывает остальные; чужие захваты не трогает."""
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            select(MediaDeletion)
+            .where(MediaDeletion.id.in_(ids), MediaDeletion.claimed_by == MEDIA_DELETE_WORKER_ID)
+            .with_for_update()
+        )).scalars().all()
+        now = datetime.utcnow()
+        deleted = []
+        for row in rows:
+            if row.public_id in done:
+                deleted.append(row.id)
+                continue
+            row.status = DELETE_PENDING
+            row.claimed_by = None
+            row.attempts += 1
+            row.last_error = "Not deleted by Cloudinary" if api_ok else "Cloudinary API request failed"
+            row.next_attempt_at = now + timedelta(seconds=_retry_delay(row.attempts))
+            if row.attempts >= MEDIA_DELETE_MAX_ATTEMPTS:
+                logger.error(f"Не удалось удалить {row.public_id} из Cloudinary после {row.attempts} попыток")
+                stats["gave_up"] += 1
+            else:
+                stats["retried"] += 1
+        if deleted:
+            await db.execute(delete(MediaDeletion).where(MediaDeletion.id.in_(deleted)))
+            stats["deleted"] += len(deleted)
+        if len(rows) < len(ids):
+            # Захват устарел и записи забрал другой процесс — результат за ним
+            stats["lost_claims"] += len(ids) - len(rows)
+        await db.commit()
+
+async def _process_batch():
+    """
+    Удаляет одну пачку. Возвращает (число записей в пачке, ответил ли
+    Cloudinary).
+    """
+    claimed = await _claim_batch()
+    if not claimed:
+        return 0, True
+
+    # Cloudinary SDK синхронный — выполняем его в потоке, вне транзакции
+    stats["api_calls"] += 1
+    done = await asyncio.to_thread(delete_images, [public_id for _, public_id in claimed])
+    api_ok = done is not None
+    if not api_ok:
+        stats["api_errors"] += 1
+        done = set()
+
+    await _record_results([row_id for row_id, _ in claimed], done, api_ok)
+    return len(claimed), api_ok
+
+async def _worker():
+    min_interval = 3600 / MEDIA_DELETE_CALLS_PER_HOUR
+    failures = 0
+    while True:
+        _wakeup.clear()
+        try:
+            processed, api_ok = await _process_batch()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка фонового удаления изображений: {e}")
+            processed, api_ok = 0, False
+
+        if not api_ok:
+            # Cloudinary или БД недоступны — пауза растёт с числом сбоев подряд
+            failures += 1
+            await asyncio.sleep(max(min_interval, _retry_delay(failures)))
+            continue
+        failures = 0
+        if processed:
+            # Ограничение частоты запросов к Admin API
+            await asyncio.sleep(min_interval)
+            if processed == MEDIA_DELETE_BATCH_SIZE:
+                continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), MEDIA_DELETE_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def start_media_cleanup():
+    """Запускает воркер удаления (вызывается при старте приложения)."""
+    global _wakeup, _worker_task
+    if _worker_task is None:
+        _wakeup = asyncio.Event()
+        _worker_task = asyncio.create_task(_worker())
+
+async def media_cleanup_stats():
+    async with AsyncSessionLocal() as db:
+        queued, deleting, dead = (await db.execute(
+            select(
+                func.count().filter(MediaDeletion.attempts < MEDIA_DELETE_MAX_ATTEMPTS,
+                                    MediaDeletion.status == DELETE_PENDING),
+                func.count().filter(MediaDeletion.status == DELETE_DELETING),
+                func.count().filter(MediaDeletion.attempts >= MEDIA_DELETE_MAX_ATTEMPTS,
+                                    MediaDeletion.status == DELETE_PENDING),
+            )
+        )).one()
+    return {
+        **stats,
+        "queued": queued,
+        "deleting": deleting,
+        "dead": dead,
+        "batch_size": MEDIA_DELETE_BATCH_SIZE,
+        "calls_per_hour": MEDIA_DELETE_CALLS_PER_HOUR,
+    }
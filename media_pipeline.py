@@ -0,0 +1,517 @@
+"""
+Фоновая загрузка аватаров в Cloudinary.
+
+Обработчик загрузки не ждёт Cloudinary: файл по частям сохраняется во
+временный каталог (MEDIA_SPOOL_DIR), проверяется, в БД создаётся аватар со
+статусом upload_status='pending' и ответ возвращается сразу. Фоновые воркеры
+из очереди готовят варианты изображения (image_processing, в пуле процессов)
+и загружают их; при ошибке задача возвращается в очередь с экспоненциальной
+задержкой (уже загруженные варианты повторно не загружаются), после
+MEDIA_UPLOAD_RETRIES попыток аватар помечается как 'failed'.
+
+Повторные загрузки не попадают в Cloudinary. Загруженное изображение — это
+ассет (models.MediaAsset) с хешем содержимого (sha256) и перцептивным
+хешем. Если такой же файл уже есть (или у пользователя есть почти такое же
+изображение — перцептивные хеши отличаются не больше чем на
+MEDIA_PHASH_MAX_DISTANCE бит), новый аватар ссылается на существующий ассет.
+У ассета есть счётчик ссылок: изображения удаляются из Cloudinary только
+вместе с последним аватаром (release_avatar_media), причём не сразу, а
+через очередь отложенного удаления (media_cleanup).
+
+URL вариантов копируются в UserAvatar: file_path — "full" в WebP,
+thumbnail_url — миниатюра в WebP, variants — все варианты с public_id.
+
+Несколько процессов и хостов не загружают один ассет дважды: перед
+обработкой процесс атомарно захватывает ассет (upload_status='processing',
+claimed_by, claimed_at — _claim), а загруженные варианты сохраняет в ассете
+после каждой загрузки, продлевая захват. Файлы в spool-каталоге называются
+по id ассета и есть только на хосте, принявшем загрузку (spool_host), поэтому
+после перезапуска и для брошенных загрузок (захват не обновлялся дольше
+MEDIA_UPLOAD_CLAIM_TIMEOUT) в очередь ставятся только ассеты этого хоста
+(recover_pending_uploads). Отсутствие файла не считается ошибкой загрузки:
+захват снимается, и ассет ждёт процесс, у которого файл есть.
+
+Для локальной проверки без Cloudinary можно запустить заглушку его API
+(cloudinary_local.py) и указать её адрес в CLOUDINARY_UPLOAD_PREFIX.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import tempfile
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException, UploadFile
+from sqlalchemy import event, select, update, delete, or_, and_, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from image_processing import InvalidImage, OUTPUT_FORMATS, fingerprint_image, phash_distance, make_variants, run_in_pool
+from models import MediaAsset, UserAvatar
+from user_cache import invalidate_profile
+from media_cleanup import schedule_media_deletion, delete_media_later
+from utils_cloudinary import upload_image
+
+logger = logging.getLogger(__name__)
+
+MEDIA_SPOOL_DIR = os.getenv("MEDIA_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "avatar_uploads"))
+MEDIA_UPLOAD_WORKERS = int(os.getenv("MEDIA_UPLOAD_WORKERS", "2"))
+MEDIA_UPLOAD_RETRIES = int(os.getenv("MEDIA_UPLOAD_RETRIES", "5"))
+# Задержка перед повторной попыткой: MEDIA_UPLOAD_RETRY_DELAY * 2^(попытка-1) секунд
+MEDIA_UPLOAD_RETRY_DELAY = float(os.getenv("MEDIA_UPLOAD_RETRY_DELAY", "2"))
+MEDIA_MAX_UPLOAD_BYTES = int(os.getenv("MEDIA_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Максимальное расстояние Хэмминга между dHash, при котором изображения считаются одинаковыми
+MEDIA_PHASH_MAX_DISTANCE = int(os.getenv("MEDIA_PHASH_MAX_DISTANCE", "4"))
+MEDIA_CHUNK_SIZE = 256 * 1024
+# Захват загрузки, который не обновлялся дольше этого времени (с), считается
+# брошенным (процесс упал) и может быть перехвачен
+MEDIA_UPLOAD_CLAIM_TIMEOUT = float(os.getenv("MEDIA_UPLOAD_CLAIM_TIMEOUT", "600"))
+# Хост, в spool-каталоге которого лежат файлы принятых им загрузок
+MEDIA_HOST = os.getenv("MEDIA_HOST") or socket.gethostname()
+MEDIA_WORKER_ID = f"{MEDIA_HOST}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Что показывать вместо аватара, пока он загружается
+PENDING_AVATAR_URL = "/static/menu/img/avatar.png"
+
+UPLOAD_PENDING = "pending"
+UPLOAD_PROCESSING = "processing"  # только у ассета: загрузку выполняет процесс claimed_by
+UPLOAD_DONE = "uploaded"
+UPLOAD_FAILED = "failed"
+
+VARIANT_NAMES = [f"{name}.{fmt}" for name in ("full", "thumb") for fmt in OUTPUT_FORMATS]
+
+_queue: asyncio.Queue = None
+_recovery_task: asyncio.Task = None
+# Ассеты, которые сейчас обрабатывают воркеры этого процесса (захват у них общий)
+_active = set()
+
+stats = {
+    "queued": 0, "uploaded": 0, "retried": 0, "failed": 0, "invalid": 0, "recovered": 0,
+    "claimed_elsewhere": 0, "lost_claims": 0, "missing_files": 0,
+    "dedup_exact": 0, "dedup_similar": 0,
+}
+
+@dataclass
+class SpooledUpload:
+    path: str
+    content_hash: str
+    phash: str
+
+async def spool_upload(file: UploadFile):
+    """
+    Сохраняет загружаемый файл во временный каталог по частям, не держа его
+    целиком в памяти, проверяет, что это изображение, и считает его хеши.
+    При превышении MEDIA_MAX_UPLOAD_BYTES — 413, для файла, который не
+    является допустимым изображением, — 400.
+    """
+    os.makedirs(MEDIA_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(MEDIA_SPOOL_DIR, f"incoming-{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "wb") as out:
+            while chunk := await file.read(MEDIA_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MEDIA_MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File is too large")
+                digest.update(chunk)
+                await asyncio.to_thread(out.write, chunk)
+        phash = await run_in_pool(fingerprint_image, path)
+    except InvalidImage as e:
+        _remove(path)
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    except BaseException:
+        _remove(path)
+        raise
+    return SpooledUpload(path, digest.hexdigest(), phash)
+
+def _spool_path(asset_id: int):
+    return os.path.join(MEDIA_SPOOL_DIR, str(asset_id))
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def discard_spooled(upload: SpooledUpload):
+    """Удаляет сохранённый файл, если он не понадобился."""
+    _remove(upload.path)
+
+def _variant_paths(asset_id: int):
+    base = _spool_path(asset_id)
+    return {name: f"{base}.{name}" for name in VARIANT_NAMES if os.path.exists(f"{base}.{name}")}
+
+def _remove_spooled(asset_id: int):
+    _remove(_spool_path(asset_id))
+    for path in _variant_paths(asset_id).values():
+        _remove(path)
+
+def _after_commit(db: AsyncSession, callback):
+    """Вызывает callback после commit текущей транзакции db; при откате — не вызывает."""
+    done = False
+
+    def on_commit(session):
+        nonlocal done
+        if not done:
+            done = True
+            callback()
+
+    def on_rollback(session):
+        nonlocal done
+        done = True
+
+    event.listen(db.sync_session, "after_commit", on_commit, once=True)
+    event.listen(db.sync_session, "after_rollback", on_rollback, once=True)
+
+def _avatar_media_fields(asset: MediaAsset):
+    """Поля UserAvatar, которые копируются из ассета."""
+    if asset.upload_status != UPLOAD_DONE:
+        return {"file_path": PENDING_AVATAR_URL, "upload_status": UPLOAD_PENDING}
+    variants = asset.variants
+    return {
+        "file_path": variants["full.webp"]["url"],
+        "cloudinary_public_id": variants["full.webp"]["public_id"],
+        "thumbnail_url": variants["thumb.webp"]["url"],
+        "variants": variants,
+        "upload_status": UPLOAD_DONE,
+    }
+
+async def _acquire_asset(db: AsyncSession, asset_id: int):
+    # Ссылку можно добавить только живому ассету: при ref_count = 0 он уже удаляется
+    return (await db.execute(
+        update(MediaAsset)
+        .where(MediaAsset.id == asset_id, MediaAsset.ref_count > 0)
+        .values(ref_count=MediaAsset.ref_count + 1)
+        .returning(MediaAsset)
+    )).scalars().first()
+
+async def _find_duplicate(db: AsyncSession, user_id: int, upload: SpooledUpload):
+    """Существующий ассет для этой загрузки (уже с добавленной ссылкой) или None."""
+    asset_id = (await db.execute(
+        select(MediaAsset.id).where(MediaAsset.content_hash == upload.content_hash)
+    )).scalar()
+    if asset_id is not None:
+        asset = await _acquire_asset(db, asset_id)
+        if asset is not None:
+            stats["dedup_exact"] += 1
+            return asset
+
+    # Почти одинаковые изображения ищем только среди аватаров самого пользователя
+    candidates = (await db.execute(
+        select(MediaAsset.id, MediaAsset.phash)
+        .join(UserAvatar, UserAvatar.asset_id == MediaAsset.id)
+        .where(UserAvatar.user_id == user_id, MediaAsset.phash.is_not(None))
+        .distinct()
+    )).all()
+    matches = sorted(
+        (phash_distance(phash, upload.phash), asset_id) for asset_id, phash in candidates
+    )
+    for distance, asset_id in matches:
+        if distance > MEDIA_PHASH_MAX_DISTANCE:
+            break
+        asset = await _acquire_asset(db, asset_id)
+        if asset is not None:
+            stats["dedup_similar"] += 1
+            return asset
+    return None
+
+async def create_avatar_from_upload(db: AsyncSession, user_id: int, upload: SpooledUpload, **fields):
+    """
+    Создаёт аватар для загруженного файла. Если такое изображение уже есть,
+    аватар ссылается на него и загрузка в Cloudinary не выполняется; иначе
+    создаётся новый ассет и загрузка ставится в очередь. Фиксирует транзакцию.
+    """
+    asset = await _find_duplicate(db, user_id, upload)
+    created = asset is None
+    if created:
+        try:
+            async with db.begin_nested():
+                asset = MediaAsset(content_hash=upload.content_hash, phash=upload.phash, spool_host=MEDIA_HOST)
+                db.add(asset)
+        except IntegrityError:
+            # Такой же файл только что загрузили параллельно
+            asset = await _find_duplicate(db, user_id, upload)
+            created = asset is None
+            if created:
+                raise
+
+    avatar = UserAvatar(user_id=user_id, asset_id=asset.id, **fields, **_avatar_media_fields(asset))
+    db.add(avatar)
+    await db.commit()
+    await db.refresh(avatar)
+
+    if created:
+        os.replace(upload.path, _spool_path(asset.id))
+        stats["queued"] += 1
+        _ensure_workers()
+        _queue.put_nowait((asset.id, 1))
+    else:
+        discard_spooled(upload)
+    return avatar
+
+async def release_avatar_media(db: AsyncSession, avatar: UserAvatar):
+    """
+    Освобождает изображения удалённого аватара (вызывается после удаления
+    строки в той же транзакции): если на ассет больше не ссылаются другие
+    аватары, его изображения ставятся в очередь на удаление из Cloudinary
+    (media_cleanup). Возвращает поставленные в очередь public_id.
+    """
+    if avatar.asset_id is None:
+        # Аватары, загруженные до появления ассетов, владеют изображениями сами
+        public_ids = {v["public_id"] for v in (avatar.variants or {}).values() if v.get("public_id")}
+        if avatar.cloudinary_public_id:
+            public_ids.add(avatar.cloudinary_public_id)
+        public_ids = sorted(public_ids)
+        await schedule_media_deletion(db, public_ids)
+        return public_ids
+
+    await db.execute(
+        update(MediaAsset)
+        .where(MediaAsset.id == avatar.asset_id)
+        .values(ref_count=MediaAsset.ref_count - 1)
+    )
+    released = (await db.execute(
+        delete(MediaAsset)
+        .where(MediaAsset.id == avatar.asset_id, MediaAsset.ref_count <= 0)
+        .returning(MediaAsset.variants, MediaAsset.upload_status)
+    )).first()
+    if released is None:
+        return []
+    if released.upload_status != UPLOAD_DONE:
+        # Загрузка ещё не завершена — отменяем её (загруженное воркер удалит сам).
+        # Файл удаляется только после commit: при откате ассет остаётся и его
+        # загрузка должна завершиться
+        asset_id = avatar.asset_id
+        _after_commit(db, lambda: _remove_spooled(asset_id))
+    public_ids = sorted(v["public_id"] for v in (released.variants or {}).values())
+    await schedule_media_deletion(db, public_ids)
+    return public_ids
+
+async def _claim(asset_id: int):
+    """
+    Атомарно захватывает загрузку ассета этим процессом. Возвращает уже
+    загруженные варианты или None, если ассет загружает другой процесс, он
+    уже загружен или удалён.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=MEDIA_UPLOAD_CLAIM_TIMEOUT)
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(
+            update(MediaAsset)
+            .where(MediaAsset.id == asset_id, or_(
+                MediaAsset.upload_status == UPLOAD_PENDING,
+                and_(MediaAsset.upload_status == UPLOAD_PROCESSING,
+                     or_(MediaAsset.claimed_by == MEDIA_WORKER_ID, MediaAsset.claimed_at < stale)),
+            ))
+            .values(upload_status=UPLOAD_PROCESSING, claimed_by=MEDIA_WORKER_ID, claimed_at=now)
+            .returning(MediaAsset.variants)
+            .execution_options(synchronize_session=False)
+        )).first()
+        await db.commit()
+    return None if row is None else dict(row.variants or {})
+
+async def _release_claim(asset_id: int):
+    """Возвращает ассет в очередь для других процессов (claimed_at остаётся — повтор не раньше таймаута)."""
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(MediaAsset)
+            .where(MediaAsset.id == asset_id, MediaAsset.claimed_by == MEDIA_WORKER_ID)
+            .values(upload_status=UPLOAD_PENDING, claimed_by=None)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+async def _save_progress(asset_id: int, uploaded):
+    """Сохраняет загруженные варианты и продлевает захват; False — захват потерян."""
+    async with AsyncSessionLocal() as db:
+        saved = (await db.execute(
+            update(MediaAsset)
+            .where(MediaAsset.id == asset_id, MediaAsset.claimed_by == MEDIA_WORKER_ID)
+            .values(variants=uploaded, claimed_at=datetime.utcnow())
+            .returning(MediaAsset.id)
+            .execution_options(synchronize_session=False)
+        )).first() is not None
+        await db.commit()
+    return saved
+
+async def _upload(asset_id: int, attempt: int):
+    uploaded = await _claim(asset_id)
+    if uploaded is None:
+        stats["claimed_elsewhere"] += 1
+        return
+
+    variants = _variant_paths(asset_id)
+    if len(variants) < len(VARIANT_NAMES):
+        path = _spool_path(asset_id)
+        if not os.path.exists(path):
+            # Файл может быть у процесса на другом хосте — это не ошибка загрузки
+            logger.warning(f"Файл ассета {asset_id} не найден в {MEDIA_SPOOL_DIR}, загрузка отложена")
+            stats["missing_files"] += 1
+            await _release_claim(asset_id)
+            return
+        try:
+            variants = await run_in_pool(make_variants, path, path)
+        except InvalidImage as e:
+            logger.warning(f"Ассет {asset_id} не удалось обработать: {e}")
+            stats["invalid"] += 1
+            if await _finish(asset_id, None):
+                _remove_spooled(asset_id)
+            return
+        # Оригинал больше не нужен: загружаются только варианты
+        _remove(path)
+
+    for name, variant_path in variants.items():
+        if name in uploaded:
+            continue
+        # Cloudinary SDK синхронный — выполняем его в потоке, не блокируя event loop
+        url, public_id = await asyncio.to_thread(upload_image, variant_path)
+        if not (url and public_id):
+            break
+        uploaded[name] = {"url": url, "public_id": public_id}
+        if not await _save_progress(asset_id, uploaded):
+            # Ассет удалён или перехвачен другим процессом; варианты, сохранённые
+            # раньше, удалит или использует он, а этот больше никому не нужен
+            logger.warning(f"Захват загрузки ассета {asset_id} потерян")
+            stats["lost_claims"] += 1
+            await delete_media_later([public_id])
+            return
+    else:
+        if await _finish(asset_id, uploaded):
+            _remove_spooled(asset_id)
+        return
+
+    if attempt < MEDIA_UPLOAD_RETRIES:
+        delay = MEDIA_UPLOAD_RETRY_DELAY * 2 ** (attempt - 1)
+        logger.warning(f"Загрузка ассета {asset_id} не удалась (попытка {attempt}), повтор через {delay} с")
+        stats["retried"] += 1
+        asyncio.get_running_loop().call_later(delay, _queue.put_nowait, (asset_id, attempt + 1))
+        return
+
+    logger.error(f"Загрузка ассета {asset_id} не удалась после {attempt} попыток")
+    if await _finish(asset_id, None):
+        _remove_spooled(asset_id)
+
+async def _finish(asset_id: int, variants):
+    """
+    Записывает результат загрузки (variants=None — ошибка). Возвращает
+    False, если загрузку перехватил другой процесс (тогда файлы нужны ему).
+    """
+    async with AsyncSessionLocal() as db:
+        asset = (await db.execute(
+            select(MediaAsset).where(MediaAsset.id == asset_id).with_for_update()
+        )).scalars().first()
+        if asset is None:
+            # Все аватары удалили, пока ассет загружался — файлы больше не нужны
+            await schedule_media_deletion(db, [variant["public_id"] for variant in (variants or {}).values()])
+            await db.commit()
+            return True
+        if asset.claimed_by != MEDIA_WORKER_ID:
+            # Захват устарел и загрузку перехватил другой процесс — результат за ним
+            stats["lost_claims"] += 1
+            return False
+        user_ids = (await db.execute(
+            select(UserAvatar.user_id).where(UserAvatar.asset_id == asset_id).distinct()
+        )).scalars().all()
+        if variants:
+            asset.variants = variants
+            asset.upload_status = UPLOAD_DONE
+            asset.claimed_by = asset.claimed_at = None
+            await db.execute(
+                update(UserAvatar).where(UserAvatar.asset_id == asset_id).values(**_avatar_media_fields(asset))
+            )
+            stats["uploaded"] += 1
+        else:
+            # Ассет удаляется, чтобы следующая загрузка того же файла попробовала снова;
+            # варианты, загруженные до ошибки, удаляются из Cloudinary
+            await schedule_media_deletion(db, [variant["public_id"] for variant in (asset.variants or {}).values()])
+            await db.execute(
+                update(UserAvatar).where(UserAvatar.asset_id == asset_id)
+                .values(upload_status=UPLOAD_FAILED, asset_id=None)
+            )
+            await db.execute(delete(MediaAsset).where(MediaAsset.id == asset_id))
+            stats["failed"] += 1
+        await db.commit()
+    # Аватар мог стать основным (админ) до окончания загрузки
+    for user_id in user_ids:
+        await invalidate_profile(user_id)
+    return True
+
+async def _worker():
+    while True:
+        asset_id, attempt = await _queue.get()
+        try:
+            if asset_id in _active:
+                stats["claimed_elsewhere"] += 1
+                continue
+            _active.add(asset_id)
+            try:
+                await _upload(asset_id, attempt)
+            finally:
+                _active.discard(asset_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка фоновой загрузки ассета {asset_id}: {e}")
+        finally:
+            _queue.task_done()
+
+async def recover_pending_uploads(startup: bool = False):
+    """
+    Ставит в очередь загрузки этого хоста (файлы есть только в его
+    spool-каталоге), которые никто не выполняет: захват брошен дольше
+    MEDIA_UPLOAD_CLAIM_TIMEOUT, а при старте — и все ожидающие. Кто из
+    процессов хоста выполнит загрузку, решает атомарный захват (_claim).
+    """
+    stale = datetime.utcnow() - timedelta(seconds=MEDIA_UPLOAD_CLAIM_TIMEOUT)
+    waiting = MediaAsset.upload_status == UPLOAD_PENDING
+    if not startup:
+        waiting = and_(waiting, func.coalesce(MediaAsset.claimed_at, MediaAsset.created_at) < stale)
+    async with AsyncSessionLocal() as db:
+        asset_ids = (await db.execute(
+            select(MediaAsset.id).where(
+                # spool_host пуст у ассетов, созданных до появления захвата
+                or_(MediaAsset.spool_host == MEDIA_HOST, MediaAsset.spool_host.is_(None)),
+                or_(waiting, and_(MediaAsset.upload_status == UPLOAD_PROCESSING, MediaAsset.claimed_at < stale)),
+            )
+        )).scalars().all()
+    for asset_id in asset_ids:
+        stats["recovered"] += 1
+        _queue.put_nowait((asset_id, 1))
+
+async def _recovery_loop():
+    while True:
+        await asyncio.sleep(MEDIA_UPLOAD_CLAIM_TIMEOUT)
+        try:
+            await recover_pending_uploads()
+        except Exception as e:
+            logger.error(f"Не удалось проверить брошенные загрузки аватаров: {e}")
+
+def _ensure_workers():
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue()
+        for _ in range(MEDIA_UPLOAD_WORKERS):
+            asyncio.create_task(_worker())
+
+async def start_media_workers():
+    """Запускает воркеры загрузки (вызывается при старте приложения)."""
+    global _recovery_task
+    _ensure_workers()
+    try:
+        await recover_pending_uploads(startup=True)
+    except Exception as e:
+        logger.error(f"Не удалось восстановить незавершённые загрузки аватаров: {e}")
+    if _recovery_task is None:
+        _recovery_task = asyncio.create_task(_recovery_loop())
+
+def media_stats():
+    return {
+        **stats,
+        "workers": MEDIA_UPLOAD_WORKERS,
+        "queue_size": _queue.qsize() if _queue is not None else 0,
+    }
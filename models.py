@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Date, Text, ForeignKey, Table, DateTime, Boolean, func
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, SmallInteger, String, Date, Text, ForeignKey, Table, DateTime, Boolean, Index, Computed, JSON, func, cast
+from sqlalchemy.dialects.postgresql import TSVECTOR, JSONB
+from sqlalchemy.orm import relationship, validates, deferred
 from datetime import datetime
 from database import Base
 from passlib.context import CryptContext
@@ -7,10 +8,34 @@ from passlib.context import CryptContext
 # Создаём контекст для хеширования паролей
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+def birthday_ordinal(birthday):
+    """Порядковый номер дня рождения без учёта года: month * 100 + day (0101..1231)."""
+    if birthday is None:
+        return None
+    return birthday.month * 100 + birthday.day
+
+# Конфигурация полнотекстового поиска: без стемминга, подходит для имён на любом языке
+SEARCH_CONFIG = 'simple'
+
+def contact_search_document_sql(table_prefix=""):
+    """
+    SQL-выражение поискового документа контакта (имя, фамилия, email).
+    Одно и то же выражение используется в колонке search_vector, в trigram-индексе
+    и в запросах поиска, иначе PostgreSQL не применит индекс по выражению.
+    """
+    p = f"{table_prefix}." if table_prefix else ""
+    return (f"coalesce({p}first_name, '') || ' ' || coalesce({p}last_name, '') "
+            f"|| ' ' || coalesce({p}email, '')")
+
+def phone_digits_sql(table_prefix=""):
+    """SQL-выражение номера телефона, очищенного от всего, кроме цифр."""
+    p = f"{table_prefix}." if table_prefix else ""
+    return rf"regexp_replace({p}number, '\D', '', 'g')"
+
 # Association table for many-to-many Contact <-> Group
 contact_group = Table(
     'contact_group', Base.metadata,
-    Column('contact_id', Integer, ForeignKey('contacts.id'), primary_key=True),
+    Column('contact_id', Integer, ForeignKey('contacts.id', ondelete='CASCADE'), primary_key=True),
     Column('group_id', Integer, ForeignKey('groups.id'), primary_key=True)
 )
 
@@ -36,22 +61,90 @@ class User(Base):
     def verify_password(self, plain_password):
         return pwd_context.verify(plain_password, self.hashed_password)
 
+class MediaAsset(Base):
+    """
+    Изображение, загруженное в Cloudinary (набор вариантов). Одинаковые
+    загрузки используют один ассет; ref_count — число аватаров, которые на
+    него ссылаются (см. media_pipeline).
+    """
+    __tablename__ = 'media_assets'
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), unique=True, nullable=False)  # sha256 исходного файла
+    phash = Column(String(16), nullable=True)  # перцептивный хеш (dHash)
+    variants = Column(JSON, nullable=True)  # {"full.webp": {"url", "public_id"}, ...}
+    upload_status = Column(String, default='pending', nullable=False)  # 'pending', 'processing', 'uploaded'
+    ref_count = Column(Integer, default=1, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Фоновая загрузка: хост, где лежит исходный файл, и процесс, который её выполняет
+    spool_host = Column(String, nullable=True)
+    claimed_by = Column(String, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+
+    avatars = relationship('UserAvatar', back_populates='asset')
+
+    __table_args__ = (
+        # Поиск ассетов по URL варианта (media_cleanup._referenced_urls)
+        Index('ix_media_assets_variants', cast(variants, JSONB).label('variants_jsonb'),
+              postgresql_using='gin', postgresql_ops={'variants_jsonb': 'jsonb_path_ops'}),
+    )
+
+class MediaDeletion(Base):
+    """Изображение Cloudinary, ожидающее удаления (см. media_cleanup)."""
+    __tablename__ = 'media_deletions'
+    id = Column(Integer, primary_key=True, index=True)
+    public_id = Column(String, unique=True, nullable=False)
+    # URL, по которому изображение поставлено в очередь (schedule_url_deletion):
+    # перед удалением воркер проверяет, что на него больше не ссылаются
+    url = Column(String, nullable=True)
+    status = Column(String, default='pending', server_default='pending', nullable=False)  # 'pending', 'deleting'
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    last_error = Column(Text, nullable=True)
+    claimed_by = Column(String, nullable=True)  # процесс, который сейчас удаляет изображение
+    claimed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class EmailOutbox(Base):
+    """Письмо, ожидающее отправки (см. email_outbox)."""
+    __tablename__ = 'email_outbox'
+    id = Column(Integer, primary_key=True, index=True)
+    to_email = Column(String, nullable=False)
+    subject = Column(String, nullable=True)
+    message = Column(Text, nullable=False)  # письмо целиком (RFC 5322)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    last_error = Column(Text, nullable=True)
+    claimed_by = Column(String, nullable=True)  # процесс, который сейчас отправляет письмо
+    claimed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class UserAvatar(Base):
     __tablename__ = 'user_avatars'
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    file_path = Column(String, nullable=False)
+    file_path = Column(String, nullable=False, index=True)
     cloudinary_public_id = Column(String, nullable=True)  # Добавляем поле для хранения public_id из Cloudinary
     is_approved = Column(Integer, default=0)  # 0 - not approved, 1 - approved
     is_main = Column(Integer, default=0)      # 0 - not main, 1 - main
     request_type = Column(String, default='upload')  # 'upload' or 'set_main'
     request_status = Column(Integer, default=0)  # 0 - not pending, 1 - pending, 2 - rejected, 3 - approved
+    upload_status = Column(String, default='uploaded', server_default='uploaded', index=True)  # 'pending', 'uploaded', 'failed' (см. media_pipeline)
+    thumbnail_url = Column(String, nullable=True, index=True)  # миниатюра для меню и списков
+    variants = Column(JSON, nullable=True)  # {"full.webp": {"url", "public_id"}, "thumb.avif": ...}
+    asset_id = Column(Integer, ForeignKey('media_assets.id'), nullable=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     user = relationship('User', back_populates='avatars')
+    asset = relationship('MediaAsset', back_populates='avatars')
     messages = relationship('AvatarRequestMessage', back_populates='avatar', cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Поиск аватаров по URL варианта (media_cleanup._referenced_urls)
+        Index('ix_user_avatars_variants', cast(variants, JSONB).label('variants_jsonb'),
+              postgresql_using='gin', postgresql_ops={'variants_jsonb': 'jsonb_path_ops'}),
+    )
+
 class AvatarRequestMessage(Base):
     __tablename__ = 'avatar_request_messages'
     id = Column(Integer, primary_key=True, index=True)
@@ -75,23 +168,71 @@ class Contact(Base):
     last_name = Column(String)
     email = Column(String, nullable=False)
     birthday = Column(Date, nullable=False)
+    # Денормализованный день рождения (month * 100 + day) для поиска по индексу
+    birthday_md = Column(SmallInteger, nullable=True, index=True)
     extra_info = Column(Text)
+    # Поисковый документ, который PostgreSQL поддерживает сам (generated column).
+    # Trigram-индексы (pg_trgm) создаются в db_migrations после установки расширения.
+    search_vector = deferred(Column(
+        TSVECTOR,
+        Computed(f"to_tsvector('{SEARCH_CONFIG}', {contact_search_document_sql()})", persisted=True)
+    ))
+
+    __table_args__ = (
+        Index('ix_contacts_user_birthday_md', 'user_id', 'birthday_md'),
+        # Сортировка контактов пользователя по имени без учёта регистра
+        Index('ix_contacts_user_lower_first_name', user_id, func.lower(first_name), id),
+        # Keyset-пагинация по всем контактам (superadmin без user_id)
+        Index('ix_contacts_lower_first_name_id', func.lower(first_name), id),
+        Index('ix_contacts_search_vector', search_vector, postgresql_using='gin'),
+    )
 
     user = relationship('User', back_populates='contacts')
-    phone_numbers = relationship('PhoneNumber', back_populates='contact', cascade="all, delete-orphan")
-    avatars = relationship('Avatar', back_populates='contact', cascade="all, delete-orphan")
-    photos = relationship('Photo', back_populates='contact', cascade="all, delete-orphan")
-    groups = relationship('Group', secondary=contact_group, back_populates='contacts')
+    # Телефоны, аватары, фото и членство в группах удаляет сама БД (ON DELETE
+    # CASCADE): при удалении контакта ORM не загружает и не удаляет их по одному
+    phone_numbers = relationship('PhoneNumber', back_populates='contact', cascade="all, delete-orphan", passive_deletes=True)
+    avatars = relationship('Avatar', back_populates='contact', cascade="all, delete-orphan", passive_deletes=True)
+    photos = relationship('Photo', back_populates='contact', cascade="all, delete-orphan", passive_deletes=True)
+    groups = relationship('Group', secondary=contact_group, back_populates='contacts', passive_deletes=True)
+
+    # birthday_md всегда обновляется вместе с birthday (при создании и изменении)
+    @validates('birthday')
+    def _sync_birthday_md(self, key, value):
+        self.birthday_md = birthday_ordinal(value)
+        return value
 
 class PhoneNumber(Base):
     __tablename__ = 'phone_numbers'
     id = Column(Integer, primary_key=True, index=True)
-    contact_id = Column(Integer, ForeignKey('contacts.id'))
+    contact_id = Column(Integer, ForeignKey('contacts.id', ondelete='CASCADE'), index=True)
     number = Column(String, nullable=False)
     label = Column(String, default="other")  # e.g., home, work, mobile
 
     contact = relationship('Contact', back_populates='phone_numbers')
 
+class ContactImportJob(Base):
+    """Фоновый импорт контактов из файла (см. contact_import)."""
+    __tablename__ = 'contact_import_jobs'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # владелец импортируемых контактов
+    created_by = Column(Integer, ForeignKey('users.id'), nullable=False)
+    format = Column(String, nullable=False)  # 'csv', 'vcard'
+    filename = Column(String, nullable=True)
+    status = Column(String, default='queued', nullable=False)  # 'queued', 'running', 'done', 'failed'
+    total_bytes = Column(Integer, default=0, nullable=False)
+    bytes_read = Column(Integer, default=0, nullable=False)
+    rows_processed = Column(Integer, default=0, nullable=False)
+    imported = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    errors = Column(JSON, nullable=True)  # [{"row": номер строки, "error": текст}, ...]
+    error = Column(Text, nullable=True)  # ошибка, из-за которой импорт остановлен
+    file_host = Column(String, nullable=True)  # хост, на котором лежит загруженный файл
+    claimed_by = Column(String, nullable=True)  # процесс, который ведёт задачу
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)  # обновляется владельцем, пока задача жива
+    finished_at = Column(DateTime, nullable=True)
+
 class Group(Base):
     __tablename__ = 'groups'
     id = Column(Integer, primary_key=True, index=True)
@@ -101,8 +242,8 @@ class Group(Base):
 class Avatar(Base):
     __tablename__ = 'avatars'
     id = Column(Integer, primary_key=True, index=True)
-    contact_id = Column(Integer, ForeignKey('contacts.id'))
-    file_path = Column(String)  # путь к файлу аватарки контакта
+    contact_id = Column(Integer, ForeignKey('contacts.id', ondelete='CASCADE'), index=True)
+    file_path = Column(String, index=True)  # путь к файлу аватарки контакта
     is_main = Column(Integer, default=0)  # 1 если основная, 0 иначе
     show = Column(Integer, default=1)  # 1 если показывать, 0 иначе
 
@@ -111,8 +252,8 @@ class Avatar(Base):
 class Photo(Base):
     __tablename__ = 'photos'
     id = Column(Integer, primary_key=True, index=True)
-    contact_id = Column(Integer, ForeignKey('contacts.id'))
-    file_path = Column(String)
+    contact_id = Column(Integer, ForeignKey('contacts.id', ondelete='CASCADE'), index=True)
+    file_path = Column(String, index=True)
     is_main = Column(Integer, default=0)
     show = Column(Integer, default=1)
 
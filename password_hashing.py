@@ -0,0 +1,77 @@
+"""
+Хеширование и проверка паролей (bcrypt) вне event loop.
+
+bcrypt занимает ~250 мс CPU на операцию. Вызванный прямо в async-обработчике,
+он останавливает все остальные запросы, поэтому операции выполняются в
+отдельном ограниченном пуле потоков (bcrypt отпускает GIL, так что потоки
+работают параллельно). Число ожидающих операций ограничено: при переполнении
+сразу выбрасывается PasswordHashingBusy (ответ 503), и поток входов не
+может занять все ресурсы сервера.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from models import pwd_context
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Сколько операций может одновременно выполняться и ждать в очереди
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8)))
+PASSWORD_HASH_RETRY_AFTER = 1
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_pending = 0
+
+stats = {
+    "submitted": 0,
+    "completed": 0,
+    "rejected": 0,
+    "max_pending": 0,
+    "total_wait_ms": 0.0,
+    "total_run_ms": 0.0,
+}
+
+class PasswordHashingBusy(Exception):
+    """Очередь хеширования паролей переполнена, запрос нужно повторить позже."""
+
+def _timed(func, submitted_at, *args):
+    started_at = time.monotonic()
+    try:
+        return func(*args)
+    finally:
+        finished_at = time.monotonic()
+        stats["total_wait_ms"] += (started_at - submitted_at) * 1000
+        stats["total_run_ms"] += (finished_at - started_at) * 1000
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= PASSWORD_HASH_MAX_PENDING:
+        stats["rejected"] += 1
+        raise PasswordHashingBusy()
+    _pending += 1
+    stats["submitted"] += 1
+    stats["max_pending"] = max(stats["max_pending"], _pending)
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, _timed, func, time.monotonic(), *args)
+    finally:
+        _pending -= 1
+        stats["completed"] += 1
+
+async def hash_password(password: str) -> str:
+    return await _run(pwd_context.hash, password)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run(pwd_context.verify, plain_password, hashed_password)
+
+def hashing_stats():
+    completed = stats["completed"]
+    return {
+        **stats,
+        "workers": PASSWORD_HASH_WORKERS,
+        "max_pending_limit": PASSWORD_HASH_MAX_PENDING,
+        "pending": _pending,
+        "avg_wait_ms": round(stats["total_wait_ms"] / completed, 2) if completed else 0,
+        "avg_run_ms": round(stats["total_run_ms"] / completed, 2) if completed else 0,
+    }
@@ -1,63 +1,316 @@
-from fastapi import FastAPI, Request, Response, Depends, HTTPException, status
-import redis.asyncio as redis
-from fastapi_limiter import FastAPILimiter
-from fastapi_limiter.depends import RateLimiter
+"""
+Ограничение частоты запросов (rate limiting).
+
+Алгоритм — GCRA (generic cell rate algorithm): для каждого клиента хранится
+одно число, TAT (theoretical arrival time), — время, к которому «освободится»
+его лимит. Это эквивалент скользящего окна без хранения отдельных запросов.
+
+- Политики задаются по маршрутам и ролям (RATE_LIMIT_POLICIES), например
+  25 запросов в минуту на /users/me для обычных пользователей.
+- Общий лимит для всех процессов считается в Redis одним Lua-скриптом
+  (атомарно, один round trip).
+- Перед походом в Redis выполняется локальная проверка: локальный счётчик
+  видит только запросы своего процесса, то есть не больше общего, поэтому
+  если отказ следует уже из него (или Redis недавно ответил отказом и время
+  ещё не вышло), клиенту отказывают без обращения к Redis.
+- Пока Redis недоступен, решение принимается по локальному счётчику —
+  лимиты приблизительные, отдельно для каждого процесса.
+- Без настроенного Redis (REDIS_URL) ограничение, как и раньше, выключено;
+  RATE_LIMIT_WITHOUT_REDIS=True включает локальные лимиты в каждом процессе.
+- Время принятия решения собирается в гистограмму (rate_limit_stats).
+"""
+from fastapi import Request, Response, Depends, HTTPException, status
+import json
+import logging
+import math
 import os
+import time
 from dotenv import load_dotenv
-import asyncio
-from typing import Optional
+
+from auth import get_current_user
+from models import User
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Получаем URL Redis из переменных окружения
-# Для Render.com проверяем как REDIS_URL, так и RENDER_REDIS_URL
-REDIS_URL = os.getenv("REDIS_URL") or os.getenv("RENDER_REDIS_URL")
+# Redis-клиент общий для всего приложения (см. redis_client.py)
+from redis_client import async_redis_client, call_redis, RedisUnavailable, REDIS_CONFIGURED_URL as REDIS_URL
+
+logger = logging.getLogger(__name__)
 
 # Проверяем, настроено ли ограничение запросов или нет
 RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True").lower() in ("true", "1", "t")
+# Считать лимиты локально в каждом процессе, если Redis не настроен (по умолчанию — не ограничивать)
+RATE_LIMIT_WITHOUT_REDIS = os.getenv("RATE_LIMIT_WITHOUT_REDIS", "False").lower() in ("true", "1", "t")
+
+REDIS_KEY_PREFIX = "ratelimit:"
+
+# Политики: маршрут -> роль -> "запросов/секунд" (None — без ограничения).
+# Роль "default" применяется к ролям, для которых политика не задана.
+DEFAULT_POLICIES = {
+    "users_me": {"default": "25/60", "admin": "100/60", "superadmin": None},
+}
+
+class RateLimitPolicy:
+    """Лимит times запросов за seconds секунд (с допустимым всплеском до times)."""
+
+    def __init__(self, times: int, seconds: float):
+        self.times = times
+        self.seconds = seconds
+        # Интервал между запросами при равномерном потоке
+        self.emission_interval = seconds / times
+
+    @classmethod
+    def parse(cls, value):
+        """Разбирает "запросов/секунд"; ValueError, если значение некорректно."""
+        if value is None:
+            return None
+        times, sep, seconds = str(value).partition("/")
+        if not sep:
+            raise ValueError(f"ожидается \"запросов/секунд\", получено {value!r}")
+        times, seconds = int(times), float(seconds)
+        if times <= 0 or not (0 < seconds < math.inf):
+            raise ValueError(f"число запросов и период должны быть положительными, получено {value!r}")
+        return cls(times, seconds)
+
+    def __repr__(self):
+        return f"{self.times}/{self.seconds:g}"
+
+def _load_policies():
+    policies = {
+        route: {role: RateLimitPolicy.parse(value) for role, value in roles.items()}
+        for route, roles in DEFAULT_POLICIES.items()
+    }
+    override = os.getenv("RATE_LIMIT_POLICIES")
+    if not override:
+        return policies
+    # Например: {"users_me": {"default": "10/60", "admin": "50/60"}}.
+    # Некорректные записи пропускаются (для них остаются значения по умолчанию),
+    # чтобы ошибка в настройке не останавливала приложение
+    try:
+        override = json.loads(override)
+        if not isinstance(override, dict):
+            raise ValueError("ожидается объект {маршрут: {роль: лимит}}")
+    except ValueError as e:
+        logger.error(f"Некорректный RATE_LIMIT_POLICIES, используются значения по умолчанию: {e}")
+        return policies
+    for route, roles in override.items():
+        if not isinstance(roles, dict):
+            logger.error(f"RATE_LIMIT_POLICIES: для {route} ожидается объект {{роль: лимит}}, запись пропущена")
+            continue
+        for role, value in roles.items():
+            try:
+                policies.setdefault(route, {})[role] = RateLimitPolicy.parse(value)
+            except ValueError as e:
+                logger.error(f"RATE_LIMIT_POLICIES: лимит {route}/{role} пропущен: {e}")
+    return policies
+
+policies = _load_policies()
+
+def get_policy(route: str, role: str):
+    roles = policies.get(route, {})
+    return roles[role] if role in roles else roles.get("default")
+
+# GCRA в Redis. KEYS[1] — ключ клиента, ARGV[1] — интервал между запросами
+# (мс), ARGV[2] — период лимита (мс). Время берётся у Redis, чтобы все
+# процессы считали по одним часам. Возвращает {разрешено, сколько ждать (мс),
+# сколько запросов ещё осталось}.
+GCRA_SCRIPT = """
+local interval = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local wait = new_tat - period - now
+if wait > 0 then
+    return {0, wait, 0}
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', new_tat - now)
+return {1, 0, math.floor((period - (new_tat - now)) / interval)}
+"""
+
+_gcra_script = async_redis_client.register_script(GCRA_SCRIPT)
+
+class LocalGCRA:
+    """
+    Тот же GCRA в памяти процесса. Используется как предварительная проверка
+    перед Redis и как замена Redis, пока он недоступен.
+    """
+    MAX_KEYS = 10000
+
+    def __init__(self):
+        self.tats = {}  # key -> TAT (time.monotonic())
+        # key -> до какого момента Redis отказывает этому клиенту
+        self.blocked_until = {}
 
-# Флаг для проверки успешности подключения к Redis
-redis_connected = False
+    def check(self, key: str, policy: RateLimitPolicy, commit: bool = True):
+        """Возвращает 0, если запрос разрешён, иначе через сколько секунд повторить."""
+        now = time.monotonic()
+        blocked_until = self.blocked_until.get(key)
+        if blocked_until is not None:
+            if now < blocked_until:
+                return blocked_until - now
+            del self.blocked_until[key]
+
+        tat = max(self.tats.get(key, now), now)
+        new_tat = tat + policy.emission_interval
+        wait = new_tat - policy.seconds - now
+        if wait > 0:
+            return wait
+        if commit:
+            self.record(key, new_tat, now)
+        return 0
+
+    def record(self, key: str, new_tat: float, now: float):
+        self.tats[key] = new_tat
+        if len(self.tats) > self.MAX_KEYS:
+            # Ключи с прошедшим TAT эквивалентны отсутствующим
+            self.tats = {k: v for k, v in self.tats.items() if v > now}
+            self.blocked_until = {k: v for k, v in self.blocked_until.items() if v > now}
+
+    def block(self, key: str, seconds: float):
+        self.blocked_until[key] = time.monotonic() + seconds
+
+local_limiter = LocalGCRA()
+
+# Гистограмма времени принятия решения (мс) по источнику решения:
+# local — отказ без Redis, redis — решение Redis, fallback — Redis недоступен
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 2, 5, 10, 25, 50, 100)
+
+def _new_latency_stats():
+    return {
+        "count": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "buckets": {str(b): 0 for b in LATENCY_BUCKETS_MS} | {"+Inf": 0},
+    }
+
+stats = {
+    "allowed": 0,
+    "rejected": 0,
+    "latency": {source: _new_latency_stats() for source in ("local", "redis", "fallback")},
+}
+
+def _observe(source: str, started_at: float, allowed: bool):
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+    latency = stats["latency"][source]
+    latency["count"] += 1
+    latency["total_ms"] += elapsed_ms
+    latency["max_ms"] = max(latency["max_ms"], elapsed_ms)
+    bucket = next((str(b) for b in LATENCY_BUCKETS_MS if elapsed_ms <= b), "+Inf")
+    latency["buckets"][bucket] += 1
+    stats["allowed" if allowed else "rejected"] += 1
+
+def rate_limit_stats():
+    return {
+        "enabled": RATE_LIMIT_ENABLED and bool(REDIS_URL or RATE_LIMIT_WITHOUT_REDIS),
+        "redis": bool(REDIS_URL),
+        "policies": {route: {role: repr(p) if p else None for role, p in roles.items()}
+                     for route, roles in policies.items()},
+        "allowed": stats["allowed"],
+        "rejected": stats["rejected"],
+        "latency": {
+            source: {
+                **latency,
+                "avg_ms": round(latency["total_ms"] / latency["count"], 3) if latency["count"] else 0,
+            }
+            for source, latency in stats["latency"].items()
+        },
+        "local_keys": len(local_limiter.tats),
+        "local_blocked": len(local_limiter.blocked_until),
+    }
 
 async def init_limiter():
     """
-    Инициализация rate limiter при запуске приложения
+    Инициализация rate limiter при запуске приложения: загружает Lua-скрипт
+    в Redis, чтобы первые запросы выполнялись через EVALSHA.
     """
-    global redis_connected
-    
-    # Если ограничение запросов отключено или Redis URL не задан, пропускаем инициализацию
     if not RATE_LIMIT_ENABLED:
         print("Rate limiter отключен в настройках")
         return
-    
+
     if not REDIS_URL:
-        print("REDIS_URL не задан. Rate limiter будет работать без ограничений.")
+        if RATE_LIMIT_WITHOUT_REDIS:
+            print("REDIS_URL не задан. Rate limiter считает лимиты локально в каждом процессе.")
+        else:
+            print("REDIS_URL не задан. Rate limiter отключен (RATE_LIMIT_WITHOUT_REDIS=True включает локальные лимиты).")
         return
-    
+
     try:
-        print(f"Попытка подключения к Redis по адресу: {REDIS_URL}")
-        redis_instance = redis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
-        await FastAPILimiter.init(redis_instance)
-        redis_connected = True
+        await call_redis(lambda: async_redis_client.script_load(GCRA_SCRIPT), deadline=2)
         print("Rate limiter успешно инициализирован с Redis")
-    except Exception as e:
+    except RedisUnavailable as e:
+        # Скрипт будет загружен при первом вызове (EVALSHA -> NOSCRIPT -> EVAL)
         print(f"Ошибка при инициализации rate limiter: {e}")
-        print("Приложение продолжит работу без ограничения запросов")
-        redis_connected = False
+        print("До восстановления Redis используется локальное ограничение запросов")
+
+def _client_identity(request: Request, user: User):
+    if user is not None and user.id is not None:
+        return f"user:{user.id}"
+    forwarded = request.headers.get("X-Forwarded-For")
+    ip = forwarded.split(",")[0] if forwarded else request.client.host
+    return f"ip:{ip}"
 
-# Создаем зависимости для разных типов ограничения
-# Ограничение: 5 запросов в минуту
-rate_limit_me_endpoint = RateLimiter(times=25, seconds=60)
+def _too_many_requests(retry_after: float):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too Many Requests",
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
 
-# Функция для создания зависимости с обработкой случая отсутствия соединения с Redis
-async def check_rate_limit_me(request: Request, response: Response):
+def rate_limit(route: str):
     """
-    Проверяет ограничение скорости для маршрута /me
+    Зависимость FastAPI, применяющая политику route с учётом роли пользователя.
+    Лимит считается на пользователя (для запросов без id — на IP).
     """
-    if not redis_connected or not RATE_LIMIT_ENABLED:
-        # Если Redis не подключен или ограничение выключено, пропускаем ограничение
-        return
-    
-    # Используем стандартный rate limiter
-    await rate_limit_me_endpoint(request, response)
\ No newline at end of file
+    async def check_rate_limit(request: Request, response: Response, current_user: User = Depends(get_current_user)):
+        if not RATE_LIMIT_ENABLED or not (REDIS_URL or RATE_LIMIT_WITHOUT_REDIS):
+            return
+        policy = get_policy(route, current_user.role)
+        if policy is None:
+            return
+
+        started_at = time.perf_counter()
+        key = f"{route}:{_client_identity(request, current_user)}"
+
+        # Отказ, который следует из локальных данных, не требует Redis
+        retry_after = local_limiter.check(key, policy, commit=not REDIS_URL)
+        if retry_after:
+            _observe("local", started_at, allowed=False)
+            raise _too_many_requests(retry_after)
+        if not REDIS_URL:
+            _observe("local", started_at, allowed=True)
+            return
+
+        try:
+            allowed, wait_ms, remaining = await call_redis(lambda: _gcra_script(
+                keys=[REDIS_KEY_PREFIX + key],
+                args=[round(policy.emission_interval * 1000), round(policy.seconds * 1000)],
+            ))
+        except RedisUnavailable:
+            # Redis недоступен — решение по локальному счётчику
+            retry_after = local_limiter.check(key, policy)
+            _observe("fallback", started_at, allowed=not retry_after)
+            if retry_after:
+                raise _too_many_requests(retry_after)
+            return
+
+        if not allowed:
+            # Запоминаем отказ: до его окончания Redis не спрашиваем
+            local_limiter.block(key, wait_ms / 1000)
+            _observe("redis", started_at, allowed=False)
+            raise _too_many_requests(wait_ms / 1000)
+
+        local_limiter.check(key, policy)
+        _observe("redis", started_at, allowed=True)
+        response.headers["X-RateLimit-Limit"] = str(policy.times)
+        response.headers["X-RateLimit-Remaining"] = str(remaining)
+
+    return check_rate_limit
+
+# Ограничение для /users/me (политика "users_me")
+check_rate_limit_me = rate_limit("users_me")
@@ -1,32 +1,298 @@
+import asyncio
+import logging
 import os
-import redis
+import time
+from collections import OrderedDict
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 from dotenv import load_dotenv
 
 load_dotenv()
 
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+logger = logging.getLogger(__name__)
 
-redis_client = redis.StrictRedis.from_url(REDIS_URL, decode_responses=True)
+# Для Render.com проверяем как REDIS_URL, так и RENDER_REDIS_URL
+REDIS_CONFIGURED_URL = os.getenv("REDIS_URL") or os.getenv("RENDER_REDIS_URL")
+REDIS_URL = REDIS_CONFIGURED_URL or "redis://localhost:6379/0"
 
-def set_user_session(user_id, data, ttl=1800):
-    """Set user session data in Redis with a TTL (in seconds)."""
-    key = f"user_session:{user_id}"
-    redis_client.hmset(key, data)
-    redis_client.expire(key, ttl)
+# Параметры общего пула соединений
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+# Сколько ждать свободного соединения из пула, прежде чем вернуть ошибку
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "1.0"))
+# Короткие таймауты: недоступный или медленный Redis не должен задерживать запросы
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
 
-def get_user_session(user_id):
-    """Get user session data from Redis."""
-    key = f"user_session:{user_id}"
-    return redis_client.hgetall(key)
+# Один асинхронный пул на процесс: сессии, rate limiting (GCRA, rate_limiter.py) и кэши
+# используют один и тот же клиент, поэтому число соединений с Redis ограничено
+# REDIS_MAX_CONNECTIONS, а все операции выполняются без блокировки event loop.
+redis_pool = aioredis.BlockingConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+)
+async_redis_client = aioredis.Redis(connection_pool=redis_pool)
 
-def delete_user_session(user_id):
-    key = f"user_session:{user_id}"
-    redis_client.delete(key)
+async def close_redis():
+    """Закрывает соединения общего пула при остановке приложения."""
+    await async_redis_client.aclose()
+    await redis_pool.disconnect()
 
-def get_all_active_user_sessions():
-    """Return a dict of user_id to session data for all active sessions."""
-    sessions = {}
-    for key in redis_client.scan_iter("user_session:*"):
-        user_id = key.split(":", 1)[1]
-        sessions[user_id] = redis_client.hgetall(key)
-    return sessions
+# Защита от недоступного или медленного Redis.
+# Каждый вызов ограничен дедлайном REDIS_CALL_DEADLINE. После
+# REDIS_BREAKER_FAILURES ошибок подряд circuit breaker размыкается: вызовы
+# сразу получают RedisUnavailable, и вызывающий код переключается на
+# локальный fallback (сессии ниже, token bucket в rate_limiter). Через
+# REDIS_BREAKER_RESET_TIMEOUT пропускается пробный вызов; фоновый монитор
+# (redis_health_monitor) регулярно пингует Redis, а после восстановления
+# вызываются колбэки on_redis_recovered (синхронизация локальных данных).
+
+REDIS_CALL_DEADLINE = float(os.getenv("REDIS_CALL_DEADLINE", "0.3"))
+REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", "3"))
+REDIS_BREAKER_RESET_TIMEOUT = float(os.getenv("REDIS_BREAKER_RESET_TIMEOUT", "10"))
+REDIS_HEALTH_INTERVAL = float(os.getenv("REDIS_HEALTH_INTERVAL", "5"))
+
+class RedisUnavailable(Exception):
+    """Redis недоступен, не ответил за отведённое время или breaker разомкнут."""
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+
+    def allow_request(self):
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.probe_started_at = now
+            return True
+        if self.state == self.HALF_OPEN and now - self.probe_started_at >= self.reset_timeout:
+            # Пробный вызов потерялся (например, отменён) — разрешаем новый
+            self.probe_started_at = now
+            return True
+        return False
+
+    def record_success(self):
+        """Возвращает True, если breaker был разомкнут (Redis восстановился)."""
+        recovered = self.state != self.CLOSED
+        self.state = self.CLOSED
+        self.failures = 0
+        return recovered
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Redis недоступен: circuit breaker разомкнут, используется локальный fallback")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+redis_breaker = CircuitBreaker(REDIS_BREAKER_FAILURES, REDIS_BREAKER_RESET_TIMEOUT)
+_recovery_callbacks = []
+
+def on_redis_recovered(callback):
+    """Регистрирует async-колбэк, вызываемый после восстановления Redis."""
+    _recovery_callbacks.append(callback)
+
+async def _run_recovery_callbacks():
+    logger.info("Redis снова доступен: синхронизация локальных данных")
+    for callback in _recovery_callbacks:
+        try:
+            await callback()
+        except Exception as e:
+            logger.warning(f"Ошибка синхронизации после восстановления Redis: {e}")
+
+def _record_success():
+    if redis_breaker.record_success():
+        asyncio.get_running_loop().create_task(_run_recovery_callbacks())
+
+async def call_redis(make_call, deadline: float = REDIS_CALL_DEADLINE):
+    """
+    Выполняет make_call() (функция, возвращающая корутину) через circuit breaker
+    с дедлайном. Ошибки Redis и таймауты превращаются в RedisUnavailable.
+    """
+    if not redis_breaker.allow_request():
+        raise RedisUnavailable("circuit breaker open")
+    try:
+        result = await asyncio.wait_for(make_call(), deadline)
+    except (RedisError, OSError, asyncio.TimeoutError) as e:
+        redis_breaker.record_failure()
+        raise RedisUnavailable(str(e) or type(e).__name__) from e
+    except Exception:
+        # Redis ответил, ошибка на стороне вызывающего кода (например, 429 от limiter)
+        _record_success()
+        raise
+    _record_success()
+    return result
+
+async def redis_health_monitor():
+    """Фоновая задача: периодический PING, чтобы замечать отказ и восстановление Redis без запросов."""
+    while True:
+        await asyncio.sleep(REDIS_HEALTH_INTERVAL)
+        try:
+            await call_redis(async_redis_client.ping)
+        except RedisUnavailable:
+            pass
+
+# Хранилище пользовательских сессий.
+# Данные сессии — hash user_session:{id} с TTL. Вторичный индекс — sorted set
+# user_sessions:by_expiry (member = user_id, score = время истечения), поэтому
+# список активных сессий и их количество не требуют SCAN по всему keyspace,
+# а стоимость чтения зависит только от числа возвращаемых сессий.
+#
+# Пока Redis недоступен, сессии пишутся в локальный кэш процесса, а операции
+# запоминаются в _pending_session_ops и повторяются в Redis после восстановления.
+
+SESSION_KEY_PREFIX = "user_session:"
+SESSION_INDEX_KEY = "user_sessions:by_expiry"
+
+_local_sessions = {}  # str(user_id) -> (expires_at, data)
+_pending_session_ops: "OrderedDict[str, tuple]" = OrderedDict()  # str(user_id) -> ("set", data, expires_at) | ("delete",)
+
+def _session_key(user_id):
+    return f"{SESSION_KEY_PREFIX}{user_id}"
+
+def _local_session(user_id):
+    entry = _local_sessions.get(str(user_id))
+    if entry is None:
+        return {}
+    expires_at, data = entry
+    if expires_at < time.time():
+        _local_sessions.pop(str(user_id), None)
+        return {}
+    return data
+
+async def _redis_set_session(user_id, data, ttl):
+    key = _session_key(user_id)
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping=data)
+        pipe.expire(key, ttl)
+        pipe.zadd(SESSION_INDEX_KEY, {str(user_id): time.time() + ttl})
+        await pipe.execute()
+
+async def _redis_delete_session(user_id):
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(_session_key(user_id))
+        pipe.zrem(SESSION_INDEX_KEY, str(user_id))
+        await pipe.execute()
+
+async def _redis_get_sessions(user_ids):
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.hgetall(_session_key(user_id))
+        return await pipe.execute()
+
+async def set_user_session(user_id, data, ttl=1800):
+    """Атомарно (MULTI/EXEC) записывает сессию, её TTL и запись в индексе."""
+    try:
+        await call_redis(lambda: _redis_set_session(user_id, data, ttl))
+        _local_sessions.pop(str(user_id), None)
+        _pending_session_ops.pop(str(user_id), None)
+    except RedisUnavailable:
+        expires_at = time.time() + ttl
+        _local_sessions[str(user_id)] = (expires_at, {k: str(v) for k, v in data.items()})
+        _pending_session_ops[str(user_id)] = ("set", data, expires_at)
+
+async def get_user_session(user_id):
+    """Get user session data from Redis (or the local fallback)."""
+    return (await get_user_sessions([user_id]))[user_id]
+
+async def get_user_sessions(user_ids):
+    """Сессии нескольких пользователей за один round trip: {user_id: data} (пустой dict, если сессии нет)."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    try:
+        results = await call_redis(lambda: _redis_get_sessions(user_ids))
+    except RedisUnavailable:
+        results = [{} for _ in user_ids]
+    # Сессии, ещё не перенесённые из локального fallback в Redis
+    return {user_id: data or _local_session(user_id) for user_id, data in zip(user_ids, results)}
+
+async def get_sessions_status(user_ids):
+    """Есть ли активная сессия у каждого пользователя (EXISTS одним pipeline)."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+
+    async def exists_all():
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.exists(_session_key(user_id))
+            return await pipe.execute()
+
+    try:
+        results = await call_redis(exists_all)
+    except RedisUnavailable:
+        results = [0 for _ in user_ids]
+    return {user_id: bool(exists) or bool(_local_session(user_id)) for user_id, exists in zip(user_ids, results)}
+
+async def delete_user_session(user_id):
+    _local_sessions.pop(str(user_id), None)
+    try:
+        await call_redis(lambda: _redis_delete_session(user_id))
+        _pending_session_ops.pop(str(user_id), None)
+    except RedisUnavailable:
+        _pending_session_ops[str(user_id)] = ("delete",)
+
+async def get_active_user_sessions(offset=0, limit=100):
+    """
+    Страница активных сессий (сначала самые свежие) и их общее количество.
+    Истёкшие записи индекса удаляются по score, сами hash-и истекают по TTL.
+    Без Redis возвращаются сессии из локального fallback.
+    """
+    now = time.time()
+
+    async def index_page():
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(SESSION_INDEX_KEY, "-inf", now)
+            pipe.zrevrangebyscore(SESSION_INDEX_KEY, "+inf", now, start=offset, num=limit)
+            pipe.zcard(SESSION_INDEX_KEY)
+            _, user_ids, total = await pipe.execute()
+        return user_ids, total
+
+    try:
+        user_ids, total = await call_redis(index_page)
+    except RedisUnavailable:
+        local = sorted(
+            ((expires_at, data) for expires_at, data in _local_sessions.values() if expires_at >= now),
+            key=lambda item: item[0], reverse=True
+        )
+        return [data for _, data in local[offset:offset + limit]], len(local)
+    sessions = await get_user_sessions(user_ids)
+    # Сессия могла быть вытеснена из Redis раньше срока — пропускаем пустые
+    return [data for data in sessions.values() if data], total
+
+async def reconcile_sessions():
+    """Переносит в Redis изменения сессий, сделанные локально во время недоступности."""
+    for user_id, op in list(_pending_session_ops.items()):
+        if op[0] == "set":
+            _, data, expires_at = op
+            ttl = int(expires_at - time.time())
+            if ttl > 0:
+                await call_redis(lambda: _redis_set_session(user_id, data, ttl))
+        else:
+            await call_redis(lambda: _redis_delete_session(user_id))
+        # Операция могла измениться, пока ждали Redis, — удаляем только выполненную
+        if _pending_session_ops.get(user_id) is op:
+            del _pending_session_ops[user_id]
+            if op[0] == "set":
+                _local_sessions.pop(user_id, None)
+    if not _pending_session_ops:
+        logger.info("Локальные сессии синхронизированы с Redis")
+
+on_redis_recovered(reconcile_sessions)
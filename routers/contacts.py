@@ -1,31 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import extract, and_, or_
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status, UploadFile, File
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, or_, select, func
 from typing import List, Optional
 from datetime import date, timedelta
 import logging
 import crud, models, schemas
-from database import SessionLocal
+from database import get_async_db
 from models import Contact, User
-from schemas import Contact as ContactSchema, ContactCreate, ContactUpdate, UserWithContacts, UserWithBirthdays
+from schemas import Contact as ContactSchema, ContactCreate, ContactUpdate, ContactPage, UserWithContacts, UserWithBirthdays, ContactBatchDelete, ContactBatchDeleteResult, ContactBatchRequest, ContactBatchResult
 # Используем обновлённые функции авторизации
-from auth import get_current_user, check_contact_access
+from auth import get_current_user, get_current_admin, check_contact_access
+from contact_batch import apply_contact_batch, contact_batch_stats
+from contact_import import create_import_job, job_status, errors_csv, FORMATS
+from contact_export import (
+    export_query, export_stream, export_filename, export_media_type, contact_export_stats,
+    FORMATS as EXPORT_FORMATS,
+)
 
 router = APIRouter(prefix="/contacts", tags=["Contacts"])
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 @router.post("/", response_model=ContactSchema)
 async def create_contact(
     request: Request,
     contact: ContactCreate, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     logging.info(f"[ROUTER] create_contact RAW: {contact}")
     
@@ -42,20 +42,117 @@ async def create_contact(
         target_user_id = current_user.id
     
     try:
-        return crud.create_contact(db, target_user_id, contact)
+        return await crud.create_contact(db, target_user_id, contact)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.post("/import", status_code=status.HTTP_202_ACCEPTED)
+async def import_contacts(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, description="csv или vcard; по умолчанию — по расширению файла"),
+    user_id: Optional[int] = Query(None, description="Владелец контактов (только для админов)"),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Импорт контактов из CSV или vCard. Файл обрабатывается в фоне; прогресс
+    и ошибки по строкам — в GET /contacts/import/{job_id}.
+    """
+    if format is not None and format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    # Как и при создании контакта: админы могут импортировать для любого пользователя
+    if current_user.role in ["superadmin", "admin"] and user_id is not None:
+        target_user_id = user_id
+    else:
+        target_user_id = current_user.id
+    job = await create_import_job(db, file, target_user_id, current_user.id, format)
+    return {"job_id": job.id, "status": job.status, "status_url": f"/contacts/import/{job.id}"}
+
+async def _get_import_job(db: AsyncSession, job_id: int, current_user: User):
+    job = await db.get(models.ContactImportJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    if current_user.role not in ["superadmin", "admin"] and job.created_by != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions to access this import")
+    return job
+
+@router.get("/import/{job_id}")
+async def get_import_status(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Прогресс импорта и первые ошибки по строкам."""
+    return job_status(await _get_import_job(db, job_id, current_user))
+
+@router.get("/import/{job_id}/errors")
+async def get_import_errors(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Отчёт об ошибках импорта в CSV: номер строки и причина."""
+    job = await _get_import_job(db, job_id, current_user)
+    return Response(
+        content=errors_csv(job),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="import-{job_id}-errors.csv"'},
+    )
+
+@router.get("/export")
+async def export_contacts(
+    format: str = Query("csv", description="csv, vcard или ndjson"),
+    gzip: bool = Query(False, description="Сжать файл gzip на лету"),
+    search: str = Query(None),
+    sort: str = Query("asc"),
+    user_id: Optional[int] = Query(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Экспорт контактов (те же права и фильтры, что в GET /contacts). Файл
+    отдаётся потоком по мере чтения из БД, не собираясь целиком в памяти.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    if user_id is None and current_user.role != "superadmin":
+        user_id = current_user.id
+    stmt = export_query(current_user, user_id=user_id, search=search, sort=sort,
+                        dialect_name=crud.get_dialect_name(db))
+    # Поток читает контакты в своей сессии; соединение запроса возвращаем в пул
+    # сразу, чтобы запрос не удерживал два соединения
+    await db.close()
+    return StreamingResponse(
+        export_stream(stmt, format, gzip=gzip),
+        media_type=export_media_type(format, gzip),
+        headers={"Content-Disposition": f'attachment; filename="{export_filename(format, gzip)}"'},
+    )
+
+@router.get("/export/stats")
+async def get_export_stats(current_user: User = Depends(get_current_admin)):
+    """Метрики экспорта: число выгрузок, контактов и отправленных байт."""
+    return contact_export_stats()
+
 @router.get("/grouped", response_model=List[UserWithContacts])
 async def read_contacts_grouped(
     request: Request,
+    response: Response,
     search: str = Query(None),
     sort: str = Query("asc"),
+    per_user_limit: int = Query(100, ge=1, le=1000),
+    per_user_offset: int = Query(0, ge=0),
+    users_limit: int = Query(100, ge=1, le=1000),
+    users_offset: int = Query(0, ge=0),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
+    """
+    Контакты, сгруппированные по пользователям. Пользователи тоже отдаются
+    страницами (users_offset/users_limit, по id); их общее число — в
+    заголовке X-Total-Count.
+    """
     # Определяем, кого возвращать
-    query_users = db.query(models.User)
+    query_users = select(models.User)
     
     if current_user.role == "superadmin":
         # Все пользователи для суперадмина
@@ -65,24 +162,36 @@ async def read_contacts_grouped(
         pass
     else:
         # Только свои контакты для обычного пользователя
-        query_users = query_users.filter(models.User.id == current_user.id)
+        query_users = query_users.where(models.User.id == current_user.id)
+
+    users_total = (await db.execute(
+        select(func.count()).select_from(query_users.subquery())
+    )).scalar_one()
+    response.headers["X-Total-Count"] = str(users_total)
+    users = (await db.execute(
+        query_users.order_by(models.User.id).offset(users_offset).limit(users_limit)
+    )).scalars().all()
+    logging.info(f"/contacts/grouped: {len(users)} of {users_total} users for role {current_user.role}")
 
-    # Жадно грузим контакты
-    query_users = query_users.options(joinedload(models.User.contacts))
-    users = query_users.all()
-    logging.info(f"/contacts/grouped: found {len(users)} users for role {current_user.role}")
+    # Поиск, сортировка и постраничная выборка (top-K на пользователя) выполняются в БД
+    contacts_by_user, totals_by_user = await crud.get_contacts_grouped_by_user(
+        db,
+        current_user,
+        [u.id for u in users],
+        search=search,
+        sort=sort,
+        per_user_limit=per_user_limit,
+        per_user_offset=per_user_offset
+    )
 
-    # Фильтрация и сортировка контактов на уровне Python
     result = []
     for u in users:
-        contacts = u.contacts
-        if search:
-            search_lc = search.lower()
-            contacts = [c for c in contacts if search_lc in (c.first_name or '').lower() or search_lc in (c.last_name or '').lower() or search_lc in (c.email or '').lower()]
-        if sort == "desc":
-            contacts = sorted(contacts, key=lambda c: (c.first_name or '').lower(), reverse=True)
-        else:
-            contacts = sorted(contacts, key=lambda c: (c.first_name or '').lower())
+        contacts = contacts_by_user.get(u.id, [])
+        contacts_total = totals_by_user.get(u.id, 0)
+        # Курсор для догрузки контактов пользователя через /contacts/page
+        next_cursor = None
+        if contacts and contacts_total > per_user_offset + len(contacts):
+            next_cursor = crud.encode_contact_cursor(contacts[-1])
         
         # Улучшенная проверка и исправление email перед сериализацией
         email = u.email
@@ -101,7 +210,9 @@ async def read_contacts_grouped(
                 username=u.username,
                 email=email,
                 role=u.role or "user",
-                contacts=contacts_data
+                contacts=contacts_data,
+                contacts_total=contacts_total,
+                next_cursor=next_cursor
             ))
         except Exception as e:
             logging.error(f"Ошибка при создании UserWithContacts для пользователя {u.id}: {str(e)}")
@@ -114,7 +225,8 @@ async def read_contacts_grouped(
                 username=u.username,
                 email=fallback_email,
                 role=u.role or "user",
-                contacts=[]
+                contacts=[],
+                contacts_total=contacts_total
             ))
     return result
 
@@ -122,7 +234,7 @@ async def read_contacts_grouped(
 async def read_birthdays_grouped_by_users(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Получение дней рождения, сгруппированных по пользователям.
@@ -135,45 +247,31 @@ async def read_birthdays_grouped_by_users(
             detail="Недостаточно прав для доступа к этому ресурсу"
         )
     
-    # Получаем всех пользователей
-    query_users = db.query(models.User)
-    users = query_users.all()
-    
-    result = []
     today = date.today()
-    in_seven_days = today + timedelta(days=7)
-    today_md = today.month * 100 + today.day
-    in_seven_days_md = in_seven_days.month * 100 + in_seven_days.day
     
-    for user in users:
-        # Дни рождения в ближайшие 7 дней
-        next7_query = db.query(models.Contact).filter(
-            models.Contact.user_id == user.id,
-            models.Contact.birthday.isnot(None)
-        )
-        
-        if today_md <= in_seven_days_md:
-            next7_contacts = next7_query.filter(
-                birthday_md_expr().between(today_md, in_seven_days_md)
-            ).all()
-        else:
-            next7_contacts = next7_query.filter(
-                or_(
-                    birthday_md_expr().between(today_md, 1231),
-                    birthday_md_expr().between(101, in_seven_days_md)
-                )
-            ).all()
-        
-        # Дни рождения в ближайшие 12 месяцев
-        next12_contacts = db.query(models.Contact).filter(
-            models.Contact.user_id == user.id,
-            models.Contact.birthday.isnot(None),
-            birthday_md_expr() >= today_md
-        ).order_by(
-            extract('month', models.Contact.birthday),
-            extract('day', models.Contact.birthday)
-        ).all()
-        
+    # Один запрос вместо 2N+1: контакты вместе с владельцами, уже упорядоченные
+    # по пользователю и ближайшему дню рождения. В окно 12 месяцев попадают все
+    # контакты с датой рождения, окно 7 дней является его подмножеством.
+    # Связи контактов подгружаются selectinload-ом фиксированным числом запросов.
+    rows = (await db.execute(
+        select(models.User, models.Contact)
+        .join(models.Contact, models.Contact.user_id == models.User.id)
+        .options(*crud.contact_load_options())
+        .where(models.Contact.birthday_md.isnot(None), *crud.contact_scope_filter(current_user))
+        .order_by(models.User.id, *crud.next_birthday_order(today))
+    )).all()
+    
+    # Группируем строки по пользователям за один проход
+    grouped = {}
+    for user, contact in rows:
+        if user.id not in grouped:
+            grouped[user.id] = (user, [], [])
+        if crud.birthday_in_window(contact.birthday_md, today, days=7):
+            grouped[user.id][1].append(contact)
+        grouped[user.id][2].append(contact)
+    
+    result = []
+    for user, next7_contacts, next12_contacts in grouped.values():
         # Не добавляем пользователей без контактов с днями рождения
         if next7_contacts or next12_contacts:
             # Улучшенная проверка и исправление email перед сериализацией
@@ -218,130 +316,108 @@ async def read_birthdays_grouped_by_users(
 @router.get("/", response_model=List[ContactSchema])
 async def read_contacts(
     request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
     search: str = Query(None),
     sort: str = Query("asc"),
     user_id: Optional[int] = Query(None),
+    cursor: Optional[str] = Query(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(models.Contact)
-    
-    # Если не указан user_id и это супер-админ — показываем все контакты
-    if user_id is not None:
-        query = query.filter(models.Contact.user_id == user_id)
-    elif current_user.role != "superadmin":
-        # Обычный пользователь — только свои контакты
-        query = query.filter(models.Contact.user_id == current_user.id)
-    
-    # superadmin без user_id — все контакты
-    if search:
-        search_pattern = f"%{search}%"
-        query = query.filter(
-            (models.Contact.first_name.ilike(search_pattern)) |
-            (models.Contact.last_name.ilike(search_pattern)) |
-            (models.Contact.email.ilike(search_pattern))
+    # Если не указан user_id и это не супер-админ — по умолчанию только свои контакты.
+    # Права (обычный пользователь видит только свои) применяются в crud в самом SQL.
+    if user_id is None and current_user.role != "superadmin":
+        user_id = current_user.id
+    if cursor is None and skip:
+        # Старый режим offset/limit оставлен для совместимости
+        return await crud.get_contacts(
+            db, current_user, user_id=user_id, search=search, sort=sort, skip=skip, limit=limit
         )
-    
-    if sort == "desc":
-        query = query.order_by(models.Contact.first_name.desc())
-    else:
-        query = query.order_by(models.Contact.first_name.asc())
-    
-    return query.offset(skip).limit(limit).all()
+    try:
+        contacts, next_cursor = await crud.get_contacts_page(
+            db, current_user, user_id=user_id, search=search, sort=sort, limit=limit, cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return contacts
+
+@router.get("/page", response_model=ContactPage)
+async def read_contacts_page(
+    request: Request,
+    limit: int = Query(100, ge=1, le=500),
+    search: str = Query(None),
+    sort: str = Query("asc"),
+    user_id: Optional[int] = Query(None),
+    cursor: Optional[str] = Query(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Keyset-пагинация контактов (для бесконечной прокрутки).
+    Следующая страница запрашивается с cursor=next_cursor из предыдущего ответа.
+    """
+    if user_id is None and current_user.role != "superadmin":
+        user_id = current_user.id
+    try:
+        contacts, next_cursor = await crud.get_contacts_page(
+            db, current_user, user_id=user_id, search=search, sort=sort, limit=limit, cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ContactPage(
+        items=[schemas.Contact.model_validate(c, from_attributes=True) for c in contacts],
+        next_cursor=next_cursor
+    )
 
 @router.get("/search/", response_model=List[ContactSchema])
 async def search_contacts(
     request: Request,
     query: str, 
+    limit: int = Query(50, ge=1, le=500),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    results = crud.search_contacts(db, query)
-    # Фильтруем результаты по доступу пользователя
-    if current_user.role not in ["superadmin", "admin"]:
-        results = [contact for contact in results if contact.user_id == current_user.id]
-    return results
+    # Результаты упорядочены по релевантности (на PostgreSQL), доступ проверяется в SQL
+    return await crud.search_contacts(db, current_user, query, limit=limit)
 
 @router.get("/birthdays/", response_model=List[ContactSchema])
 async def get_upcoming_birthdays(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    results = crud.contacts_with_upcoming_birthdays(db)
-    # Фильтруем результаты по доступу пользователя
-    if current_user.role not in ["superadmin", "admin"]:
-        results = [contact for contact in results if contact.user_id == current_user.id]
-    return results
-
-def birthday_md_expr():
-    return extract('month', models.Contact.birthday) * 100 + extract('day', models.Contact.birthday)
+    return await crud.contacts_with_upcoming_birthdays(db, current_user)
 
 @router.get("/birthdays/next7days", response_model=List[ContactSchema])
 async def get_upcoming_birthdays_next7days(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    today = date.today()
-    in_seven_days = today + timedelta(days=7)
-    today_md = today.month * 100 + today.day
-    in_seven_days_md = in_seven_days.month * 100 + in_seven_days.day
-
-    query = db.query(models.Contact).filter(models.Contact.birthday.isnot(None))
-    
-    # Ограничиваем доступ для обычных пользователей
-    if current_user.role not in ["superadmin", "admin"]:
-        query = query.filter(models.Contact.user_id == current_user.id)
-
-    if today_md <= in_seven_days_md:
-        contacts = query.filter(
-            birthday_md_expr().between(today_md, in_seven_days_md)
-        ).all()
-    else:
-        contacts = query.filter(
-            or_(
-                birthday_md_expr().between(today_md, 1231),
-                birthday_md_expr().between(101, in_seven_days_md)
-            )
-        ).all()
-    return contacts
+    return await crud.contacts_with_upcoming_birthdays(db, current_user, days=7)
 
 @router.get("/birthdays/next12months", response_model=List[ContactSchema])
 async def get_birthdays_next_12_months(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    today = date.today()
-    today_md = today.month * 100 + today.day
-    
-    query = db.query(models.Contact).filter(
-        models.Contact.birthday.isnot(None),
-        birthday_md_expr() >= today_md
-    )
-    
-    # Ограничиваем доступ для обычных пользователей
-    if current_user.role not in ["superadmin", "admin"]:
-        query = query.filter(models.Contact.user_id == current_user.id)
-        
-    contacts = query.order_by(
-        extract('month', models.Contact.birthday),
-        extract('day', models.Contact.birthday)
-    ).all()
-    
-    return contacts
+    # За 12 месяцев день рождения есть у каждого контакта: сортируем по
+    # ближайшей дате, чтобы контакты с ДР в начале года шли после декабрьских
+    return await crud.contacts_with_birthdays(db, current_user)
 
 @router.get("/{contact_id}", response_model=ContactSchema)
 async def read_contact(
     request: Request,
     contact_id: int, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    db_contact = crud.get_contact(db, contact_id)
+    db_contact = await crud.get_contact(db, contact_id)
     if db_contact is None:
         raise HTTPException(status_code=404, detail="Contact not found")
         
@@ -360,10 +436,10 @@ async def update_contact(
     contact_id: int, 
     contact: ContactUpdate, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Проверяем существование контакта
-    existing_contact = crud.get_contact(db, contact_id)
+    existing_contact = await crud.get_contact(db, contact_id)
     if not existing_contact:
         raise HTTPException(status_code=404, detail="Contact not found")
         
@@ -375,18 +451,52 @@ async def update_contact(
         )
     
     logging.info(f"[ROUTER] update_contact RAW: {contact}")
-    db_contact = crud.update_contact(db, contact_id, contact)
+    db_contact = await crud.update_contact(db, contact_id, contact)
     return db_contact
 
+@router.post("/batch-delete", response_model=ContactBatchDeleteResult)
+async def delete_contacts_batch(
+    body: ContactBatchDelete,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Удаление нескольких контактов одним запросом к БД. Контакты, которых нет
+    или к которым нет доступа, возвращаются в not_found.
+    """
+    deleted = await crud.delete_contacts(db, current_user, body.ids)
+    return ContactBatchDeleteResult(
+        deleted=deleted,
+        not_found=sorted(set(body.ids) - set(deleted)),
+    )
+
+@router.post("/batch", response_model=ContactBatchResult)
+async def apply_contacts_batch(
+    body: ContactBatchRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Несколько операций create/update/delete/set_groups/add_groups/remove_groups
+    в одной транзакции. Результат возвращается для каждой операции; с
+    atomic=true ошибка любой операции отменяет весь пакет.
+    """
+    return await apply_contact_batch(db, current_user, body.operations, atomic=body.atomic)
+
+@router.get("/batch/stats")
+async def get_batch_stats(current_user: User = Depends(get_current_admin)):
+    """Счётчики пакетных изменений контактов."""
+    return contact_batch_stats()
+
 @router.delete("/{contact_id}", response_model=ContactSchema)
 async def delete_contact(
     request: Request,
     contact_id: int, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Проверяем существование контакта
-    existing_contact = crud.get_contact(db, contact_id)
+    existing_contact = await crud.get_contact(db, contact_id)
     if not existing_contact:
         raise HTTPException(status_code=404, detail="Contact not found")
         
@@ -397,5 +507,5 @@ async def delete_contact(
             detail="Not enough permissions to delete this contact"
         )
         
-    db_contact = crud.delete_contact(db, contact_id)
+    db_contact = await crud.delete_contact(db, contact_id)
     return db_contact
@@ -1,10 +1,14 @@
-from fastapi import APIRouter, HTTPException, Request, Depends, status
+from fastapi import APIRouter, HTTPException, Request, Depends, Query, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.exc import OperationalError
-from sqlalchemy import inspect, text
-from database import engine, SessionLocal, is_docker_environment, is_render_environment
+from sqlalchemy import inspect, text, select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import engine, async_engine, SessionLocal, get_async_db, pool_stats, is_docker_environment, is_render_environment
+import crud
 import models
-from faker import Faker
+from auth import get_current_admin
+from contact_purge import start_contact_purge, contact_purge_stats, CONTACT_PURGE_CHUNK_SIZE
+from fake_data import generate_fake_data, DEFAULT_PHONE_COUNTS, FAKE_DATA_MAX_CONTACTS, FAKE_DATA_MAX_USER_CONTACTS
 import psycopg2
 import os
 import re
@@ -16,7 +20,6 @@ optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token", auto_error=Fals
 
 # Удаляем префикс "/db", так как он уже указан в main.py при подключении роутера
 router = APIRouter(prefix="/db", tags=["Database Utils"])
-faker = Faker()
 
 # Функция для получения параметров подключения к базе данных
 def get_db_params():
@@ -78,6 +81,17 @@ def db_status():
     except OperationalError:
         return {"status": "fail", "message": "Немає підключення до бази даних."}
 
+@router.get("/pool-stats")
+def db_pool_stats(current_user: models.User = Depends(get_current_admin)):
+    """Соединения из пула на запрос (см. database.pool_stats) и текущее состояние пулов."""
+    requests_total = pool_stats["requests"]
+    return {
+        **pool_stats,
+        "checkouts_per_request": round(pool_stats["checkouts"] / requests_total, 3) if requests_total else 0,
+        "async_pool": async_engine.pool.status(),
+        "sync_pool": engine.pool.status(),
+    }
+
 @router.post("/init")
 def db_init():
     try:
@@ -91,14 +105,39 @@ def db_init():
         raise HTTPException(status_code=500, detail="Немає підключення до бази даних.")
 
 @router.post("/fill-fake")
-def db_fill_fake(n: int = 10, request: Request = None):
+def db_fill_fake(
+    n: int = 10,
+    request: Request = None,
+    users: int = Query(0, ge=0, description="Создать пользователей loadtest_<seed>_<i> (тогда n не используется)"),
+    contacts_per_user: float = Query(100, ge=0),
+    contacts_distribution: str = Query("fixed", description="fixed, uniform, exponential или lognormal"),
+    contacts_sigma: float = Query(1.0, gt=0),
+    seed: Optional[int] = Query(None, description="Одинаковый seed даёт одинаковый набор данных"),
+    phone_counts: str = Query(DEFAULT_PHONE_COUNTS, description="Веса числа телефонов: число:вес через запятую"),
+    birth_year_min: int = Query(1945),
+    birth_year_max: int = Query(2007),
+    birthday_distribution: str = Query("uniform", description="uniform или normal"),
+    groups: int = Query(0, ge=0),
+    group_membership: float = Query(0.3, ge=0, le=1),
+):
+    """
+    Тестовые контакты: n контактов текущему пользователю или, при users > 0,
+    новые пользователи с контактами по заданным распределениям (fake_data).
+    Создавать пользователей и большие наборы может только администратор.
+    """
+    session_user = request.session.get('user') if request and hasattr(request, 'session') else None
+    is_admin = bool(session_user) and session_user.get('role') in ('admin', 'superadmin')
+    if users and not is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Створювати користувачів можуть лише адміністратори.",
+        )
     try:
         db = SessionLocal()
         inspector = inspect(engine)
         if not inspector.get_table_names():
             models.Base.metadata.create_all(bind=engine)
-        from models import Contact, PhoneNumber, User
-        import random
+        from models import User
         
         # Определяем user_id для контактов
         user_id = None
@@ -162,39 +201,29 @@ def db_fill_fake(n: int = 10, request: Request = None):
             user_id = user.id
             print(f"Создаем контакты для первого пользователя ID={user_id} (запасной вариант)")
             
-        # Создаем контакты с полученным user_id
-        import logging
-        for _ in range(n):
-            first_name = faker.first_name() or "John"
-            last_name = faker.last_name() or "Doe"
-            email = faker.unique.email() or f"user{random.randint(1000,9999)}@example.com"
-            contact = Contact(
-                user_id=user_id,
-                first_name=first_name,
-                last_name=last_name,
-                email=email,
-                birthday=faker.date_of_birth(minimum_age=18, maximum_age=80),
-                extra_info=faker.sentence()
-            )
-            db.add(contact)
-            logging.info(f"Fake contact: {first_name} {last_name} {email}")
-            db.flush()
-            for _ in range(random.randint(1, 3)):
-                import re
-                raw_number = faker.phone_number()
-                cleaned_number = re.sub(r'[^0-9\-+() ]', '', raw_number)
-                if len(cleaned_number) < 7:
-                    cleaned_number = '+380' + faker.msisdn()[:9]
-                pn = PhoneNumber(
-                    number=cleaned_number,
-                    label=random.choice(["home", "work", "mobile"]),
-                    contact_id=contact.id
-                )
-                db.add(pn)
-        db.commit()
-        return {"status": "ok", "message": f"Додано {n} випадкових контактів для user_id={user_id}."}
+        # Пользователи, контакты и телефоны загружаются через COPY (см. fake_data)
+        summary = generate_fake_data(
+            seed=seed, users=users, user_id=user_id, contacts=n,
+            contacts_per_user=contacts_per_user, contacts_distribution=contacts_distribution,
+            contacts_sigma=contacts_sigma, phone_counts=phone_counts,
+            birth_year_min=birth_year_min, birth_year_max=birth_year_max,
+            birthday_distribution=birthday_distribution, groups=groups,
+            group_membership=group_membership,
+            max_contacts=FAKE_DATA_MAX_CONTACTS if is_admin else FAKE_DATA_MAX_USER_CONTACTS,
+            # Небольшие наборы не-администраторов — без пула процессов
+            workers=None if is_admin else 1,
+        )
+        if users:
+            message = f"Додано {summary['users']} користувачів і {summary['contacts']} випадкових контактів (seed={summary['seed']})."
+        else:
+            message = f"Додано {summary['contacts']} випадкових контактів для user_id={user_id} (seed={summary['seed']})."
+        return {"status": "ok", "message": message, **summary}
     except OperationalError:
         raise HTTPException(status_code=500, detail="Немає підключення до бази даних.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         print(f"Ошибка при создании контактов: {str(e)}")
@@ -203,14 +232,18 @@ def db_fill_fake(n: int = 10, request: Request = None):
         db.close()
 
 @router.post("/clear")
-def db_clear(request: Request = None):
+async def db_clear(request: Request = None, db: AsyncSession = Depends(get_async_db)):
+    """
+    Удаляет контакты: администратор — всех пользователей, остальные — свои.
+    Небольшие объёмы удаляются сразу, большие — пачками в фоне (contact_purge).
+    """
     try:
-        db = SessionLocal()
-        from models import Contact, PhoneNumber, Avatar, Photo, User
+        from models import Contact, User
         
         # Определяем для какого пользователя удаляем контакты
         user_id = None
         is_admin = False
+        role = None
         
         # Получаем информацию о текущем пользователе
         if request and hasattr(request, 'session'):
@@ -223,7 +256,7 @@ def db_clear(request: Request = None):
                 if role == 'superadmin' and current_user.get('id') == -1:
                     print("Обнаружен суперадмин с ID = -1")
                     # Ищем суперадмина в базе данных
-                    superadmin = db.query(User).filter_by(role='superadmin').first()
+                    superadmin = (await db.execute(select(User).filter_by(role='superadmin'))).scalars().first()
                     if superadmin:
                         user_id = superadmin.id
                         print(f"Найден суперадмин с реальным ID={user_id}")
@@ -232,47 +265,58 @@ def db_clear(request: Request = None):
                 else:
                     user_id = current_user.get('id')
                 
+        if not is_admin and not user_id:
+            # Если не удалось определить пользователя - не удаляем ничего
+            return {"status": "error", "message": "Необхідна авторизація для видалення контактів."}
+        
         # Если удаляет админ или суперадмин - удаляем все контакты
+        purge_user_id = None if is_admin else user_id
         if is_admin:
             print(f"Администратор (ID={user_id}, role={role}) удаляет все контакты")
-            db.query(PhoneNumber).delete()
-            db.query(Avatar).delete()
-            db.query(Photo).delete()
-            db.query(Contact).delete()
-            msg = "Всі контакти видалені адміністратором."
-        # Если это обычный пользователь или суперадмин удаляет свои контакты
-        elif user_id:
+        else:
             print(f"Пользователь ID={user_id} удаляет свои контакты")
-            # Получаем все контакты пользователя
-            user_contacts = db.query(Contact).filter(Contact.user_id == user_id).all()
-            
-            # Получаем ID всех контактов пользователя
-            contact_ids = [contact.id for contact in user_contacts]
-            
-            if contact_ids:
-                # Удаляем связанные записи телефонов, аватаров и фото
-                db.query(PhoneNumber).filter(PhoneNumber.contact_id.in_(contact_ids)).delete(synchronize_session=False)
-                db.query(Avatar).filter(Avatar.contact_id.in_(contact_ids)).delete(synchronize_session=False)
-                db.query(Photo).filter(Photo.contact_id.in_(contact_ids)).delete(synchronize_session=False)
-                
-                # Удаляем сами контакты
-                db.query(Contact).filter(Contact.user_id == user_id).delete()
-            
-            msg = f"Всі ваші контакти видалені. Видалено {len(contact_ids)} контактів."
+        total = await crud.count_contacts(db, purge_user_id)
+        
+        if total > CONTACT_PURGE_CHUNK_SIZE:
+            # Много контактов — удаляем пачками в фоне, не держа долгих блокировок
+            await db.close()
+            if not start_contact_purge(purge_user_id):
+                return {"status": "running", "message": "Видалення контактів уже виконується."}
+            return {
+                "status": "accepted",
+                "contacts": total,
+                "message": f"Видалення {total} контактів запущено у фоні.",
+            }
+        
+        # Небольшой объём: одна пачка, которая ждёт блокировки, а не пропускает
+        # их; затем пересчёт — контакты могли добавить во время удаления
+        deleted = await crud.delete_contacts_chunk(
+            db, purge_user_id, limit=CONTACT_PURGE_CHUNK_SIZE, skip_locked=False
+        )
+        remaining = await crud.count_contacts(db, purge_user_id)
+        if remaining:
+            return {
+                "status": "partial",
+                "deleted": deleted,
+                "remaining": remaining,
+                "message": f"Видалено {deleted} контактів, ще {remaining} залишилось. Повторіть видалення.",
+            }
+        if is_admin:
+            msg = "Всі контакти видалені адміністратором."
         else:
-            # Если не удалось определить пользователя - не удаляем ничего
-            return {"status": "error", "message": "Необхідна авторизація для видалення контактів."}
-            
-        db.commit()
+            msg = f"Всі ваші контакти видалені. Видалено {deleted} контактів."
         return {"status": "ok", "message": msg}
     except OperationalError:
         raise HTTPException(status_code=500, detail="Немає підключення до бази даних.")
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Ошибка при удалении контактов: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
+
+@router.get("/clear-stats")
+def db_clear_stats(current_user: models.User = Depends(get_current_admin)):
+    """Метрики фонового удаления контактов."""
+    return contact_purge_stats()
 
 # Обновляем endpoint, чтобы он работал даже без авторизации
 @router.get("/check-state")
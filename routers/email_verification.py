@@ -3,11 +3,14 @@ from fastapi import APIRouter, HTTPException, Depends, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from database import SessionLocal
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from database import get_async_db
 from models import User
-from utils_email_verif import send_verification_email
-from passlib.context import CryptContext
+from auth import get_current_admin
+from utils_email_verif import verification_email, password_reset_email
+from email_outbox import queue_email, email_outbox_stats
+from password_hashing import hash_password, verify_password, hashing_stats
 
 router = APIRouter(prefix="/auth", tags=["Auth and Verification"])
 
@@ -18,18 +21,6 @@ templates = Jinja2Templates(directory="templates")
 async def forgot_password_form(request: Request):
     return templates.TemplateResponse("password_reset/forgot.html", {"request": request})
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
-
 class RegisterRequest(BaseModel):
     username: str
     email: str
@@ -44,37 +35,38 @@ class LoginRequest(BaseModel):
     password: str
 
 @router.post("/register")
-async def register_user(data: RegisterRequest, db: Session = Depends(get_db)):
-    existing_email = db.query(User).filter(User.email == data.email).first()
+async def register_user(data: RegisterRequest, db: AsyncSession = Depends(get_async_db)):
+    existing_email = (await db.execute(select(User).where(User.email == data.email))).scalars().first()
     if existing_email:
         raise HTTPException(status_code=400, detail="Email уже зарегистрирован")
-    existing_username = db.query(User).filter(User.username == data.username).first()
+    existing_username = (await db.execute(select(User).where(User.username == data.username))).scalars().first()
     if existing_username:
         raise HTTPException(status_code=400, detail="Ім'я зайнято, створіть інше")
     code = "{:06d}".format(random.randint(0, 999999))
     user = User(
         username=data.username,
         email=data.email,
-        hashed_password=hash_password(data.password),
+        hashed_password=await hash_password(data.password),
         is_verified=False,
         verification_code=code
     )
     db.add(user)
-    db.commit()
-    await send_verification_email(data.email, code)
+    # Письмо отправит фоновый воркер; в outbox оно попадает вместе с пользователем
+    queue_email(db, verification_email(data.email, code))
+    await db.commit()
     return {"detail": "Проверьте почту и введите код для завершения регистрации"}
 
 @router.post("/verify")
-async def verify_email(data: VerifyRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == data.email).first()
+async def verify_email(data: VerifyRequest, db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(User).where(User.email == data.email))).scalars().first()
     if not user or user.verification_code != data.code:
         raise HTTPException(status_code=400, detail="Неверный код")
     user.is_verified = True
     user.verification_code = None
-    db.commit()
+    await db.commit()
     return {"detail": "Email подтверждён!"}
 
-async def process_password_reset_email(request: Request, user: User, db: Session):
+async def process_password_reset_email(request: Request, user: User, db: AsyncSession):
     import secrets
     from datetime import datetime, timedelta
     from models import PasswordReset
@@ -83,20 +75,19 @@ async def process_password_reset_email(request: Request, user: User, db: Session
     # Сохраняем токен
     reset_entry = PasswordReset(user_id=user.id, token=reset_token, expires_at=expires_at)
     db.add(reset_entry)
-    db.commit()
-    # Формируем ссылку
+    # Формируем ссылку; письмо сохраняется в outbox вместе с токеном
     reset_url = f"https://{request.base_url.hostname}/reset/{reset_token}"
-    from utils_email_verif import send_password_reset_email
-    await send_password_reset_email(user.email, reset_url, user.username)
+    queue_email(db, password_reset_email(user.email, reset_url, user.username))
+    await db.commit()
     return {"detail": "Лист для відновлення пароля надіслано на вашу пошту"}
 
 @router.post("/forgot")
-async def forgot_password(request: Request, db: Session = Depends(get_db)):
+async def forgot_password(request: Request, db: AsyncSession = Depends(get_async_db)):
     data = await request.json()
     email = data.get('email')
     if not email:
         raise HTTPException(status_code=400, detail="Email обов'язковий")
-    user = db.query(User).filter(User.email == email).first()
+    user = (await db.execute(select(User).where(User.email == email))).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="Перевірте чи саме на цей email ви хочете відправити листа для відновлення пароля")
     return await process_password_reset_email(request, user, db)
@@ -105,19 +96,29 @@ from fastapi import Depends
 from auth import get_current_user
 
 @router.post("/reset-password-from-settings")
-async def reset_password_from_settings(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def reset_password_from_settings(request: Request, db: AsyncSession = Depends(get_async_db), current_user: User = Depends(get_current_user)):
     if not current_user or not current_user.email:
         raise HTTPException(status_code=401, detail="Не удалось определить пользователя")
-    user = db.query(User).filter(User.email == current_user.email).first()
+    user = (await db.execute(select(User).where(User.email == current_user.email))).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     return await process_password_reset_email(request, user, db)
 
 @router.post("/login")
-def login(data: LoginRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == data.email).first()
-    if not user or not pwd_context.verify(data.password, user.hashed_password):
+async def login(data: LoginRequest, db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(User).where(User.email == data.email))).scalars().first()
+    if not user or not await verify_password(data.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Неверный email или пароль")
     if not user.is_verified:
         raise HTTPException(status_code=403, detail="Подтвердите email для входа")
     return {"detail": "Успешный вход!", "user_id": user.id}
+
+@router.get("/hash-pool-stats")
+async def hash_pool_stats(current_user: User = Depends(get_current_admin)):
+    """Метрики пула хеширования паролей: очередь, отказы, среднее ожидание и время bcrypt."""
+    return hashing_stats()
+
+@router.get("/email-outbox-stats")
+async def get_email_outbox_stats(current_user: User = Depends(get_current_admin)):
+    """Метрики отправки писем: очередь outbox, повторы, соединения SMTP."""
+    return await email_outbox_stats()
@@ -1,16 +1,23 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Response, File, UploadFile, Form
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from sqlalchemy import select, update, delete
 from datetime import timedelta, datetime
 from typing import Optional, List
 
-from database import get_db
+from database import get_async_db
 from models import User, UserAvatar, AvatarRequestMessage
-from auth import get_current_user, create_access_token
+from auth import get_current_user, get_current_admin, create_access_token
+from user_cache import invalidate_user, invalidate_profile, get_cached_profile, cache_profile
+from password_hashing import hash_password, verify_password
 from schemas import UserResponse
-from utils_cloudinary import upload_image, delete_image
+from media_pipeline import (
+    spool_upload, create_avatar_from_upload, discard_spooled, release_avatar_media, media_stats,
+    UPLOAD_PENDING, UPLOAD_DONE,
+)
+from media_cleanup import media_cleanup_stats
 # Импортируем функцию ограничения запросов
-from rate_limiter import check_rate_limit_me
+from rate_limiter import check_rate_limit_me, rate_limit_stats
 # Import sessions API
 from routers.users_sessions import router as sessions_router
 
@@ -22,53 +29,70 @@ router = APIRouter(
 User-related endpoints, including login, user info, and session management.
 """
 
+# Аватары по умолчанию, если у пользователя нет одобренного
+DEFAULT_AVATARS = {
+    "superadmin": "/static/menu/img/manager.png",
+    "admin": "/static/menu/img/ska.png",
+}
+DEFAULT_AVATAR = "/static/menu/img/avatar.png"
+
+async def resolve_avatar_urls(db: AsyncSession, user: User):
+    """
+    URL аватара и его миниатюры: основной одобренный аватар, иначе любой
+    одобренный, иначе аватар по роли.
+    """
+    avatar = (await db.execute(
+        select(UserAvatar.file_path, UserAvatar.thumbnail_url)
+        .where(UserAvatar.user_id == user.id, UserAvatar.is_approved == 1)
+        .order_by(UserAvatar.is_main.desc(), UserAvatar.id)
+        .limit(1)
+    )).first()
+    if avatar is None:
+        default = DEFAULT_AVATARS.get(user.role, DEFAULT_AVATAR)
+        return default, default
+    # Аватары, загруженные до появления вариантов, не имеют миниатюры
+    return avatar.file_path, avatar.thumbnail_url or avatar.file_path
+
+def _etag_matches(request: Request, etag: str):
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in header.split(","))
+
 @router.get("/me", response_model=UserResponse, dependencies=[Depends(check_rate_limit_me)])
-async def get_current_user_info(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_current_user_info(request: Request, response: Response, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
     Получить информацию о текущем авторизованном пользователе
-    Ограничение: 5 запросов в минуту
+    Ограничение: политика "users_me" (по умолчанию 25 запросов в минуту)
+
+    Профиль кэшируется (см. user_cache), поэтому обычно запрос выполняется
+    без обращения к БД. Поддерживается ETag: при совпадении If-None-Match
+    возвращается 304 без тела.
     """
-    # Получаем основной аватар пользователя (если есть) - используем явный запрос вместо lazy loading
-    avatar_url = None
-    
-    # Получаем пользователя с активной сессией
-    user_with_session = db.query(User).filter(User.id == current_user.id).first()
-    
-    if user_with_session:
-        # Загружаем аватары пользователя (если есть)
-        avatars = db.query(UserAvatar).filter(UserAvatar.user_id == user_with_session.id).all()
-        
-        if avatars:
-            # Ищем основной аватар со статусом approved
-            main_avatar = next((avatar for avatar in avatars 
-                                if avatar.is_main == 1 and avatar.is_approved == 1), None)
-            if main_avatar:
-                avatar_url = main_avatar.file_path
-            else:
-                # Если основного нет, берем первый approved
-                approved_avatar = next((avatar for avatar in avatars 
-                                       if avatar.is_approved == 1), None)
-                if approved_avatar:
-                    avatar_url = approved_avatar.file_path
-    
-    # Если аватар не найден, используем стандартный в зависимости от роли
-    if not avatar_url:
-        if user_with_session.role == "superadmin":
-            avatar_url = "/static/menu/img/manager.png"
-        elif user_with_session.role == "admin":
-            avatar_url = "/static/menu/img/ska.png"
-        else:
-            avatar_url = "/static/menu/img/avatar.png"
-    
-    return {
-        "id": current_user.id,
-        "username": current_user.username,
-        "email": current_user.email,
-        "role": current_user.role,
-        "avatar_url": avatar_url,
-        "created_at": getattr(current_user, 'created_at', None),
-        "updated_at": getattr(current_user, 'updated_at', None)
-    }
+    profile = await get_cached_profile(current_user.id)
+    if profile is None:
+        avatar_url, avatar_thumbnail_url = await resolve_avatar_urls(db, current_user)
+        profile = await cache_profile(current_user.id, {
+            "id": current_user.id,
+            "username": current_user.username,
+            "email": current_user.email,
+            "role": current_user.role,
+            "avatar_url": avatar_url,
+            "avatar_thumbnail_url": avatar_thumbnail_url,
+            "created_at": getattr(current_user, 'created_at', None),
+            "updated_at": getattr(current_user, 'updated_at', None)
+        })
+
+    headers = {"ETag": profile["etag"], "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, profile["etag"]):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return {key: value for key, value in profile.items() if key != "etag"}
+
+@router.get("/rate-limit-stats")
+async def get_rate_limit_stats(current_user: User = Depends(get_current_admin)):
+    """Метрики rate limiter: политики, число разрешений и отказов, время принятия решения."""
+    return rate_limit_stats()
 
 @router.patch("/update/username")
 async def update_username(
@@ -76,7 +100,7 @@ async def update_username(
     response: Response,
     username_data: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Обновить имя пользователя
@@ -87,19 +111,23 @@ async def update_username(
     new_username = username_data["username"]
     
     # Проверка, не занято ли имя пользователя
-    existing_user = db.query(User).filter(User.username == new_username, User.id != current_user.id).first()
+    existing_user = (await db.execute(
+        select(User).where(User.username == new_username, User.id != current_user.id)
+    )).scalars().first()
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already taken")
     
     # Получаем пользователя из текущей сессии для обновления
-    user_to_update = db.query(User).filter(User.id == current_user.id).first()
+    user_to_update = (await db.execute(select(User).where(User.id == current_user.id))).scalars().first()
     if not user_to_update:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Обновляем имя пользователя
+    old_username = user_to_update.username
     user_to_update.username = new_username
-    db.commit()
-    db.refresh(user_to_update)
+    await db.commit()
+    await db.refresh(user_to_update)
+    await invalidate_user(user_to_update.id, old_username, new_username)
     
     # Создаем новый токен с обновленным именем пользователя
     access_token_expires = timedelta(minutes=60 * 24 * 7)  # 7 дней
@@ -124,7 +152,7 @@ async def update_password(
     request: Request,
     password_data: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Обновить пароль пользователя
@@ -133,17 +161,18 @@ async def update_password(
         raise HTTPException(status_code=400, detail="Current password and new password are required")
     
     # Получаем пользователя из текущей сессии для обновления
-    user_to_update = db.query(User).filter(User.id == current_user.id).first()
+    user_to_update = (await db.execute(select(User).where(User.id == current_user.id))).scalars().first()
     if not user_to_update:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Проверка текущего пароля
-    if not user_to_update.verify_password(password_data["current_password"]):
+    if not await verify_password(password_data["current_password"], user_to_update.hashed_password):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
     
     # Обновляем пароль
-    user_to_update.hashed_password = User.get_password_hash(password_data["new_password"])
-    db.commit()
+    user_to_update.hashed_password = await hash_password(password_data["new_password"])
+    await db.commit()
+    await invalidate_user(user_to_update.id, user_to_update.username)
     
     return {"message": "Password updated successfully"}
 
@@ -151,7 +180,7 @@ async def update_password(
 async def reset_password(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Инициировать процесс сброса пароля
@@ -160,7 +189,7 @@ async def reset_password(
     # Для упрощения в тестовой версии просто возвращаем ответ об успехе
     
     # Получаем пользователя из текущей сессии
-    user_to_reset = db.query(User).filter(User.id == current_user.id).first()
+    user_to_reset = (await db.execute(select(User).where(User.id == current_user.id))).scalars().first()
     if not user_to_reset:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -174,20 +203,23 @@ async def reset_password(
 async def get_user_avatars(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Получить список всех аватаров пользователя
     """
-    avatars = db.query(UserAvatar).filter(UserAvatar.user_id == current_user.id).all()
+    avatars = (await db.execute(select(UserAvatar).where(UserAvatar.user_id == current_user.id))).scalars().all()
     
     return [
         {
             "id": avatar.id,
             "file_path": avatar.file_path,
+            "thumbnail_url": avatar.thumbnail_url or avatar.file_path,
+            "variants": {name: v["url"] for name, v in (avatar.variants or {}).items()},
             "is_main": avatar.is_main == 1,
             "is_approved": avatar.is_approved == 1,
             "request_status": avatar.request_status,
+            "upload_status": avatar.upload_status,
             "created_at": avatar.created_at
         }
         for avatar in avatars
@@ -198,17 +230,17 @@ async def upload_user_avatar(
     request: Request,
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Загрузить новый аватар пользователя
     """
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
+    # Файл сохраняется на диск, а в Cloudinary его загружает фоновый воркер
+    # (если такое изображение уже загружалось, используется существующее)
+    upload = await spool_upload(file)
     try:
-        url, public_id = upload_image(await file.read())
-        if not url or not public_id:
-            raise HTTPException(status_code=500, detail="Failed to upload avatar")
         # Для админов — сразу approved и основным
         #if current_user.role in ["admin", "superadmin"]:
         #    is_approved = 1
@@ -218,73 +250,86 @@ async def upload_user_avatar(
         is_approved = 0
         request_status = 0
         is_main = 0
-        new_avatar = UserAvatar(
-            user_id=current_user.id,
-            file_path=url,
-            cloudinary_public_id=public_id,
+        new_avatar = await create_avatar_from_upload(
+            db,
+            current_user.id,
+            upload,
             is_approved=is_approved,
             is_main=is_main,
             request_type='upload',
             request_status=request_status
         )
-        db.add(new_avatar)
-        db.commit()
-        db.refresh(new_avatar)
-        return {
-            "id": new_avatar.id,
-            "file_path": new_avatar.file_path,
-            "is_main": new_avatar.is_main == 1,
-            "is_approved": new_avatar.is_approved == 1,
-            "request_status": new_avatar.request_status,
-            "message": "Avatar uploaded successfully"
-        }
     except Exception as e:
+        discard_spooled(upload)
         print(f"Error uploading avatar: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to upload avatar: {str(e)}")
+    return {
+        "id": new_avatar.id,
+        "file_path": new_avatar.file_path,
+        "thumbnail_url": new_avatar.thumbnail_url or new_avatar.file_path,
+        "is_main": new_avatar.is_main == 1,
+        "is_approved": new_avatar.is_approved == 1,
+        "request_status": new_avatar.request_status,
+        "upload_status": new_avatar.upload_status,
+        "message": "Avatar upload queued" if new_avatar.upload_status == UPLOAD_PENDING else "Avatar uploaded successfully"
+    }
+
+@router.get("/avatars/upload-stats")
+async def get_avatar_upload_stats(current_user: User = Depends(get_current_admin)):
+    """Метрики фоновой загрузки аватаров: очередь, повторы, ошибки."""
+    return media_stats()
+
+@router.get("/avatars/deletion-stats")
+async def get_media_deletion_stats(current_user: User = Depends(get_current_admin)):
+    """Метрики отложенного удаления изображений из Cloudinary."""
+    return await media_cleanup_stats()
 
 @router.patch("/avatars/{avatar_id}/set-main")
 async def set_avatar_as_main(
     request: Request,
     avatar_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Установить аватар как основной (только после одобрения админом)
     """
-    avatar = db.query(UserAvatar).filter(
+    avatar = (await db.execute(select(UserAvatar).where(
         UserAvatar.id == avatar_id,
         UserAvatar.user_id == current_user.id
-    ).first()
+    ))).scalars().first()
     if not avatar:
         raise HTTPException(status_code=404, detail="Avatar not found or not owned by user")
+    if avatar.upload_status != UPLOAD_DONE:
+        raise HTTPException(status_code=409, detail="Avatar is not uploaded yet")
     if current_user.role in ["admin", "superadmin"]:
         # Для админа — сразу делаем основным
-        db.query(UserAvatar).filter(UserAvatar.user_id == current_user.id).update({
-            "request_status": 0,
-            "is_main": 0
-        })
+        await db.execute(update(UserAvatar).where(UserAvatar.user_id == current_user.id).values(
+            request_status=0,
+            is_main=0
+        ))
         avatar.is_main = 1
         avatar.is_approved = 1
         avatar.request_status = 3
-        db.commit()
+        await db.commit()
+        await invalidate_profile(current_user.id)
         return {"message": "Avatar set as main successfully"}
     # Для обычных пользователей — только заявка, НЕ сбрасываем основную!
     # Только сбрасываем pending/rejected у всех, но не is_main
-    db.query(UserAvatar).filter(UserAvatar.user_id == current_user.id).update({
-        "request_status": 0
-    })
+    await db.execute(update(UserAvatar).where(UserAvatar.user_id == current_user.id).values(
+        request_status=0
+    ))
     avatar.request_type = 'set_main'
     avatar.request_status = 1
     avatar.is_main = 0
     avatar.is_approved = 0
-    db.commit()
+    await db.commit()
     # Сбросить все pending-заявки в AvatarRequestMessage
-    db.query(AvatarRequestMessage).filter(
+    await db.execute(delete(AvatarRequestMessage).where(
         AvatarRequestMessage.user_id == current_user.id,
         AvatarRequestMessage.status == 1
-    ).delete()
-    db.commit()
+    ))
+    await db.commit()
     # Создаём заявку
     msg = AvatarRequestMessage(
         user_id=current_user.id,
@@ -294,7 +339,8 @@ async def set_avatar_as_main(
         created_at=datetime.utcnow()
     )
     db.add(msg)
-    db.commit()
+    await db.commit()
+    await invalidate_profile(current_user.id)
     return {"message": "Request to set avatar as main sent for approval"}
 
 @router.post("/avatar-requests/{avatar_id}/approve")
@@ -302,19 +348,19 @@ async def approve_avatar_request(
     request: Request,
     avatar_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role not in ["admin", "superadmin"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    avatar = db.query(UserAvatar).filter(UserAvatar.id == avatar_id).first()
+    avatar = (await db.execute(select(UserAvatar).where(UserAvatar.id == avatar_id))).scalars().first()
     if not avatar:
         raise HTTPException(status_code=404, detail="Avatar not found")
     # Находим заявку
-    req = db.query(AvatarRequestMessage).filter(AvatarRequestMessage.avatar_id == avatar_id, AvatarRequestMessage.status == 1).first()
+    req = (await db.execute(select(AvatarRequestMessage).where(AvatarRequestMessage.avatar_id == avatar_id, AvatarRequestMessage.status == 1))).scalars().first()
     if not req:
         raise HTTPException(status_code=404, detail="Request not found")
     # Сбросить is_main у всех аватарок пользователя
-    db.query(UserAvatar).filter(UserAvatar.user_id == avatar.user_id).update({"is_main": 0})
+    await db.execute(update(UserAvatar).where(UserAvatar.user_id == avatar.user_id).values(is_main=0))
     # Обновляем статусы
     avatar.is_approved = 1
     avatar.request_status = 3
@@ -322,7 +368,8 @@ async def approve_avatar_request(
     req.status = 3
     req.reviewed_by = current_user.id
     req.reviewed_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
+    await invalidate_profile(avatar.user_id)
     return {"message": "Avatar request approved"}
 
 @router.post("/{user_id}/set-role")
@@ -331,24 +378,25 @@ async def set_user_role(
     user_id: int,
     new_role: str = Form(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role not in ["admin", "superadmin"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     if new_role not in ["user", "admin", "superadmin"]:
         raise HTTPException(status_code=400, detail="Invalid role")
-    user = db.query(User).filter(User.id == user_id).first()
+    user = (await db.execute(select(User).where(User.id == user_id))).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     user.role = new_role
-    db.commit()
+    await db.commit()
+    await invalidate_user(user.id, user.username)
     return {"message": f"User role set to {new_role}"}
 
 @router.get("/permissions", response_model=List[dict])
 async def get_users_with_permissions(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Получить всех пользователей с их ролями, аватарами и pending заявками на смену аватара.
@@ -357,9 +405,13 @@ async def get_users_with_permissions(
     if current_user.role not in ["admin", "superadmin"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
 
-    users = db.query(User).options(joinedload(User.avatars)).all()
+    users = (await db.execute(select(User).options(selectinload(User.avatars)))).scalars().all()
     # Получаем pending заявки на смену аватара
-    pending_requests = db.query(AvatarRequestMessage).filter(AvatarRequestMessage.status == 1).all()
+    pending_requests = (await db.execute(
+        select(AvatarRequestMessage)
+        .options(selectinload(AvatarRequestMessage.avatar))
+        .where(AvatarRequestMessage.status == 1)
+    )).scalars().all()
     # Группируем pending заявки по user_id
     requests_by_user = {}
     for req in pending_requests:
@@ -369,6 +421,7 @@ async def get_users_with_permissions(
             "id": req.id,
             "avatar_id": req.avatar_id,
             "avatar_url": req.avatar.file_path if req.avatar else None,
+            "avatar_thumbnail_url": (req.avatar.thumbnail_url or req.avatar.file_path) if req.avatar else None,
             "request_type": req.avatar.request_type if req.avatar else None,
             "status": req.status,
             "created_at": req.created_at,
@@ -383,6 +436,7 @@ async def get_users_with_permissions(
             # Если нет основного, ищем любой одобренный
             main_avatar = next((a for a in user.avatars if a.is_approved == 1), None)
         main_avatar_url = main_avatar.file_path if main_avatar else None
+        main_avatar_thumbnail_url = (main_avatar.thumbnail_url or main_avatar.file_path) if main_avatar else None
         # Все аватары пользователя
         avatars = [{
             "id": a.id,
@@ -399,6 +453,7 @@ async def get_users_with_permissions(
             "email": user.email,
             "role": user.role,
             "main_avatar_url": main_avatar_url,
+            "main_avatar_thumbnail_url": main_avatar_thumbnail_url,
             "avatars": avatars,
             "pending_avatar_requests": pending
         })
@@ -409,33 +464,35 @@ async def request_avatar_as_main(
     request: Request,
     avatar_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Пользователь отправляет запрос на сделать аватар основным. Все предыдущие pending-запросы удаляются.
     """
-    avatar = db.query(UserAvatar).filter(UserAvatar.id == avatar_id, UserAvatar.user_id == current_user.id).first()
+    avatar = (await db.execute(select(UserAvatar).where(UserAvatar.id == avatar_id, UserAvatar.user_id == current_user.id))).scalars().first()
     if not avatar:
         raise HTTPException(status_code=404, detail="Avatar not found or not owned by user")
+    if avatar.upload_status != UPLOAD_DONE:
+        raise HTTPException(status_code=409, detail="Avatar is not uploaded yet")
     # --- Сбросить pending у всех других аватарок пользователя при создании новой заявки ---
-    db.query(UserAvatar).filter(
+    await db.execute(update(UserAvatar).where(
         UserAvatar.user_id == current_user.id,
         UserAvatar.id != avatar.id,
         UserAvatar.request_status == 1
-    ).update({"request_status": 0, "is_approved": 0, "is_main": 0})
-    db.commit()
+    ).values(request_status=0, is_approved=0, is_main=0))
+    await db.commit()
     avatar.request_type = 'set_main'
     avatar.request_status = 1  # pending
     avatar.is_main = 0
     avatar.is_approved = 0
-    db.commit()
+    await db.commit()
     # Сбросить все pending-заявки в AvatarRequestMessage (кроме новой)
-    db.query(AvatarRequestMessage).filter(
+    await db.execute(delete(AvatarRequestMessage).where(
         AvatarRequestMessage.user_id == current_user.id,
         AvatarRequestMessage.avatar_id != avatar.id,
         AvatarRequestMessage.status == 1
-    ).delete()
-    db.commit()
+    ))
+    await db.commit()
     # Создаём заявку
     msg = AvatarRequestMessage(
         user_id=current_user.id,
@@ -445,7 +502,8 @@ async def request_avatar_as_main(
         created_at=datetime.utcnow()
     )
     db.add(msg)
-    db.commit()
+    await db.commit()
+    await invalidate_profile(current_user.id)
     return {"message": "Request to set avatar as main sent for approval"}
 
 @router.delete("/avatar-requests/{avatar_id}/cancel")
@@ -453,24 +511,25 @@ async def cancel_avatar_request(
     request: Request,
     avatar_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Пользователь отменяет pending-запрос на смену основного аватара.
     """
-    avatar = db.query(UserAvatar).filter(UserAvatar.id == avatar_id, UserAvatar.user_id == current_user.id).first()
+    avatar = (await db.execute(select(UserAvatar).where(UserAvatar.id == avatar_id, UserAvatar.user_id == current_user.id))).scalars().first()
     if not avatar:
         raise HTTPException(status_code=404, detail="Avatar not found or not owned by user")
     # Попытаться найти и удалить pending-запрос
-    req = db.query(AvatarRequestMessage).filter(AvatarRequestMessage.avatar_id == avatar_id, AvatarRequestMessage.status == 1).first()
+    req = (await db.execute(select(AvatarRequestMessage).where(AvatarRequestMessage.avatar_id == avatar_id, AvatarRequestMessage.status == 1))).scalars().first()
     if req:
-        db.delete(req)
-        db.commit()
+        await db.delete(req)
+        await db.commit()
     # --- Всегда сбрасывать pending у аватарки ---
     avatar.request_status = 0
     avatar.is_approved = 0
     avatar.is_main = 0
-    db.commit()
+    await db.commit()
+    await invalidate_profile(current_user.id)
     return {"message": "Pending request cancelled"}
 
 @router.post("/avatar-requests/{avatar_id}/reject")
@@ -478,14 +537,14 @@ async def reject_avatar_request(
     request: Request,
     avatar_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role not in ["admin", "superadmin"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    avatar = db.query(UserAvatar).filter(UserAvatar.id == avatar_id).first()
+    avatar = (await db.execute(select(UserAvatar).where(UserAvatar.id == avatar_id))).scalars().first()
     if not avatar:
         raise HTTPException(status_code=404, detail="Avatar not found")
-    req = db.query(AvatarRequestMessage).filter(AvatarRequestMessage.avatar_id == avatar_id, AvatarRequestMessage.status == 1).first()
+    req = (await db.execute(select(AvatarRequestMessage).where(AvatarRequestMessage.avatar_id == avatar_id, AvatarRequestMessage.status == 1))).scalars().first()
     if not req:
         raise HTTPException(status_code=404, detail="Request not found")
     was_main = avatar.is_main
@@ -495,13 +554,14 @@ async def reject_avatar_request(
     req.status = 2
     req.reviewed_by = current_user.id
     req.reviewed_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
     # --- Исправление: если отклонена основная аватарка, назначить другую одобренную как основную ---
     if was_main:
-        other_approved = db.query(UserAvatar).filter(UserAvatar.user_id == avatar.user_id, UserAvatar.is_approved == 1, UserAvatar.id != avatar.id).order_by(UserAvatar.created_at.desc()).first()
+        other_approved = (await db.execute(select(UserAvatar).where(UserAvatar.user_id == avatar.user_id, UserAvatar.is_approved == 1, UserAvatar.id != avatar.id).order_by(UserAvatar.created_at.desc()))).scalars().first()
         if other_approved:
             other_approved.is_main = 1
-            db.commit()
+            await db.commit()
+    await invalidate_profile(avatar.user_id)
     return {"message": "Avatar request rejected"}
 
 @router.delete("/avatars/{avatar_id}")
@@ -509,16 +569,16 @@ async def delete_user_avatar(
     request: Request,
     avatar_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Удалить аватар пользователя
     """
     # Проверяем, существует ли аватар и принадлежит ли он пользователю
-    avatar = db.query(UserAvatar).filter(
+    avatar = (await db.execute(select(UserAvatar).where(
         UserAvatar.id == avatar_id,
         UserAvatar.user_id == current_user.id
-    ).first()
+    ))).scalars().first()
     
     if not avatar:
         raise HTTPException(status_code=404, detail="Avatar not found or not owned by user")
@@ -526,37 +586,36 @@ async def delete_user_avatar(
     # Если удаляемый аватар был основным, нужно выбрать другой аватар как основной
     was_main = avatar.is_main == 1
     
-    # Если у аватара есть public_id в Cloudinary, удаляем изображение из Cloudinary
-    if hasattr(avatar, 'cloudinary_public_id') and avatar.cloudinary_public_id:
-        delete_image(avatar.cloudinary_public_id)
-    
-    # Удаляем из базы данных
-    db.delete(avatar)
-    db.commit()
+    # Удаляем из базы данных; изображения, на которые больше не ссылаются
+    # другие аватары, удаляются из Cloudinary в фоне (media_cleanup)
+    await db.delete(avatar)
+    await db.flush()
+    await release_avatar_media(db, avatar)
     
     # Если удаленный аватар был основным, устанавливаем следующий доступный как основной
     if was_main:
-        next_avatar = db.query(UserAvatar).filter(
+        next_avatar = (await db.execute(select(UserAvatar).where(
             UserAvatar.user_id == current_user.id,
             UserAvatar.is_approved == 1
-        ).first()
+        ).limit(1))).scalars().first()
         
         if next_avatar:
             next_avatar.is_main = 1
-            db.commit()
+    await db.commit()
     
+    await invalidate_profile(current_user.id)
     return {"message": "Avatar deleted successfully"}
 
 @router.get("/avatar-requests", response_model=List[dict])
 async def get_avatar_requests(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role not in ["admin", "superadmin"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     # Показываем только pending заявки
-    requests = db.query(AvatarRequestMessage).options(joinedload(AvatarRequestMessage.user), joinedload(AvatarRequestMessage.avatar)).filter(AvatarRequestMessage.status == 1).all()
+    requests = (await db.execute(select(AvatarRequestMessage).options(selectinload(AvatarRequestMessage.user), selectinload(AvatarRequestMessage.avatar)).where(AvatarRequestMessage.status == 1))).scalars().all()
     result = []
     for req in requests:
         result.append({
@@ -566,6 +625,7 @@ async def get_avatar_requests(
             "email": req.user.email if req.user else None,
             "avatar_id": req.avatar_id,
             "avatar_url": req.avatar.file_path if req.avatar else None,
+            "avatar_thumbnail_url": (req.avatar.thumbnail_url or req.avatar.file_path) if req.avatar else None,
             "request_type": req.avatar.request_type if req.avatar else None,
             "status": req.status,
             "created_at": req.created_at,
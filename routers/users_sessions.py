@@ -1,5 +1,5 @@
-from fastapi import APIRouter, Depends, HTTPException
-from redis_client import get_all_active_user_sessions
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from redis_client import get_active_user_sessions
 from typing import List, Dict
 
 router = APIRouter(
@@ -8,11 +8,16 @@ router = APIRouter(
 )
 
 @router.get("/active", response_model=List[Dict])
-def get_active_sessions():
+async def get_active_sessions(
+    response: Response,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000)
+):
     """
-    Returns a list of active user sessions from Redis.
+    Returns a page of active user sessions from Redis, most recent first.
     Each session contains user id, username, email, role, etc.
+    The total number of active sessions is returned in the X-Total-Count header.
     """
-    sessions = get_all_active_user_sessions()
-    # Convert sessions dict to list of dicts
-    return list(sessions.values())
+    sessions, total = await get_active_user_sessions(offset=offset, limit=limit)
+    response.headers["X-Total-Count"] = str(total)
+    return sessions
@@ -1,8 +1,14 @@
-from typing import List, Optional
+from typing import List, Optional, Literal
 from datetime import date, datetime
-from pydantic import BaseModel, EmailStr, Field, constr, validator
+from pydantic import BaseModel, EmailStr, Field, ValidationError, constr, validator
 import re
 
+def validation_error_message(e: ValidationError):
+    """Ошибки проверки схемы одной строкой: "поле: причина; ..."."""
+    return "; ".join(
+        f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+    )
+
 class PhoneNumberBase(BaseModel):
     number: constr(strip_whitespace=True, min_length=2, max_length=32)  
     label: Optional[str] = Field(default=None, description="Label: any string or None")
@@ -74,6 +80,47 @@ class Contact(ContactBase):
     class Config:
         orm_mode = True
 
+class ContactBatchDelete(BaseModel):
+    """id контактов для пакетного удаления."""
+    ids: List[int] = Field(..., min_length=1, max_length=1000)
+
+class ContactBatchDeleteResult(BaseModel):
+    deleted: List[int] = []
+    not_found: List[int] = []  # нет такого контакта или нет доступа к нему
+
+class ContactBatchOperation(BaseModel):
+    """
+    Операция пакетного изменения. data — поля ContactCreate (create) или
+    ContactUpdate (update); они проверяются для каждой операции отдельно,
+    чтобы ошибка одной не отклоняла весь пакет.
+    """
+    op: Literal["create", "update", "delete", "set_groups", "add_groups", "remove_groups"]
+    id: Optional[int] = None  # контакт для update, delete и операций с группами
+    data: Optional[dict] = None
+    group_ids: Optional[List[int]] = None
+
+class ContactBatchRequest(BaseModel):
+    operations: List[ContactBatchOperation] = Field(..., min_length=1, max_length=1000)
+    atomic: bool = False  # True — при ошибке любой операции не применяется ни одна
+
+class ContactBatchItemResult(BaseModel):
+    index: int
+    op: str
+    id: Optional[int] = None
+    status: int  # код, который вернул бы одиночный запрос: 200, 201, 400, 403, 404
+    error: Optional[str] = None
+
+class ContactBatchResult(BaseModel):
+    results: List[ContactBatchItemResult]
+    succeeded: int
+    failed: int
+    committed: bool
+
+class ContactPage(BaseModel):
+    """Страница контактов для keyset-пагинации."""
+    items: List[Contact] = []
+    next_cursor: Optional[str] = None
+
 # Добавляю класс UserResponse для эндпоинта /users/me
 class UserResponse(BaseModel):
     id: int
@@ -81,6 +128,7 @@ class UserResponse(BaseModel):
     email: EmailStr
     role: str
     avatar_url: Optional[str] = None
+    avatar_thumbnail_url: Optional[str] = None
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
     
@@ -93,6 +141,8 @@ class UserWithContacts(BaseModel):
     email: EmailStr
     role: str
     contacts: List[Contact] = []
+    contacts_total: int = 0  # Всего контактов пользователя (с учётом поиска), а не только на странице
+    next_cursor: Optional[str] = None  # Курсор продолжения для /contacts/page?user_id=...
     class Config:
         orm_mode = True
 
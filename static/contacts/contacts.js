@@ -91,6 +91,14 @@ let alphaSortDir = 'asc'; // глобальне напрям сортуванн
 let expandedContactId = null; // id индивидуально раскрытого контакта
 let birthdayMode = false; // глобальный режим дней рождений
 let contactsCache = []; // Глобальный кэш контактов
+let contactsPageUrl = null; // URL текущего списка для /contacts/page (без курсора)
+let contactsNextCursor = null; // Курсор следующей страницы (null — страниц больше нет)
+let contactsPageLoading = false;
+// Админский вид (/contacts/grouped) грузится страницами пользователей
+const GROUPED_USERS_PAGE = 50;
+let groupedUrl = null; // URL текущего списка /contacts/grouped (без users_offset)
+let groupedQuery = ''; // search/sort текущего списка — для догрузки контактов пользователя
+let groupedUsersOffset = null; // users_offset следующей страницы (null — пользователей больше нет)
 
 // --- Перемикач вигляду контактів ---
 document.addEventListener('DOMContentLoaded', function() {
@@ -329,28 +337,45 @@ async function fetchContacts() {
   // Определяем, является ли пользователь админом или суперадмином
   const isAdminOrSuper = userRole === 'admin' || userRole === 'superadmin';
   
-  // Для обычных пользователей — старый endpoint
+  // Для обычных пользователей — постраничный endpoint с курсором (бесконечная прокрутка)
   if (!isAdminOrSuper) {
+    groupedUrl = null;
+    groupedUsersOffset = null;
     params.push('limit=100');
     const userId = window.selectedUserId;
     if (userId) params.push('user_id=' + encodeURIComponent(userId));
-    const url = '/contacts' + (params.length ? '?' + params.join('&') : '');
+    const url = '/contacts/page?' + params.join('&');
+    contactsPageUrl = url;
+    contactsNextCursor = null;
     try {
       console.log('Выполняется запрос для обычного пользователя:', url);
       // Используем authorizedFetch для отправки JWT-токена
-      return await authorizedFetch(url);
+      const page = await authorizedFetch(url);
+      contactsNextCursor = (page && page.next_cursor) || null;
+      return (page && page.items) || [];
     } catch (error) {
       console.error('Ошибка при запросе контактов для обычного пользователя:', error);
       return [];
     }
   } else {
-    // Для админа и супер-админа — новый endpoint
-    const url = '/contacts/grouped' + (params.length ? '?' + params.join('&') : '');
+    contactsPageUrl = null;
+    contactsNextCursor = null;
+    // Для админа и супер-админа — новый endpoint, первая страница пользователей;
+    // остальные догружаются при прокрутке, контакты пользователя — кнопкой "Показати ще"
+    groupedQuery = params.join('&');
+    const url = '/contacts/grouped?' + params.concat('users_limit=' + GROUPED_USERS_PAGE).join('&');
+    groupedUrl = url;
+    groupedUsersOffset = null;
     try {
       console.log('Выполняется запрос для админа/суперадмина:', url);
       // Используем authorizedFetch для отправки JWT-токена
-      return await authorizedFetch(url);
+      const users = await authorizedFetch(url);
+      if (url === groupedUrl && Array.isArray(users) && users.length === GROUPED_USERS_PAGE) {
+        groupedUsersOffset = users.length;
+      }
+      return users;
     } catch (error) {
+      groupedUrl = null;
       console.error('Ошибка при запросе контактов для админа/суперадмина:', error, 'userRole =', userRole);
       // Если запрос к групповому эндпоинту не удался, попробуем обычный эндпоинт как запасной вариант
       try {
@@ -373,6 +398,75 @@ async function fetchContact(id) {
   return await authorizedFetch(url);
 }
 
+// --- Секция пользователя в админском виде (/contacts/grouped) ---
+async function renderUserSection(user) {
+  // Получаем ID текущего пользователя для сравнения
+  const currentUserId = window.currentUserId || '';
+  let html = '';
+  // Добавляем кнопку смены роли только для админов и обычных пользователей
+  // Но не для суперадминов и не для текущего пользователя
+  const userRole = user.role || 'user';
+  let roleButtonHtml = '';
+  
+  // Проверяем, что это не суперадмин и не текущий пользователь
+  if (userRole !== 'superadmin' && String(user.id) !== String(currentUserId)) {
+    const newRole = userRole === 'admin' ? 'user' : 'admin';
+    const btnText = userRole === 'admin' ? 'Зробити просто юзером' : 'Зробити адміном';
+    roleButtonHtml = `<button class="change-role-btn" data-user-id="${user.id}" data-current-role="${userRole}" data-new-role="${newRole}">${btnText}</button>`;
+  }
+  
+  html += `<div class="user-contacts-section" data-user-id="${user.id}">
+    <div class="user-header">
+      <b>${user.username}</b> <span style="color:#b6d5fa">(${user.email}, ${userRole})</span>
+      ${roleButtonHtml}
+    </div>
+    <div class="user-contacts-list">`;
+    
+  // Проверяем наличие контактов
+  if (Array.isArray(user.contacts) && user.contacts.length) {
+    // Правильное отображение контактов в зависимости от выбранного режима просмотра
+    if (contactsViewMode === 4) {
+      // Для режима viewMode 4 используем функцию renderFullContactTile
+      html += user.contacts.map(contact => renderFullContactTile(contact)).join('');
+    } else {
+      // Для других режимов обрабатываем каждый контакт
+      const contactsHtml = [];
+      
+      for (const contact of user.contacts) {
+        // Проверяем, является ли контакт раскрытым
+        if (expandedContactId && contact.id.toString() === expandedContactId) {
+          // Если контакт раскрыт, получаем его полные данные и рендерим в расширенном виде
+          try {
+            const userId = user.id;
+            let url = `/contacts/${contact.id}`;
+            if (userId) url += `?user_id=${encodeURIComponent(userId)}`;
+            const fullContact = await authorizedFetch(url);
+            contactsHtml.push(renderFullContactTile(fullContact));
+          } catch (error) {
+            console.error('Ошибка при загрузке полных данных контакта:', error);
+            contactsHtml.push(renderContactTile(contact, contactsViewMode));
+          }
+        } else {
+          // Если контакт не раскрыт, рендерим его в обычном виде
+          contactsHtml.push(renderContactTile(contact, contactsViewMode));
+        }
+      }
+      
+      html += contactsHtml.join('');
+    }
+  } else {
+    html += '<div style="margin-left:1em;opacity:0.7">— Контактів немає —</div>';
+  }
+  
+  html += `</div>`;
+  // Остальные контакты пользователя догружаются через /contacts/page по его курсору
+  if (user.next_cursor) {
+    html += `<button class="load-more-user-contacts" data-user-id="${user.id}">Показати ще (${user.contacts.length} з ${user.contacts_total})</button>`;
+  }
+  html += `</div><hr style="margin:14px 0;opacity:0.2">`;
+  return html;
+}
+
 async function renderContacts() {
   if (birthdayMode) return; // Не рендерить обычные контакты, если активен шаблон дней рожденья
   const list = document.getElementById('contacts-list');
@@ -389,67 +483,8 @@ async function renderContacts() {
     if (!Array.isArray(data) || !data.length) {
       html = '<div>Контакти не знайдено</div>';
     } else {
-      // Получаем ID текущего пользователя для сравнения
-      const currentUserId = window.currentUserId || '';
-      
       for (const user of data) {
-        // Добавляем кнопку смены роли только для админов и обычных пользователей
-        // Но не для суперадминов и не для текущего пользователя
-        const userRole = user.role || 'user';
-        let roleButtonHtml = '';
-        
-        // Проверяем, что это не суперадмин и не текущий пользователь
-        if (userRole !== 'superadmin' && String(user.id) !== String(currentUserId)) {
-          const newRole = userRole === 'admin' ? 'user' : 'admin';
-          const btnText = userRole === 'admin' ? 'Зробити просто юзером' : 'Зробити адміном';
-          roleButtonHtml = `<button class="change-role-btn" data-user-id="${user.id}" data-current-role="${userRole}" data-new-role="${newRole}">${btnText}</button>`;
-        }
-        
-        html += `<div class="user-contacts-section">
-          <div class="user-header">
-            <b>${user.username}</b> <span style="color:#b6d5fa">(${user.email}, ${userRole})</span>
-            ${roleButtonHtml}
-          </div>
-          <div class="user-contacts-list">`;
-          
-        // Проверяем наличие контактов
-        if (Array.isArray(user.contacts) && user.contacts.length) {
-          // Правильное отображение контактов в зависимости от выбранного режима просмотра
-          if (contactsViewMode === 4) {
-            // Для режима viewMode 4 используем функцию renderFullContactTile
-            html += user.contacts.map(contact => renderFullContactTile(contact)).join('');
-          } else {
-            // Для других режимов обрабатываем каждый контакт
-            const contactsHtml = [];
-            
-            for (const contact of user.contacts) {
-              // Проверяем, является ли контакт раскрытым
-              if (expandedContactId && contact.id.toString() === expandedContactId) {
-                // Если контакт раскрыт, получаем его полные данные и рендерим в расширенном виде
-                try {
-                  const userId = user.id;
-                  let url = `/contacts/${contact.id}`;
-                  if (userId) url += `?user_id=${encodeURIComponent(userId)}`;
-                  const fullContact = await authorizedFetch(url);
-                  contactsHtml.push(renderFullContactTile(fullContact));
-                } catch (error) {
-                  console.error('Ошибка при загрузке полных данных контакта:', error);
-                  contactsHtml.push(renderContactTile(contact, contactsViewMode));
-                }
-              } else {
-                // Если контакт не раскрыт, рендерим его в обычном виде
-                contactsHtml.push(renderContactTile(contact, contactsViewMode));
-              }
-            }
-            
-            html += contactsHtml.join('');
-          }
-        } else {
-          html += '<div style="margin-left:1em;opacity:0.7">— Контактів немає —</div>';
-        }
-        
-        html += `</div>
-        </div><hr style="margin:14px 0;opacity:0.2">`;
+        html += await renderUserSection(user);
       }
     }
     list.innerHTML = html;
@@ -473,6 +508,98 @@ async function renderContacts() {
   list.innerHTML = tilesHtml.join('');
 }
 
+// --- Догрузка следующей страницы при прокрутке ---
+async function loadMoreContacts() {
+  if (groupedUrl) return loadMoreGroupedUsers();
+  if (birthdayMode || contactsPageLoading || !contactsNextCursor || !contactsPageUrl) return;
+  contactsPageLoading = true;
+  const pageUrl = contactsPageUrl;
+  try {
+    const page = await authorizedFetch(pageUrl + '&cursor=' + encodeURIComponent(contactsNextCursor));
+    // Пока грузили, список мог смениться (поиск, сортировка) — тогда страница устарела
+    if (pageUrl !== contactsPageUrl || birthdayMode) return;
+    const items = (page && page.items) || [];
+    contactsNextCursor = (page && page.next_cursor) || null;
+    contactsCache = contactsCache.concat(items);
+    const list = document.getElementById('contacts-list');
+    list.insertAdjacentHTML('beforeend', items.map(contact =>
+      contactsViewMode === 4 ? renderFullContactTile(contact) : renderContactTile(contact, contactsViewMode)
+    ).join(''));
+  } catch (error) {
+    console.error('Ошибка при догрузке контактов:', error);
+  } finally {
+    contactsPageLoading = false;
+  }
+}
+
+// --- Админский вид: следующая страница пользователей ---
+async function loadMoreGroupedUsers() {
+  if (birthdayMode || contactsPageLoading || groupedUsersOffset === null || !groupedUrl) return;
+  contactsPageLoading = true;
+  const url = groupedUrl;
+  try {
+    const users = await authorizedFetch(url + '&users_offset=' + groupedUsersOffset);
+    // Пока грузили, список мог смениться (поиск, сортировка) — тогда страница устарела
+    if (url !== groupedUrl || birthdayMode) return;
+    const page = Array.isArray(users) ? users : [];
+    groupedUsersOffset = page.length === GROUPED_USERS_PAGE ? groupedUsersOffset + page.length : null;
+    contactsCache = contactsCache.concat(page);
+    const sections = [];
+    for (const user of page) sections.push(await renderUserSection(user));
+    document.getElementById('contacts-list').insertAdjacentHTML('beforeend', sections.join(''));
+  } catch (error) {
+    console.error('Ошибка при догрузке пользователей:', error);
+  } finally {
+    contactsPageLoading = false;
+  }
+}
+
+// --- Админский вид: следующая страница контактов одного пользователя ---
+async function loadMoreUserContacts(btn) {
+  const userId = btn.getAttribute('data-user-id');
+  const user = contactsCache.find(u => String(u.id) === userId);
+  if (btn.disabled || !user || !user.next_cursor) return;
+  btn.disabled = true;
+  const url = groupedUrl;
+  try {
+    let pageUrl = '/contacts/page?limit=100&user_id=' + encodeURIComponent(userId) +
+      '&cursor=' + encodeURIComponent(user.next_cursor);
+    if (groupedQuery) pageUrl += '&' + groupedQuery;
+    const page = await authorizedFetch(pageUrl);
+    if (url !== groupedUrl || birthdayMode) return;
+    const items = (page && page.items) || [];
+    user.contacts = user.contacts.concat(items);
+    user.next_cursor = (page && page.next_cursor) || null;
+    const section = btn.closest('.user-contacts-section');
+    section.querySelector('.user-contacts-list').insertAdjacentHTML('beforeend', items.map(contact =>
+      contactsViewMode === 4 ? renderFullContactTile(contact) : renderContactTile(contact, contactsViewMode)
+    ).join(''));
+    if (user.next_cursor) {
+      btn.textContent = `Показати ще (${user.contacts.length} з ${user.contacts_total})`;
+    } else {
+      btn.remove();
+    }
+  } catch (error) {
+    console.error('Ошибка при догрузке контактов пользователя:', error);
+  } finally {
+    btn.disabled = false;
+  }
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+  const list = document.getElementById('contacts-list');
+  if (!list) return;
+  list.addEventListener('scroll', () => {
+    if (list.scrollTop + list.clientHeight >= list.scrollHeight - 200) {
+      loadMoreContacts();
+    }
+  });
+  list.addEventListener('click', e => {
+    const btn = e.target.closest('.load-more-user-contacts');
+    if (btn) loadMoreUserContacts(btn);
+  });
+});
+
 
 // --- Обновление api-link-block ---
 function updateApiLink(url) {
@@ -1366,6 +1493,122 @@ document.addEventListener('DOMContentLoaded', function() {
   }
 });
 
+// --- Множественный выбор контактов и пакетные действия (один запрос POST /contacts/batch) ---
+let selectMode = false;
+const selectedContactIds = new Set();
+
+function markSelectedTiles() {
+  document.querySelectorAll('#contacts-list .contact-tile[data-id]').forEach(tile => {
+    tile.classList.toggle('selected', selectedContactIds.has(tile.dataset.id));
+  });
+}
+
+function updateBulkBar() {
+  const bar = document.getElementById('contacts-bulk-bar');
+  const toggle = document.getElementById('contacts-select-toggle');
+  if (!bar || !toggle) return;
+  bar.style.display = selectMode ? 'inline-flex' : 'none';
+  toggle.textContent = selectMode ? 'Скасувати вибір' : 'Вибрати';
+  document.getElementById('bulk-count').textContent = `Вибрано: ${selectedContactIds.size}`;
+  bar.querySelectorAll('button').forEach(btn => { btn.disabled = !selectedContactIds.size; });
+}
+
+function setSelectMode(on) {
+  selectMode = on;
+  selectedContactIds.clear();
+  document.getElementById('contacts-list')?.classList.toggle('select-mode', on);
+  markSelectedTiles();
+  updateBulkBar();
+}
+
+async function loadBulkGroups() {
+  const select = document.getElementById('bulk-group');
+  try {
+    const groups = await authorizedFetch('/groups/');
+    select.innerHTML = (groups || []).map(gr => `<option value="${gr.id}">${gr.name}</option>`).join('');
+  } catch (e) {
+    console.error('Ошибка при загрузке групп:', e);
+  }
+}
+
+async function runBulkAction(operations, doneText) {
+  try {
+    const result = await authorizedFetch('/contacts/batch', {
+      method: 'POST',
+      body: JSON.stringify({ operations })
+    });
+    const failed = result.results.filter(item => item.status >= 400);
+    const message = failed.length
+      ? `${doneText}: ${result.succeeded}, помилок: ${failed.length} (${failed[0].error})`
+      : `${doneText}: ${result.succeeded}`;
+    if (typeof addFooterMessage === 'function') {
+      addFooterMessage(message, failed.length ? 'error' : 'success');
+    } else {
+      alert(message);
+    }
+  } catch (e) {
+    alert('Помилка пакетної операції: ' + e.message);
+  }
+  setSelectMode(false);
+  window.resetContactsUI();
+  window.fetchAndRenderContacts();
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+  const sortBar = document.querySelector('.sort');
+  const list = document.getElementById('contacts-list');
+  if (!sortBar || !list) return;
+  sortBar.insertAdjacentHTML('beforeend', `
+    <button id="contacts-select-toggle" type="button" class="contacts-select-toggle">Вибрати</button>
+    <span id="contacts-bulk-bar" class="contacts-bulk-bar" style="display:none">
+      <span id="bulk-count"></span>
+      <button id="bulk-delete" type="button">Видалити</button>
+      <select id="bulk-group" title="Група"></select>
+      <button id="bulk-add-group" type="button">До групи</button>
+      <button id="bulk-remove-group" type="button">З групи</button>
+    </span>`);
+
+  document.getElementById('contacts-select-toggle').addEventListener('click', () => {
+    if (birthdayMode) return;
+    setSelectMode(!selectMode);
+    if (selectMode) loadBulkGroups();
+  });
+  document.getElementById('bulk-delete').addEventListener('click', () => {
+    if (!confirm(`Видалити вибрані контакти (${selectedContactIds.size})?`)) return;
+    runBulkAction([...selectedContactIds].map(id => ({ op: 'delete', id: +id })), 'Видалено');
+  });
+  ['add', 'remove'].forEach(action => {
+    document.getElementById(`bulk-${action}-group`).addEventListener('click', () => {
+      const groupId = +document.getElementById('bulk-group').value;
+      if (!groupId) return;
+      runBulkAction(
+        [...selectedContactIds].map(id => ({ op: `${action}_groups`, id: +id, group_ids: [groupId] })),
+        action === 'add' ? 'Додано до групи' : 'Вилучено з групи'
+      );
+    });
+  });
+
+  // Плитки перерисовываются целиком (renderContacts, догрузка страниц) — возвращаем отметки
+  new MutationObserver(() => { if (selectMode) markSelectedTiles(); }).observe(list, { childList: true, subtree: true });
+
+  // В режиме выбора клик по плитке только отмечает её (раскрытие карточки не срабатывает)
+  window.addEventListener('click', function(e) {
+    if (!selectMode || birthdayMode) return;
+    const tile = e.target.closest('#contacts-list .contact-tile[data-id]');
+    if (!tile) return;
+    e.preventDefault();
+    e.stopPropagation();
+    const id = tile.dataset.id;
+    if (selectedContactIds.has(id)) {
+      selectedContactIds.delete(id);
+    } else {
+      selectedContactIds.add(id);
+    }
+    tile.classList.toggle('selected', selectedContactIds.has(id));
+    updateBulkBar();
+  }, true);
+});
+
 // Экспортируем функции для использования в других модулях
 window.resetContactsUI = resetContactsUI;
 window.fetchAndRenderContacts = fetchAndRenderContacts;
@@ -35,7 +35,7 @@ async function loadUserProfile() {
     if (userData.avatar_url) {
       const menuAvatarElement = document.querySelector('.avatar-section img');
       if (menuAvatarElement) {
-        menuAvatarElement.src = userData.avatar_url;
+        menuAvatarElement.src = userData.avatar_thumbnail_url || userData.avatar_url;
         menuAvatarElement.alt = userData.username || 'User Avatar';
       }
     }
@@ -422,7 +422,7 @@ async function loadPermissionsUsers() {
       <tr><th>Аватар</th><th>Имя</th><th>Почта</th><th>Роль</th><th>Действия</th><th>Запросы на аватар</th></tr>
       ${users.map(u => `
         <tr>
-          <td><img src="${u.main_avatar_url || '/static/menu/img/avatar.png'}" style="width:40px;height:40px;border-radius:50%"></td>
+          <td><img src="${u.main_avatar_thumbnail_url || u.main_avatar_url || '/static/menu/img/avatar.png'}" style="width:40px;height:40px;border-radius:50%"></td>
           <td>${u.username}</td>
           <td>${u.email}</td>
           <td>${u.role}
@@ -433,7 +433,7 @@ async function loadPermissionsUsers() {
             ${u.pending_avatar_requests && u.pending_avatar_requests.length > 0 ?
               u.pending_avatar_requests.filter(req => req.status === 1).map(req => `
                 <div style='margin-bottom:5px;'>
-                  <img src='${req.avatar_url || '/static/menu/img/avatar.png'}' style='width:40px;height:40px;border-radius:50%;vertical-align:middle;'>
+                  <img src='${req.avatar_thumbnail_url || req.avatar_url || '/static/menu/img/avatar.png'}' style='width:40px;height:40px;border-radius:50%;vertical-align:middle;'>
                   <span>${req.message || ''}</span>
                   <button class="approve-avatar-btn" data-avatar-id="${req.avatar_id}">Схвалити</button>
                   <button class="reject-avatar-btn" data-avatar-id="${req.avatar_id}">Відмовити</button>
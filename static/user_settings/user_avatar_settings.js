@@ -62,6 +62,8 @@ function setupAvatarEventListeners() {
 /**
  * Загружает все аватары пользователя и отображает их
  */
+let avatarUploadPollTimer = null;
+
 async function loadUserAvatars() {
   try {
     // Получаем токен доступа из cookie
@@ -82,6 +84,12 @@ async function loadUserAvatars() {
     const data = await response.json();
     console.log('Загруженные аватары:', data);
     displayUserAvatars(data);
+
+    // Пока аватар загружается в Cloudinary в фоне, периодически обновляем список
+    clearTimeout(avatarUploadPollTimer);
+    if (data.some(avatar => avatar.upload_status === 'pending')) {
+      avatarUploadPollTimer = setTimeout(loadUserAvatars, 2000);
+    }
   } catch (error) {
     console.error('Ошибка при загрузке аватаров:', error);
     
@@ -122,7 +130,11 @@ function displayUserAvatars(avatars) {
     if (avatar.is_main && avatar.is_approved) avatarElement.classList.add('main-avatar');
     let actionHtml = '';
     // --- Новый числовой статус ---
-    if (avatar.is_main && avatar.is_approved) {
+    if (avatar.upload_status === 'pending') {
+      actionHtml = '<span class="uploading-badge">Завантажується...</span>';
+    } else if (avatar.upload_status === 'failed') {
+      actionHtml = '<span class="rejected-badge">Помилка завантаження</span>';
+    } else if (avatar.is_main && avatar.is_approved) {
       actionHtml = '<span class="main-badge">Основний</span>';
     } else if (avatar.request_status === 1) {
       actionHtml = `<span class="pending-badge" data-id="${avatar.id}" title="На перевірці">На перевірці</span>`;
@@ -132,7 +144,7 @@ function displayUserAvatars(avatars) {
       actionHtml = `<button class="set-main-avatar-btn" data-id="${avatar.id}">Зробити основним</button>`;
     }
     avatarElement.innerHTML = `
-      <img src="${avatar.file_path}" alt="Аватар пользователя">
+      <img src="${avatar.thumbnail_url || avatar.file_path}" alt="Аватар пользователя">
       <div class="avatar-actions">
         ${actionHtml}
         <button class="delete-avatar-btn" data-id="${avatar.id}">Видалити</button>
@@ -315,7 +327,7 @@ async function uploadAvatar(file) {
     }
     
     // Обновляем аватар в превью если это первый аватар или если он сделан основным
-    if (!data.is_main && data.file_path) {
+    if (!data.is_main && data.file_path && data.upload_status !== 'pending') {
       updateUserAvatarPreview(data.file_path);
     }
     
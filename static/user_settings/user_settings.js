@@ -323,7 +323,7 @@ window.showPermissionsModal = async function() {
     let html = `<table class="permissions-table"><thead><tr><th>Avatar</th><th>Username</th><th>Email</th><th>Тип</th><th>Статус</th><th>Дія</th></tr></thead><tbody>`;
     for (const req of requests) {
       html += `<tr>
-        <td><img src="${req.avatar_url || '/static/menu/img/avatar.png'}" alt="avatar" style="width:40px;height:40px;border-radius:50%"></td>
+        <td><img src="${req.avatar_thumbnail_url || req.avatar_url || '/static/menu/img/avatar.png'}" alt="avatar" style="width:40px;height:40px;border-radius:50%"></td>
         <td>${req.username || ''}</td>
         <td>${req.email || ''}</td>
         <td>${req.request_type || ''}</td>
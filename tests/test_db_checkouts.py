@@ -0,0 +1,74 @@
+"""
+Запрос берёт из пула не больше DB_MAX_CHECKOUTS_PER_REQUEST соединений
+(заголовок X-DB-Checkouts: всего/максимум одновременно), а при
+DB_ENFORCE_CHECKOUT_LIMIT=True лишнее соединение не выдаётся.
+
+Как и остальные тесты, выполняется, только если задан TEST_DATABASE_URL.
+Таблицы тестовой базы пересоздаются.
+"""
+import asyncio
+import os
+import sys
+from datetime import date
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL не задан")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def app_modules(monkeypatch):
+    # database читает DATABASE_URL при импорте
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+    import database
+    import models
+
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    monkeypatch.setattr(database, "DB_ENFORCE_CHECKOUT_LIMIT", True)
+    return database, models
+
+def test_contacts_request_uses_one_connection(app_modules):
+    database, models = app_modules
+    import httpx
+    from auth import create_access_token
+    import main
+
+    with database.SessionLocal() as db:
+        user = models.User(username="user", email="user@example.com", hashed_password="x", role="user")
+        user.contacts.append(models.Contact(first_name="C", email="c@example.com", birthday=date(1990, 1, 1)))
+        db.add(user)
+        db.commit()
+        token = create_access_token({"sub": user.username, "id": user.id, "role": user.role})
+
+    async def get(paths):
+        # ASGITransport не отправляет lifespan: миграции и фоновые воркеры тесту не нужны
+        transport = httpx.ASGITransport(app=main.app)
+        headers = {"Authorization": f"Bearer {token}"}
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", headers=headers) as client:
+                return [await client.get(path) for path in paths]
+        finally:
+            await database.async_engine.dispose()
+
+    responses = asyncio.run(get(["/contacts/", "/contacts/", "/contacts/page"]))
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    # Первый запрос загружает пользователя в кэш и завершает эту транзакцию
+    # до обработчика: соединение берётся дважды, но не одновременно
+    assert [response.headers["X-DB-Checkouts"] for response in responses] == ["2/1", "1/1", "1/1"]
+
+def test_second_connection_is_refused(app_modules):
+    database, models = app_modules
+    checkouts, token = database.begin_request_checkouts()
+    try:
+        with database.engine.connect():
+            with pytest.raises(database.TooManyCheckouts):
+                with database.engine.connect():
+                    pass
+            assert checkouts.current == 1
+    finally:
+        database.end_request_checkouts(checkouts, token)
+    assert (checkouts.total, checkouts.max_held, checkouts.current) == (1, 1, 0)
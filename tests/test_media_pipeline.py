@@ -0,0 +1,169 @@
+"""
+Фоновая загрузка аватаров (media_pipeline) через заглушку Cloudinary
+(cloudinary_local.py): файл сохраняется в spool-каталог, воркер загружает
+варианты, после ошибки повторяет попытку и записывает итоговый статус.
+
+Как и test_birthdays_grouped, нужна PostgreSQL: тест выполняется, только
+если задан TEST_DATABASE_URL. Таблицы тестовой базы пересоздаются.
+"""
+import asyncio
+import io
+import os
+import socket
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL не задан")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def cloudinary_stub(tmp_path, monkeypatch):
+    """Запускает заглушку Cloudinary в потоке и направляет на неё SDK."""
+    import cloudinary
+    import uvicorn
+
+    # cloudinary_local читает CLOUDINARY_LOCAL_DIR при импорте
+    monkeypatch.setenv("CLOUDINARY_LOCAL_DIR", str(tmp_path / "cloudinary"))
+    import cloudinary_local
+    monkeypatch.setattr(cloudinary_local, "CLOUDINARY_LOCAL_DIR", str(tmp_path / "cloudinary"))
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(cloudinary_local.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        assert time.monotonic() < deadline, "заглушка Cloudinary не запустилась"
+        time.sleep(0.05)
+
+    config = cloudinary.config()
+    saved = {name: getattr(config, name, None) for name in ("cloud_name", "api_key", "api_secret", "upload_prefix")}
+    cloudinary.config(cloud_name="local", api_key="key", api_secret="secret", upload_prefix=f"http://127.0.0.1:{port}")
+    try:
+        yield cloudinary_local
+    finally:
+        cloudinary.config(**saved)
+        server.should_exit = True
+        thread.join(timeout=10)
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    # database читает DATABASE_URL при импорте
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+    import database
+    import media_pipeline
+    import models
+
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    with database.SessionLocal() as db:
+        user = models.User(username="user", email="user@example.com", hashed_password="x", role="user")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+
+    monkeypatch.setattr(media_pipeline, "MEDIA_SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setattr(media_pipeline, "MEDIA_UPLOAD_RETRY_DELAY", 0.05)
+    # Очередь и воркеры привязаны к event loop теста
+    monkeypatch.setattr(media_pipeline, "_queue", None)
+    for name in media_pipeline.stats:
+        monkeypatch.setitem(media_pipeline.stats, name, 0)
+    return database, models, media_pipeline, user_id
+
+def _png():
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.effect_noise((64, 64), 64).convert("RGB").save(buffer, "PNG")
+    buffer.seek(0)
+    return buffer
+
+async def _spool(media_pipeline):
+    from fastapi import UploadFile
+
+    return await media_pipeline.spool_upload(UploadFile(file=_png(), filename="avatar.png"))
+
+def test_upload_is_retried_until_it_succeeds(pipeline, cloudinary_stub, monkeypatch):
+    database, models, media_pipeline, user_id = pipeline
+    # Первый запрос upload заглушка отклоняет, остальные принимает
+    answers = iter([0.0])
+    monkeypatch.setattr(cloudinary_stub, "CLOUDINARY_LOCAL_FAIL_RATE", 0.5)
+    monkeypatch.setattr(cloudinary_stub, "random", types.SimpleNamespace(random=lambda: next(answers, 1.0)))
+
+    async def run():
+        try:
+            upload = await _spool(media_pipeline)
+            async with database.AsyncSessionLocal() as db:
+                avatar = await media_pipeline.create_avatar_from_upload(db, user_id, upload)
+            assert avatar.upload_status == media_pipeline.UPLOAD_PENDING
+            assert os.path.exists(media_pipeline._spool_path(avatar.asset_id))
+
+            deadline = time.monotonic() + 30
+            while True:
+                async with database.AsyncSessionLocal() as db:
+                    avatar = await db.get(models.UserAvatar, avatar.id)
+                if avatar.upload_status != media_pipeline.UPLOAD_PENDING:
+                    return avatar
+                assert time.monotonic() < deadline, "загрузка не завершилась"
+                await asyncio.sleep(0.1)
+        finally:
+            await database.async_engine.dispose()
+
+    avatar = asyncio.run(run())
+
+    assert avatar.upload_status == media_pipeline.UPLOAD_DONE
+    assert set(avatar.variants) == set(media_pipeline.VARIANT_NAMES)
+    assert avatar.file_path == avatar.variants["full.webp"]["url"]
+    for variant in avatar.variants.values():
+        assert os.path.exists(cloudinary_stub._stored_path(variant["public_id"]))
+    assert media_pipeline.stats["retried"] == 1
+    assert media_pipeline.stats["uploaded"] == 1
+    assert os.listdir(media_pipeline.MEDIA_SPOOL_DIR) == []
+
+def test_release_removes_spooled_file_only_after_commit(pipeline, monkeypatch):
+    database, models, media_pipeline, user_id = pipeline
+    # Без воркеров: загрузка остаётся в очереди, файл — в spool-каталоге
+    monkeypatch.setattr(media_pipeline, "_ensure_workers", lambda: None)
+    monkeypatch.setattr(media_pipeline, "_queue", asyncio.Queue())
+
+    async def release(avatar_id, commit):
+        async with database.AsyncSessionLocal() as db:
+            avatar = await db.get(models.UserAvatar, avatar_id)
+            await db.delete(avatar)
+            await db.flush()
+            await media_pipeline.release_avatar_media(db, avatar)
+            if commit:
+                await db.commit()
+            else:
+                await db.rollback()
+
+    async def run():
+        try:
+            upload = await _spool(media_pipeline)
+            async with database.AsyncSessionLocal() as db:
+                avatar = await media_pipeline.create_avatar_from_upload(db, user_id, upload)
+            path = media_pipeline._spool_path(avatar.asset_id)
+
+            await release(avatar.id, commit=False)
+            assert os.path.exists(path)
+            async with database.AsyncSessionLocal() as db:
+                assert await db.get(models.MediaAsset, avatar.asset_id) is not None
+
+            await release(avatar.id, commit=True)
+            assert not os.path.exists(path)
+        finally:
+            await database.async_engine.dispose()
+
+    asyncio.run(run())
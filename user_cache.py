@@ -0,0 +1,276 @@
+"""
+Кэш пользователей для auth.get_current_user.
+
+Два уровня:
+- локальный LRU с TTL в памяти процесса (без сетевых запросов);
+- необязательный общий уровень в Redis, чтобы воркеры не ходили в БД
+  за одним и тем же пользователем.
+
+Кэшируется только снимок полей пользователя (без пароля и связей), из
+которого собирается отсоединённый объект models.User. Ключ — username и
+id из токена. При смене роли, имени или пароля вызывается invalidate_user:
+запись удаляется локально и в Redis, а остальные процессы получают
+уведомление через pub/sub и тоже очищают свой локальный уровень.
+
+Здесь же кэшируется профиль для /users/me (поля пользователя и выбранный
+avatar_url) вместе с его ETag. Ключ — id пользователя; профиль сбрасывается
+вместе с пользователем, а при изменении аватаров — через invalidate_profile.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from dotenv import load_dotenv
+
+import models
+from redis_client import async_redis_client, call_redis, on_redis_recovered, RedisUnavailable, REDIS_CONFIGURED_URL
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "True").lower() in ("true", "1", "t")
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "1024"))
+# Общий уровень в Redis по умолчанию включён, только если Redis настроен (REDIS_URL)
+USER_CACHE_REDIS_ENABLED = os.getenv(
+    "USER_CACHE_REDIS_ENABLED", "True" if REDIS_CONFIGURED_URL else "False"
+).lower() in ("true", "1", "t")
+USER_CACHE_REDIS_TTL = int(os.getenv("USER_CACHE_REDIS_TTL", "300"))
+# Пауза перед повторной подпиской на канал инвалидации
+USER_CACHE_RESUBSCRIBE_DELAY = 30
+
+REDIS_KEY_PREFIX = "auth_user:"
+PROFILE_REDIS_KEY_PREFIX = "user_profile:"
+INVALIDATE_CHANNEL = "auth_user:invalidate"
+
+# Поля пользователя, которые нужны обработчикам через current_user
+USER_FIELDS = ("id", "username", "email", "role", "is_verified")
+
+_local_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_local_profiles: "OrderedDict[int, tuple]" = OrderedDict()
+_local_lock = threading.Lock()
+
+stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+profile_stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+# Ключи Redis (по user_id), которые не удалось удалить, пока он был недоступен
+_stale_redis_entries = {}
+
+def _cache_key(username: str, user_id: Optional[int]):
+    return f"{username}:{user_id}"
+
+def user_snapshot(user: models.User):
+    return {field: getattr(user, field) for field in USER_FIELDS}
+
+def user_from_snapshot(fields: dict):
+    """Отсоединённый объект User (как временный пользователь суперадмина в auth)."""
+    return models.User(**fields)
+
+def _local_get(key, cache=_local_cache):
+    with _local_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        expires_at, fields = entry
+        if expires_at < time.monotonic():
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return fields
+
+def _local_set(key, fields: dict, cache=_local_cache):
+    with _local_lock:
+        cache[key] = (time.monotonic() + USER_CACHE_TTL, fields)
+        cache.move_to_end(key)
+        while len(cache) > USER_CACHE_MAX_SIZE:
+            cache.popitem(last=False)
+
+def _local_invalidate(user_id: int):
+    with _local_lock:
+        for key in [k for k, (_, fields) in _local_cache.items() if fields["id"] == user_id]:
+            del _local_cache[key]
+        _local_profiles.pop(user_id, None)
+
+def _local_clear():
+    with _local_lock:
+        _local_cache.clear()
+        _local_profiles.clear()
+
+async def get_cached_user(username: str, user_id: Optional[int]):
+    """Пользователь из кэша или None, если его нужно прочитать из БД."""
+    if not USER_CACHE_ENABLED:
+        return None
+    key = _cache_key(username, user_id)
+    fields = _local_get(key)
+    if fields is not None:
+        stats["local_hits"] += 1
+        return user_from_snapshot(fields)
+
+    if USER_CACHE_REDIS_ENABLED:
+        try:
+            raw = await call_redis(lambda: async_redis_client.get(REDIS_KEY_PREFIX + key))
+        except RedisUnavailable:
+            raw = None
+        if raw:
+            fields = json.loads(raw)
+            _local_set(key, fields)
+            stats["redis_hits"] += 1
+            return user_from_snapshot(fields)
+
+    stats["misses"] += 1
+    return None
+
+async def cache_user(username: str, user_id: Optional[int], user: models.User):
+    """Сохраняет пользователя, прочитанного из БД, в оба уровня кэша."""
+    if not USER_CACHE_ENABLED:
+        return
+    key = _cache_key(username, user_id)
+    fields = user_snapshot(user)
+    _local_set(key, fields)
+    if USER_CACHE_REDIS_ENABLED:
+        try:
+            await call_redis(lambda: async_redis_client.set(
+                REDIS_KEY_PREFIX + key, json.dumps(fields), ex=USER_CACHE_REDIS_TTL
+            ))
+        except RedisUnavailable:
+            pass
+
+async def get_cached_profile(user_id: int):
+    """Профиль для /users/me (с ключом "etag") из кэша или None."""
+    if not USER_CACHE_ENABLED:
+        return None
+    profile = _local_get(user_id, _local_profiles)
+    if profile is not None:
+        profile_stats["local_hits"] += 1
+        return profile
+
+    if USER_CACHE_REDIS_ENABLED:
+        try:
+            raw = await call_redis(lambda: async_redis_client.get(PROFILE_REDIS_KEY_PREFIX + str(user_id)))
+        except RedisUnavailable:
+            raw = None
+        if raw:
+            profile = json.loads(raw)
+            _local_set(user_id, profile, _local_profiles)
+            profile_stats["redis_hits"] += 1
+            return profile
+
+    profile_stats["misses"] += 1
+    return None
+
+async def cache_profile(user_id: int, profile: dict):
+    """Сохраняет профиль и возвращает его с вычисленным ETag."""
+    body = json.dumps(profile, sort_keys=True, default=str)
+    profile = {**profile, "etag": '"' + hashlib.sha1(body.encode()).hexdigest() + '"'}
+    if not USER_CACHE_ENABLED:
+        return profile
+    _local_set(user_id, profile, _local_profiles)
+    if USER_CACHE_REDIS_ENABLED:
+        try:
+            await call_redis(lambda: async_redis_client.set(
+                PROFILE_REDIS_KEY_PREFIX + str(user_id), json.dumps(profile, default=str), ex=USER_CACHE_REDIS_TTL
+            ))
+        except RedisUnavailable:
+            pass
+    return profile
+
+async def invalidate_user(user_id: int, *usernames: str):
+    """
+    Сбрасывает кэш пользователя (и его профиль) после изменения роли, имени
+    или пароля. usernames — все имена, под которыми он мог быть закэширован
+    (старое и новое).
+    """
+    keys = [REDIS_KEY_PREFIX + _cache_key(name, uid) for name in usernames for uid in (user_id, None)]
+    await _invalidate(user_id, keys + [PROFILE_REDIS_KEY_PREFIX + str(user_id)])
+
+async def invalidate_profile(user_id: int):
+    """Сбрасывает профиль /users/me после изменения аватаров пользователя."""
+    await _invalidate(user_id, [PROFILE_REDIS_KEY_PREFIX + str(user_id)])
+
+async def _invalidate(user_id: int, keys: list):
+    _local_invalidate(user_id)
+    if not USER_CACHE_REDIS_ENABLED:
+        return
+
+    async def delete_and_publish():
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            if keys:
+                pipe.delete(*keys)
+            pipe.publish(INVALIDATE_CHANNEL, str(user_id))
+            await pipe.execute()
+
+    try:
+        await call_redis(delete_and_publish)
+    except RedisUnavailable:
+        # Не удалось сбросить общий уровень: ключи удаляются после восстановления Redis
+        _stale_redis_entries.setdefault(user_id, set()).update(keys)
+
+async def invalidation_listener():
+    """
+    Фоновая задача: очищает локальный уровень по сообщениям других процессов.
+    Локальный уровень очищается целиком, только если терялась уже работавшая
+    подписка; неудачные попытки подписаться при недоступном Redis его не трогают.
+    """
+    if not (USER_CACHE_ENABLED and USER_CACHE_REDIS_ENABLED):
+        return
+    # subscribed — подписка сейчас работает; lost — работавшая подписка терялась
+    subscribed = lost = False
+    while True:
+        pubsub = async_redis_client.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATE_CHANNEL)
+            if lost:
+                # Пока подписки не было, в кэш могли попасть записи, о смене
+                # которых уведомления не дошли
+                _local_clear()
+                lost = False
+            subscribed = True
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    _local_invalidate(int(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Подписка на инвалидацию кэша пользователей прервана: {e}")
+            if subscribed:
+                # Работавшая подписка потеряна: чужие изменения могут быть не видны
+                _local_clear()
+                subscribed, lost = False, True
+            await asyncio.sleep(USER_CACHE_RESUBSCRIBE_DELAY)
+        finally:
+            try:
+                await pubsub.reset()
+            except Exception:
+                pass
+
+async def _reconcile_after_redis_outage():
+    """
+    После восстановления Redis: пока он был недоступен, инвалидации не доходили
+    до других процессов, поэтому локальный кэш сбрасывается целиком, а
+    неудалённые записи общего уровня удаляются с рассылкой уведомлений.
+    """
+    _local_clear()
+    stale = dict(_stale_redis_entries)
+    if not stale:
+        return
+
+    async def drop_stale_entries():
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            for user_id, keys in stale.items():
+                if keys:
+                    pipe.delete(*keys)
+                pipe.publish(INVALIDATE_CHANNEL, str(user_id))
+            await pipe.execute()
+
+    await call_redis(drop_stale_entries)
+    for user_id in stale:
+        _stale_redis_entries.pop(user_id, None)
+
+on_redis_recovered(_reconcile_after_redis_outage)
@@ -1,5 +1,7 @@
 import os
+import re
 import cloudinary
+import cloudinary.api
 import cloudinary.uploader
 from cloudinary.utils import cloudinary_url
 from dotenv import load_dotenv
@@ -14,10 +16,14 @@ cloudinary.config(
     api_secret=os.getenv('CLOUDINARY_API_SECRET')
 )
 
+# Адрес API можно заменить на локальную заглушку (см. cloudinary_local.py)
+if os.getenv('CLOUDINARY_UPLOAD_PREFIX'):
+    cloudinary.config(upload_prefix=os.getenv('CLOUDINARY_UPLOAD_PREFIX'))
+
 def upload_image(file, folder="avatars"):
     """
     Загрузка изображения в Cloudinary
-    :param file: файл зображення
+    :param file: файл зображення (байти, файловий об'єкт або шлях)
     :param folder: папка в Cloudinary
     :return: URL загруженного изображения и public_id
     """
@@ -48,6 +54,48 @@ def delete_image(public_id):
         print(f"Error deleting from cloudinary: {e}")
         return None
 
+def delete_images(public_ids):
+    """
+    Удаление нескольких изображений одним запросом Admin API (до 100 public_id)
+    :param public_ids: список public_id
+    :return: множество public_id, которых больше нет в Cloudinary, или None при ошибке
+    """
+    try:
+        result = cloudinary.api.delete_resources(list(public_ids))
+        return {
+            public_id for public_id, status in result.get("deleted", {}).items()
+            if status in ("deleted", "not_found")
+        }
+    except Exception as e:
+        print(f"Error deleting from cloudinary: {e}")
+        return None
+
+# https://res.cloudinary.com/<cloud>/image/upload/[<трансформации>/][v<версия>/]<public_id>.<расширение>
+_DELIVERY_URL_RE = re.compile(r"^https?://res\.cloudinary\.com/([^/]+)/image/upload/(.+)$")
+
+def public_id_from_url(url):
+    """
+    public_id изображения по URL доставки Cloudinary
+    :param url: URL изображения
+    :return: public_id или None, если это не изображение из нашего облака
+    """
+    prefix = os.getenv('CLOUDINARY_UPLOAD_PREFIX')
+    if prefix and url and url.startswith(prefix.rstrip("/") + "/media/"):
+        # Файлы локальной заглушки: {prefix}/media/<public_id>
+        return url[len(prefix.rstrip("/") + "/media/"):] or None
+    match = _DELIVERY_URL_RE.match(url or "")
+    if not match or match.group(1) != cloudinary.config().cloud_name:
+        return None
+    parts = match.group(2).split("/")
+    # Всё до сегмента версии — трансформации
+    for i, part in enumerate(parts):
+        if re.fullmatch(r"v\d+", part):
+            parts = parts[i + 1:]
+            break
+    if not parts:
+        return None
+    return os.path.splitext("/".join(parts))[0]
+
 def generate_url(public_id, **options):
     """
     Генерація URL для зображення з трансформаціями
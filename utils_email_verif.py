@@ -1,25 +1,19 @@
 import os
-import aiosmtplib
 from email.message import EmailMessage
 
-async def send_verification_email(to_email: str, code: str):
+# Функции ниже только собирают письма; отправляет их фоновый воркер
+# (см. email_outbox.queue_email)
+
+def verification_email(to_email: str, code: str):
     msg = EmailMessage()
     msg['From'] = os.getenv("EMAIL_HOST_USER")
     msg['To'] = to_email
     msg['Subject'] = "Код підтвердження реєстрації"
     msg.set_content(f"Ваш код підтвердження: {code}")
+    return msg
 
-    await aiosmtplib.send(
-        msg,
-        hostname=os.getenv("EMAIL_HOST"),
-        port=int(os.getenv("EMAIL_PORT")),
-        username=os.getenv("EMAIL_HOST_USER"),
-        password=os.getenv("EMAIL_HOST_PASSWORD"),
-        start_tls=True
-    )
-
-# Добавляем новую функцию для отправки ссылки сброса пароля
-async def send_password_reset_email(to_email: str, reset_url: str, username: str = ""):
+# Письмо со ссылкой сброса пароля
+def password_reset_email(to_email: str, reset_url: str, username: str = ""):
     msg = EmailMessage()
     msg['From'] = os.getenv("EMAIL_HOST_USER")
     msg['To'] = to_email
@@ -51,13 +45,4 @@ async def send_password_reset_email(to_email: str, reset_url: str, username: str
     # Установка содержимого и типа контента
     msg.set_content(f"Вітаємо!\n\nВи зробили запит на скидання пароля для Вашого облікового запису.\n\nЩоб встановити новий пароль, перейдіть за посиланням: {reset_url}\n\nПосилання дійсне протягом 24 годин.\n\nЯкщо Ви не запитували скидання пароля, просто ігноруйте цей лист.")
     msg.add_alternative(html_content, subtype='html')
-
-    # Отправляем email
-    await aiosmtplib.send(
-        msg,
-        hostname=os.getenv("EMAIL_HOST"),
-        port=int(os.getenv("EMAIL_PORT")),
-        username=os.getenv("EMAIL_HOST_USER"),
-        password=os.getenv("EMAIL_HOST_PASSWORD"),
-        start_tls=True
-    )
+    return msg